@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""asyncapp.py serves the waypoint hot path of views.py from an asyncio event loop.
+
+It serves these routes of views.py, with the same answers:
+
+    POST /initialize_db/
+    POST /route/
+    POST /route/<route_id>/way_point/
+    POST /route/<route_id>/way_points/    JSON only, no timestamps
+    GET  /route/<route_id>/length/        and ?verify=true
+    GET  /longest-route/<query_date>
+    GET  /cache/stats/                    without the waypoint buffer
+
+The waypoint exports and uploads in other content types, /export/,
+/longest-routes, /routes/lengths and /metrics are only served by views.py.
+
+Each uWSGI worker of wsgi.py handles one request at a time and spends most of
+it waiting on Postgres. Here every process multiplexes many in-flight
+requests over an asyncpg pool of its own, so the number of concurrent
+trackers is bound by ASYNC_DB_POOL_MAX connections per process rather than
+by the number of processes. The SQL is the same querys.STATEMENTS; the route
+metadata and longest-route caches and the spool are shared with
+controller.py. The rare initialization of the db runs the synchronous
+models.initialize_db() in the default executor.
+
+Example:
+    Run it next to the uWSGI deployment, with the same number of processes,
+
+        $ gunicorn asyncapp:application --bind 0.0.0.0:5001 --workers 5 \
+            --worker-class aiohttp.GunicornWebWorker
+
+    or, for a single process,
+
+        $ python asyncapp.py
+
+Constants:
+    ASYNC_DB_POOL_MIN (int): connections opened up front per process
+    ASYNC_DB_POOL_MAX (int): maximum connections per process
+    ASYNC_DB_POOL_TIMEOUT (float): seconds a request waits for a connection
+    ASYNC_PORT (int): port of `python asyncapp.py`
+
+"""
+import asyncio
+import json
+import logging
+import datetime
+import os
+
+import asyncpg
+from aiohttp import web
+
+import controller
+import models
+import views
+
+LOGGER = logging.getLogger(__name__)
+
+ASYNC_DB_POOL_MIN = int(os.environ.get("ASYNC_DB_POOL_MIN", 4))
+ASYNC_DB_POOL_MAX = int(os.environ.get("ASYNC_DB_POOL_MAX", 32))
+ASYNC_DB_POOL_TIMEOUT = float(os.environ.get("ASYNC_DB_POOL_TIMEOUT", 5.0))
+ASYNC_PORT = int(os.environ.get("ASYNC_PORT", 5001))
+
+# Raised while the database is down, restarting or out of connections
+UNAVAILABLE_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncio.TimeoutError,
+    OSError,
+)
+
+
+def statement(name):
+    """
+    Returns:
+        str: the $n statement querys.STATEMENTS[name]. asyncpg prepares it
+            once per connection and reuses it from its statement cache.
+    """
+    return models.querys.STATEMENTS[name][1]
+
+
+async def fetchrow(pool, query, *args):
+    """Runs query on a connection checked out of pool
+
+    Returns:
+        asyncpg.Record: the first row, or None
+
+    Raises:
+        asyncio.TimeoutError: if no connection was free for
+            ASYNC_DB_POOL_TIMEOUT seconds
+    """
+    async with pool.acquire(timeout=ASYNC_DB_POOL_TIMEOUT) as conn:
+        return await conn.fetchrow(query, *args)
+
+
+async def fetchval(pool, query, *args):
+    """
+    Returns:
+        the first column of the first row, or None
+    """
+    row = await fetchrow(pool, query, *args)
+    return row[0] if row is not None else None
+
+
+def json_response(body, status):
+    return web.Response(
+        text=json.dumps(body), status=status, content_type="application/json"
+    )
+
+
+def flask_response(response):
+    """Converts a (json text, status[, headers]) tuple of controller.py to a
+    Response"""
+    text, status, headers = response if len(response) == 3 else response + (None,)
+    return web.Response(
+        text=text, status=status, headers=headers, content_type="application/json"
+    )
+
+
+async def route_creation_date(pool, route_id):
+    """The async counterpart of controller.route_creation_date()
+
+    Returns:
+        str: the creation date as %Y-%m-%d, or None if route_id does not exist
+    """
+    creation_date = controller.ROUTE_META_CACHE.get(str(route_id))
+    if creation_date is not None:
+        return creation_date
+    creation_time = await fetchval(pool, statement("check_origin_time"), route_id)
+    if creation_time is None:
+        return None
+    return controller.cache_route_creation_date(route_id, creation_time)
+
+
+async def rejected_way_point(pool, route_id):
+    """The async counterpart of controller.rejected_way_point()"""
+    if await route_creation_date(pool, route_id) is None:
+        return json_response({"Error": "route_id does not exist!"}, 404)
+    return json_response(
+        {"Error": "You can not add more data points to this object."}, 403
+    )
+
+
+async def initialize_db(request):
+    """The async counterpart of views.initialize_db()"""
+    try:
+        secret_key = await request.json()
+    except ValueError:
+        secret_key = None
+    if not isinstance(secret_key, dict) or "key" not in secret_key:
+        return json_response({"Error": "Expected a JSON object with a key."}, 400)
+    if secret_key["key"] != views.SECRET:
+        return json_response({"Error": "Failed to initialize the db"}, 500)
+    await asyncio.get_event_loop().run_in_executor(None, models.initialize_db)
+    return json_response(
+        {"Success!": "PostGres DB with postgis extensions is created."}, 201
+    )
+
+
+async def create_route(request):
+    """The async counterpart of views.create_route()"""
+    pool = request.app["pool"]
+    new_route_id, creation_time = await fetchrow(pool, statement("start_new_route"))
+    controller.cache_route_creation_date(new_route_id, creation_time)
+    LOGGER.debug("Assigned route_id %s to new route...", new_route_id)
+    return json_response({"route_id": str(new_route_id)}, 201)
+
+
+async def add_way_point(request):
+    """The async counterpart of views.add_way_point()"""
+    route_id = int(request.match_info["route_id"])
+    try:
+        coordinates = await request.json()
+        longitude, latitude = float(coordinates["lon"]), float(coordinates["lat"])
+    except (KeyError, TypeError, ValueError):
+        return json_response(
+            {"Error": "Every waypoint needs a numeric lat and lon."}, 400
+        )
+    pool = request.app["pool"]
+    if controller.is_cached_route_stale(route_id):
+        return await rejected_way_point(pool, route_id)
+    try:
+        inserted = await fetchval(
+            pool, statement("update_route"), route_id, longitude, latitude
+        )
+    except UNAVAILABLE_ERRORS as err:
+        return flask_response(
+            controller.spool_way_points(route_id, [(longitude, latitude)], err)
+        )
+    if inserted is None:
+        return await rejected_way_point(pool, route_id)
+    return json_response(
+        {"Ok": "Updated waypoint for route_id {}".format(route_id)}, 201
+    )
+
+
+async def add_way_points(request):
+    """The async counterpart of views.add_way_points()"""
+    route_id = int(request.match_info["route_id"])
+    try:
+        way_points = await request.json()
+    except ValueError:
+        way_points = None
+    if not isinstance(way_points, list) or not way_points:
+        return json_response({"Error": "Expected a list of coordinates."}, 400)
+    if len(way_points) > views.MAX_WAY_POINTS_PER_BATCH:
+        return json_response(
+            {
+                "Error": "At most {} waypoints per batch.".format(
+                    views.MAX_WAY_POINTS_PER_BATCH
+                )
+            },
+            413,
+        )
+    try:
+        coordinates = [
+            (float(way_point["lon"]), float(way_point["lat"]))
+            for way_point in way_points
+        ]
+    except (KeyError, TypeError, ValueError):
+        return json_response(
+            {"Error": "Every waypoint needs a numeric lat and lon."}, 400
+        )
+    pool = request.app["pool"]
+    if controller.is_cached_route_stale(route_id):
+        return await rejected_way_point(pool, route_id)
+    try:
+        inserted = await fetchval(
+            pool,
+            statement("update_route_batch"),
+            route_id,
+            None,
+            [longitude for longitude, _ in coordinates],
+            [latitude for _, latitude in coordinates],
+        )
+    except UNAVAILABLE_ERRORS as err:
+        return flask_response(controller.spool_way_points(route_id, coordinates, err))
+    if not inserted:
+        return await rejected_way_point(pool, route_id)
+    return json_response(
+        {"route_id": route_id, "received": len(coordinates), "inserted": inserted},
+        201,
+    )
+
+
+async def calculate_length(request):
+    """The async counterpart of views.calculate_length()"""
+    route_id = int(request.match_info["route_id"])
+    pool = request.app["pool"]
+    length_of_route = await fetchrow(pool, statement("stored_route_length"), route_id)
+    if not length_of_route or length_of_route[1] is None:
+        return json_response(
+            {"Error": "route_id {} has not added any waypoints".format(route_id)}, 404
+        )
+    if request.query.get("verify") == "true":
+        recomputed = await fetchval(
+            pool, statement("single_route_length"), route_id
+        )
+        recomputed = recomputed or 0.0
+        return json_response(
+            {
+                "route_id": route_id,
+                "km": length_of_route[0],
+                "recomputed_km": recomputed,
+                "drift_km": length_of_route[0] - recomputed,
+            },
+            201,
+        )
+    return json_response({"route_id": route_id, "km": length_of_route[0]}, 201)
+
+
+async def calculate_longest_route_for_day(request):
+    """The async counterpart of views.calculate_longest_route_for_day()"""
+    query_date = request.match_info["query_date"]
+    longest_route_in_a_day = controller.cached_longest_route_in_day(query_date)
+    if longest_route_in_a_day is None:
+        if not controller.is_query_date_older_than_today(query_date):
+            return json_response(
+                {"Error": "The request will only query days in the past."}, 403
+            )
+        pool = request.app["pool"]
+        pgscript = statement("longest_route_of_finalized_day")
+        day = datetime.datetime.strptime(query_date, "%Y-%m-%d").date()
+        finalized = await fetchrow(pool, pgscript, day)
+        if finalized is None:
+            last_finalized_day = await fetchval(pool, statement("last_finalized_day"))
+            if last_finalized_day is None or day > last_finalized_day:
+                return flask_response(controller.day_not_finalized(day))
+        elif finalized[0] is not None:
+            longest_route_in_a_day = tuple(finalized)
+        controller.update_long_route_cache(query_date, longest_route_in_a_day)
+    if longest_route_in_a_day:
+        return json_response(
+            {
+                "date": query_date,
+                "route_id": longest_route_in_a_day[0],
+                "km": longest_route_in_a_day[1],
+            },
+            201,
+        )
+    return json_response({"Error": "No routes recorded for {}".format(query_date)}, 404)
+
+
+async def cache_stats(request):
+    """The async counterpart of views.cache_stats()"""
+    return json_response(
+        {
+            "route_meta": controller.ROUTE_META_CACHE.stats(),
+            "longest_route": controller.LONGEST_ROUTE_IN_DAY_CACHE.stats(),
+        },
+        200,
+    )
+
+
+async def open_pool(app):
+    app["pool"] = await asyncpg.create_pool(
+        min_size=ASYNC_DB_POOL_MIN,
+        max_size=ASYNC_DB_POOL_MAX,
+        host=models.DB_HOST,
+        port=models.DB_PORT,
+        database=models.DB_NAME,
+        user=models.DB_USER,
+        password=models.DB_PASS,
+        timeout=models.DB_CONNECT_TIMEOUT,
+    )
+
+
+async def close_pool(app):
+    await app["pool"].close()
+
+
+def create_app():
+    """
+    Returns:
+        web.Application: the routes listed above, backed by an asyncpg pool
+            that is opened on startup
+    """
+    app = web.Application()
+    app.router.add_post("/initialize_db/", initialize_db)
+    app.router.add_post("/route/", create_route)
+    app.router.add_post(r"/route/{route_id:\d+}/way_point/", add_way_point)
+    app.router.add_post(r"/route/{route_id:\d+}/way_points/", add_way_points)
+    app.router.add_get(r"/route/{route_id:\d+}/length/", calculate_length)
+    app.router.add_get("/longest-route/{query_date}", calculate_longest_route_for_day)
+    app.router.add_get("/cache/stats/", cache_stats)
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+    return app
+
+
+application = create_app()
+
+
+if __name__ == "__main__":
+    web.run_app(application, host="0.0.0.0", port=ASYNC_PORT)
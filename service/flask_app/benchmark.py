@@ -0,0 +1,838 @@
+# -*- coding: utf-8 -*-
+"""This module provides client-side benchmarks against a running service.
+
+Example:
+    After the service is running (cd .. && docker-compose up),
+
+        $ python benchmark.py ingest --points 2000 --batch-size 500
+
+    The latency benchmark sends single waypoints from concurrent clients.
+    Run it once per WAYPOINT_INGEST_MODE of the service (sync, buffered),
+
+        $ python benchmark.py latency --label sync --clients 20 --points 200
+
+    The compare benchmark runs the latency benchmark against the uWSGI and
+    the asyncio deployment (async_app in docker-compose.yml), which run the
+    same number of processes, at rising numbers of concurrent devices,
+
+        $ python benchmark.py compare --clients 50 200 1000
+
+    The explain benchmark talks to Postgres directly (through models.py) and
+    builds its own scratch database, BENCHMARK_DB_NAME,
+
+        $ python benchmark.py explain --db-host localhost --routes 10000 \
+            --points-per-route 1000
+
+    The planning benchmark reports, per endpoint, the planning time Postgres
+    spends on the statement sent as SQL text and as a prepared statement,
+
+        $ python benchmark.py planning --db-host localhost
+
+    The lengths benchmark times the numpy length engine (lengths.py) on
+    millions of synthetic points and, with --db-host, recomputes the routes
+    of a scratch database with PostGIS and with numpy and reports the drift,
+
+        $ python benchmark.py lengths --points 10000000 --db-host localhost
+
+    The payloads benchmark reads one long route in every format of
+    GET /route/<id>/way_points/, in full, simplified and as an encoded
+    polyline, and reports bytes and ms per route,
+
+        $ STORAGE_BACKEND=memory python benchmark.py payloads --points 100000
+
+    The export benchmark reports the rows/sec of the bulk day export
+    (export.py) on a scratch database, against a row-by-row fetch,
+
+        $ python benchmark.py export --db-host localhost --routes 10000
+
+    The logging benchmark times requests through the Flask test client with
+    logging off, written synchronously at DEBUG (as before logs.py), queued
+    at DEBUG and queued with sampled DEBUG records,
+
+        $ STORAGE_BACKEND=memory python benchmark.py logging --requests 5000
+
+    The parse benchmark decodes one batch of waypoints in every content type
+    of POST /route/<id>/way_points/ (uploads.py), JSON included, and reports
+    bytes per waypoint and waypoints decoded per second,
+
+        $ python benchmark.py parse --points 5000
+
+    Constants:
+        SERVICE_ENDPOINT (str): Flask app is running here
+        ASYNC_SERVICE_ENDPOINT (str): asyncapp.py is running here
+        ROUTE_ENDPOINT (str): POSTs to this endpoint request a new route_id
+        ROUTE_ADD_WAY_POINT_ENDPOINT (str): single waypoint ingestion
+        ROUTE_ADD_WAY_POINTS_ENDPOINT (str): batch waypoint ingestion
+        BENCHMARK_DB_NAME (str): scratch database of the explain benchmark
+
+"""
+import argparse
+import concurrent.futures
+import json
+import random
+import re
+import timeit
+
+import requests
+
+SERVICE_ENDPOINT = "http://localhost:5000/"
+ASYNC_SERVICE_ENDPOINT = "http://localhost:5001/"
+ROUTE_ENDPOINT = "{}route/".format(SERVICE_ENDPOINT)
+ROUTE_ADD_WAY_POINT_ENDPOINT = "{}{}/way_point/".format(ROUTE_ENDPOINT, "{}")
+ROUTE_ADD_WAY_POINTS_ENDPOINT = "{}{}/way_points/".format(ROUTE_ENDPOINT, "{}")
+BENCHMARK_DB_NAME = "gps_tracker_benchmark"
+
+# Routes are spread over consecutive days starting 2019-01-01, every route
+# gets points_per_route random waypoints one second apart.
+LOAD_SYNTHETIC_ROUTES = """
+    INSERT INTO route_lengths (route_id, creation_time, route_length)
+    SELECT route_id,
+        '2019-01-01'::timestamp + (route_id / %(routes_per_day)s) * interval '1 day',
+        0.0
+    FROM generate_series(1, %(routes)s) AS route_id;
+
+    INSERT INTO routes (route_id, timestamp, geom)
+    SELECT rl.route_id,
+        rl.creation_time + point * interval '1 second',
+        ST_SetSRID(ST_MakePoint(random() * 360 - 180, random() * 180 - 90), 4326)
+    FROM route_lengths rl, generate_series(1, %(points_per_route)s) AS point
+    WHERE rl.route_id > 0;
+
+    ANALYZE routes;
+    ANALYZE route_lengths;
+"""
+
+
+def random_way_points(count):
+    """Generates count random WGS84 coordinates
+
+    Returns:
+        list: of dicts with 'lat' and 'lon' keys
+    """
+    return [
+        {"lat": random.uniform(-90, 90), "lon": random.uniform(-180, 180)}
+        for _ in range(count)
+    ]
+
+
+def start_new_route(session, service=SERVICE_ENDPOINT):
+    """Requests a new route_id from the service
+
+    Returns:
+        route_id (str): the new route_id entered into the db
+    """
+    return session.post("{}route/".format(service)).json()["route_id"]
+
+
+def bench_single_point_ingest(session, way_points):
+    """Sends every waypoint in its own request
+
+    Returns:
+        float: points per second
+    """
+    route_id = start_new_route(session)
+    start_time = timeit.default_timer()
+    for coordinates in way_points:
+        response = session.post(
+            ROUTE_ADD_WAY_POINT_ENDPOINT.format(route_id), json=coordinates
+        )
+        response.raise_for_status()
+    return len(way_points) / (timeit.default_timer() - start_time)
+
+
+def bench_batch_ingest(session, way_points, batch_size):
+    """Sends the waypoints in batches of batch_size
+
+    Returns:
+        float: points per second
+    """
+    route_id = start_new_route(session)
+    start_time = timeit.default_timer()
+    for offset in range(0, len(way_points), batch_size):
+        response = session.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=way_points[offset:offset + batch_size],
+        )
+        response.raise_for_status()
+    return len(way_points) / (timeit.default_timer() - start_time)
+
+
+def run_ingest(args):
+    """Compares single-point and batch ingestion throughput"""
+    session = requests.Session()
+    way_points = random_way_points(args.points)
+    single = bench_single_point_ingest(session, way_points)
+    print("single point: {:>10.1f} points/sec".format(single))
+    batch = bench_batch_ingest(session, way_points, args.batch_size)
+    print(
+        "batch of {:>4}: {:>10.1f} points/sec ({:.1f}x)".format(
+            args.batch_size, batch, batch / single
+        )
+    )
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns:
+        float: the value below which fraction of sorted_values fall
+    """
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def stream_way_points(points, service=SERVICE_ENDPOINT):
+    """One simulated device: a new route and points single waypoint POSTs
+
+    Returns:
+        list: the latency of every waypoint POST, in seconds
+    """
+    session = requests.Session()
+    route_id = start_new_route(session, service)
+    endpoint = "{}route/{}/way_point/".format(service, route_id)
+    latencies = []
+    for coordinates in random_way_points(points):
+        start_time = timeit.default_timer()
+        response = session.post(endpoint, json=coordinates)
+        latencies.append(timeit.default_timer() - start_time)
+        response.raise_for_status()
+    return latencies
+
+
+def measure_latency(service, clients, points):
+    """Streams points single waypoint POSTs from each of clients devices
+
+    Returns:
+        tuple: (points/sec, sorted list of latencies in seconds)
+    """
+    start_time = timeit.default_timer()
+    with concurrent.futures.ThreadPoolExecutor(clients) as pool:
+        results = list(
+            pool.map(stream_way_points, [points] * clients, [service] * clients)
+        )
+    elapsed = timeit.default_timer() - start_time
+    latencies = sorted(latency for result in results for latency in result)
+    return len(latencies) / elapsed, latencies
+
+
+def print_latency(label, throughput, latencies):
+    print(
+        "{:<20} {:>8.1f} points/sec  p50 {:>7.2f} ms  p95 {:>7.2f} ms"
+        "  p99 {:>7.2f} ms".format(
+            label,
+            throughput,
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000,
+        )
+    )
+
+
+def run_latency(args):
+    """Throughput and latency of single waypoint POSTs from concurrent clients"""
+    print_latency(args.label, *measure_latency(args.service, args.clients, args.points))
+
+
+def run_compare(args):
+    """The latency benchmark against several deployments, at rising concurrency
+
+    Every deployment is measured at every --clients level, one after the
+    other, so they never compete for the cores of the host.
+    """
+    services = [service.partition("=")[::2] for service in args.services]
+    for clients in args.clients:
+        for label, service in services:
+            print_latency(
+                "{} x{}".format(label, clients),
+                *measure_latency(service, clients, args.points)
+            )
+
+
+def explain_queries(routes, routes_per_day):
+    """The hot queries of the service, with parameters for the synthetic data
+
+    Returns:
+        list: of (querys constant name, params) tuples
+    """
+    route_id = routes // 2
+    query_date = "2019-01-{:02d}".format(min(28, 1 + route_id // routes_per_day))
+    return [
+        ("ROUTE_ID_EXISTS", (route_id,)),
+        ("CHECK_ORIGIN_TIME", (route_id,)),
+        ("ROUTE_ID_HAS_WAYPOINTS", (route_id,)),
+        ("SINGLE_ROUTE_LENGTH", (route_id,)),
+        ("LONGEST_ROUTE_IN_DAY", (query_date,)),
+    ]
+
+
+def endpoint_statements(routes, routes_per_day):
+    """The statement behind each endpoint, with parameters for the synthetic data
+
+    Returns:
+        list: of (endpoint, statement name, params) tuples
+    """
+    route_id = routes // 2
+    query_date = "2019-01-{:02d}".format(min(28, 1 + route_id // routes_per_day))
+    return [
+        ("POST /route/", "start_new_route", ()),
+        ("POST /route/<id>/way_point/", "update_route", (route_id, 13.4, 52.5)),
+        (
+            "POST /route/<id>/way_points/",
+            "update_route_batch",
+            (route_id, None, [13.4, 13.5], [52.5, 52.6]),
+        ),
+        ("GET /route/<id>/length/", "stored_route_length", (route_id,)),
+        ("GET /route/<id>/length/?verify", "single_route_length", (route_id,)),
+        ("GET /longest-route/<date>", "longest_route_of_finalized_day", (query_date,)),
+    ]
+
+
+def inline_statement(pgscript, params):
+    """Splices the quoted params into the $n parameters of pgscript
+
+    Returns:
+        str: the statement as plain SQL text, the way it was sent before
+            statements were prepared
+    """
+    from psycopg2.extensions import adapt
+
+    return re.sub(
+        r"\$(\d+)",
+        lambda match: adapt(params[int(match.group(1)) - 1]).getquoted().decode(),
+        pgscript,
+    )
+
+
+def explain_analyze(models, pgscript, timing="Execution"):
+    """Runs EXPLAIN ANALYZE of pgscript in a transaction that is rolled back
+
+    Returns:
+        float: the execution (or planning) time in ms reported by EXPLAIN ANALYZE
+    """
+    conn, cur = models.execute_pgscript("EXPLAIN ANALYZE " + pgscript)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    models.release_connection(conn)
+    return float(re.search(timing + r" (?:T|t)ime: ([0-9.]+) ms", plan).group(1))
+
+
+def prepared_planning_time(models, name, params, executions):
+    """Prepares querys.STATEMENTS[name] and runs it executions times
+
+    Once Postgres switches to the generic plan of a prepared statement
+    (after 5 executions), EXECUTE skips planning.
+
+    Returns:
+        float: the planning time in ms reported by EXPLAIN ANALYZE EXECUTE
+    """
+    execute = models.execute_prepared(name, len(params))
+    conn, cur = models.execute_pgscript(models.prepare_statement(name))
+    try:
+        for _ in range(executions):
+            cur.execute(execute, params)
+        cur.execute("EXPLAIN ANALYZE " + execute, params)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+        cur.execute("DEALLOCATE {};".format(name))
+    finally:
+        models.release_connection(conn)
+    return float(re.search(r"Planning (?:T|t)ime: ([0-9.]+) ms", plan).group(1))
+
+
+def create_benchmark_database(models, args):
+    """Builds BENCHMARK_DB_NAME with the base schema and synthetic routes
+
+    The base schema is the one before models.migrate_db(), plus an empty
+    compact_routes table, which the route queries of today read as well.
+
+    Returns:
+        int: the number of routes created per day
+    """
+    models.DB_HOST = args.db_host
+    models.DB_NAME = BENCHMARK_DB_NAME
+    models.drop_database()
+    models.create_new_database()
+    models.activate_postgis_extension()
+    models.create_route_table()
+    models.add_geometry_column_to_table()
+    models.create_route_length_table()
+    models.bootstrap_tables()
+    conn, cur = models.execute_pgscript(models.querys.CREATE_COMPACT_ROUTES_TABLE)
+    models.close_and_commit(cur, conn)
+    routes_per_day = max(1, args.routes // args.days)
+    conn, cur = models.execute_pgscript(
+        LOAD_SYNTHETIC_ROUTES,
+        {
+            "routes": args.routes,
+            "routes_per_day": routes_per_day,
+            "points_per_route": args.points_per_route,
+        },
+    )
+    models.close_and_commit(cur, conn)
+    return routes_per_day
+
+
+def run_explain(args):
+    """EXPLAIN ANALYZE timings of the hot queries before and after migrate_db()"""
+    import models
+
+    routes_per_day = create_benchmark_database(models, args)
+    queries = [
+        (name, inline_statement(getattr(models.querys, name), params))
+        for name, params in explain_queries(args.routes, routes_per_day)
+    ]
+    before = [explain_analyze(models, pgscript) for _, pgscript in queries]
+    models.migrate_db()
+    after = [explain_analyze(models, pgscript) for _, pgscript in queries]
+    print(
+        "{} waypoints, {} routes".format(
+            args.routes * args.points_per_route, args.routes
+        )
+    )
+    print("{:<24} {:>12} {:>12}".format("query", "before (ms)", "after (ms)"))
+    for (name, _), before_ms, after_ms in zip(queries, before, after):
+        print("{:<24} {:>12.2f} {:>12.2f}".format(name, before_ms, after_ms))
+    models.drop_database()
+
+
+def run_planning(args):
+    """Planning time per endpoint, SQL text vs prepared statement
+
+    Writes are rolled back, so the synthetic data is the same for every
+    endpoint.
+    """
+    import models
+
+    routes_per_day = create_benchmark_database(models, args)
+    models.migrate_db()
+    print(
+        "{:<32} {:>14} {:>14} {:>12}".format(
+            "endpoint", "text (ms)", "prepared (ms)", "saved (ms)"
+        )
+    )
+    for endpoint, name, params in endpoint_statements(args.routes, routes_per_day):
+        text_ms = explain_analyze(
+            models,
+            inline_statement(models.querys.STATEMENTS[name][1], params),
+            timing="Planning",
+        )
+        prepared_ms = prepared_planning_time(models, name, params, args.executions)
+        print(
+            "{:<32} {:>14.3f} {:>14.3f} {:>12.3f}".format(
+                endpoint, text_ms, prepared_ms, text_ms - prepared_ms
+            )
+        )
+    models.drop_database()
+
+
+class ByteCounter(object):
+    """A write-only file that only counts what is written to it"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+
+def run_export(args):
+    """Rows/sec of the bulk day export, COPY TO STDOUT vs a row-by-row fetch
+
+    The baseline reads the same waypoints through a named cursor and writes
+    them with the csv module, which is what the export would cost without
+    COPY.
+    """
+    import csv
+    import datetime
+    import io
+
+    import models
+
+    routes_per_day = create_benchmark_database(models, args)
+    models.migrate_db()
+    first_day = datetime.date(2019, 1, 1)
+    last_day = first_day + datetime.timedelta(days=args.routes // routes_per_day)
+    print(
+        "{:<32} {:>12} {:>10} {:>14} {:>10}".format(
+            "export", "rows", "seconds", "rows/sec", "MB"
+        )
+    )
+
+    def report(label, rows, elapsed, size):
+        print(
+            "{:<32} {:>12} {:>10.2f} {:>14.0f} {:>10.1f}".format(
+                label, rows, elapsed, rows / elapsed, size / 1e6
+            )
+        )
+
+    for table in sorted(models.COPY_TABLES):
+        for copy_format in sorted(models.COPY_FORMATS):
+            out = ByteCounter()
+            start_time = timeit.default_timer()
+            rows = models.copy_days(table, first_day, last_day, copy_format, out)
+            report(
+                "copy {} {}".format(table, copy_format),
+                rows,
+                timeit.default_timer() - start_time,
+                out.bytes,
+            )
+    out = ByteCounter()
+    rows = 0
+    start_time = timeit.default_timer()
+    days = {"first_day": first_day, "last_day": last_day}
+    for chunk in models.stream_pgscript(models.querys.DAYS_COORDINATES, days, 10000):
+        text = io.StringIO()
+        csv.writer(text).writerows(chunk)
+        out.write(text.getvalue())
+        rows += len(chunk)
+    report(
+        "fetch way_points csv", rows, timeit.default_timer() - start_time, out.bytes
+    )
+    models.drop_database()
+
+
+def run_lengths(args):
+    """Throughput of lengths.py, and its agreement with PostGIS if --db-host"""
+    import numpy as np
+
+    import lengths
+
+    route_ids = np.repeat(np.arange(args.routes), args.points // args.routes)
+    longitudes = np.random.uniform(-180, 180, len(route_ids))
+    latitudes = np.random.uniform(-90, 90, len(route_ids))
+    start_time = timeit.default_timer()
+    lengths.route_lengths(route_ids, longitudes, latitudes)
+    elapsed = timeit.default_timer() - start_time
+    print(
+        "numpy: {} points, {} routes in {:.3f} s ({:.1f} M points/sec)".format(
+            len(route_ids), args.routes, elapsed, len(route_ids) / elapsed / 1e6
+        )
+    )
+    if args.db_host:
+        compare_length_backends(args)
+
+
+def logging_handlers(mode, log_file, sample_rate):
+    """The root handlers of a mode of the logging benchmark
+
+    Returns:
+        tuple: (list of handlers, the level of the root logger)
+    """
+    import logging
+
+    import logs
+
+    if mode == "off":
+        return [], logging.WARNING
+    if mode == "sync":
+        # What logging.basicConfig(level=DEBUG) did before logs.py
+        handler = logging.StreamHandler(log_file)
+        handler.setFormatter(logging.Formatter(logs.LOG_FORMAT, logs.LOG_DATE_FORMAT))
+        return [handler], logging.DEBUG
+    handler = logs.BackgroundQueueHandler(logs.LOG_QUEUE_SIZE, log_file)
+    if mode == "sampled":
+        handler.addFilter(
+            logs.DebugSampler(sample_rate, logs.LOG_DEBUG_MAX_PER_SECOND)
+        )
+    return [handler], logging.DEBUG
+
+
+def run_logging(args):
+    """Request latency through the Flask test client per logging mode
+
+    Every request creates a route and adds a waypoint to it, the two
+    endpoints that log at DEBUG. Run it with STORAGE_BACKEND=memory to leave
+    the database out of the numbers.
+    """
+    import logging
+
+    import views
+
+    client = views.APP.test_client()
+    root = logging.getLogger()
+    with open(args.log_file, "a") as log_file:
+        for mode in args.modes:
+            handlers, level = logging_handlers(mode, log_file, args.sample_rate)
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+            latencies = []
+            start_time = timeit.default_timer()
+            for way_point in random_way_points(args.requests):
+                request_time = timeit.default_timer()
+                route_id = json.loads(
+                    client.post("/route/").get_data(as_text=True)
+                )["route_id"]
+                client.post("/route/{}/way_point/".format(route_id), json=way_point)
+                latencies.append(timeit.default_timer() - request_time)
+            elapsed = timeit.default_timer() - start_time
+            for handler in handlers:
+                if hasattr(handler, "stop"):
+                    handler.stop()
+            print_latency(
+                "logging {}".format(mode), args.requests / elapsed, sorted(latencies)
+            )
+
+
+def run_payloads(args):
+    """Bytes and milliseconds per route of every format of the route read
+
+    One random-walk route of --points waypoints is read through the Flask
+    test client in full, simplified and as an encoded polyline. Run it with
+    STORAGE_BACKEND=memory to leave the database out of the numbers.
+    """
+    import storage
+    import views
+
+    client = views.APP.test_client()
+    route_id, _ = storage.get_storage().create_route()
+    longitudes, latitudes = [13.4], [52.52]
+    for _ in range(args.points - 1):
+        longitudes.append(longitudes[-1] + random.gauss(0, 0.0002))
+        latitudes.append(latitudes[-1] + random.gauss(0, 0.0002))
+    storage.get_storage().add_way_points(route_id, longitudes, latitudes)
+    variants = [
+        ("geojson", {}),
+        ("ndjson", {}),
+        ("csv", {}),
+        ("polyline", {}),
+        ("geojson", {"simplify": args.tolerance}),
+        ("polyline", {"simplify": args.tolerance}),
+    ]
+    print("{} waypoints, simplify={}".format(args.points, args.tolerance))
+    print("{:<24} {:>12} {:>10}".format("format", "bytes", "ms"))
+    for export_format, params in variants:
+        params = dict(params, format=export_format)
+        timings = []
+        for _ in range(args.repeat):
+            start_time = timeit.default_timer()
+            body = client.get(
+                "/route/{}/way_points/".format(route_id), query_string=params
+            ).get_data()
+            timings.append(timeit.default_timer() - start_time)
+        label = export_format + (" simplified" if "simplify" in params else "")
+        print(
+            "{:<24} {:>12} {:>10.2f}".format(
+                label, len(body), percentile(sorted(timings), 0.5) * 1000
+            )
+        )
+
+
+def run_parse(args):
+    """Bytes per waypoint and decode throughput of every upload content type
+
+    Each body holds the same random-walk batch of --points stamped
+    waypoints. A decode includes the conversion to the lists that the
+    batched insert takes, as in views.add_way_points().
+    """
+    import msgpack
+    import numpy as np
+
+    import polyline
+    import uploads
+
+    longitudes = 13.4 + np.cumsum(np.random.normal(0, 0.0002, args.points))
+    latitudes = 52.52 + np.cumsum(np.random.normal(0, 0.0002, args.points))
+    epochs = 1567296000.0 + np.arange(args.points, dtype=np.float64)
+    packed = np.empty(args.points, dtype=uploads.WAY_POINT_DTYPE)
+    packed["timestamp"], packed["lon"], packed["lat"] = epochs, longitudes, latitudes
+    records = [
+        {"timestamp": epoch, "lon": longitude, "lat": latitude}
+        for epoch, longitude, latitude in zip(
+            epochs.tolist(), longitudes.tolist(), latitudes.tolist()
+        )
+    ]
+    bodies = [
+        ("json", "application/json", json.dumps(records).encode("utf-8")),
+        ("packed", uploads.PACKED_CONTENT_TYPE, packed.tobytes()),
+        (
+            "msgpack columns",
+            "application/msgpack",
+            msgpack.packb(
+                {
+                    "timestamp": epochs.astype("<f8").tobytes(),
+                    "lon": longitudes.astype("<f8").tobytes(),
+                    "lat": latitudes.astype("<f8").tobytes(),
+                },
+                use_bin_type=True,
+            ),
+        ),
+        ("msgpack records", "application/msgpack", msgpack.packb(records)),
+        (
+            "polyline",
+            uploads.POLYLINE_CONTENT_TYPE,
+            polyline.encode_polyline(longitudes, latitudes).encode("ascii"),
+        ),
+    ]
+    print("{} waypoints per batch".format(args.points))
+    print(
+        "{:<18} {:>14} {:>10} {:>16}".format(
+            "content", "bytes/waypoint", "ms", "waypoints/sec"
+        )
+    )
+    for label, content_type, body in bodies:
+        timings = []
+        for _ in range(args.repeat):
+            start_time = timeit.default_timer()
+            uploads.as_lists(*uploads.decode_way_points(content_type, body))
+            timings.append(timeit.default_timer() - start_time)
+        median_s = percentile(sorted(timings), 0.5)
+        print(
+            "{:<18} {:>14.1f} {:>10.3f} {:>16.0f}".format(
+                label,
+                len(body) / args.points,
+                median_s * 1000,
+                args.points / median_s if median_s else 0.0,
+            )
+        )
+
+
+def compare_length_backends(args):
+    """Recomputes every synthetic route with PostGIS and with lengths.py"""
+    import models
+
+    create_benchmark_database(models, args)
+    models.migrate_db()
+    route_ids = list(range(1, args.routes + 1))
+
+    start_time = timeit.default_timer()
+    conn, cur = models.execute_pgscript(
+        models.querys.RECOMPUTE_ROUTE_LENGTHS, {"route_ids": route_ids}
+    )
+    postgis_s = timeit.default_timer() - start_time
+    cur.execute(
+        "SELECT route_id, route_length FROM route_lengths"
+        " WHERE route_id = ANY(%s) ORDER BY route_id;",
+        (route_ids,),
+    )
+    postgis = dict(cur.fetchall())
+
+    start_time = timeit.default_timer()
+    cur.execute(models.querys.ROUTE_COORDINATES, {"route_ids": route_ids})
+    rows = cur.fetchall()
+    fetch_s = timeit.default_timer() - start_time
+    start_time = timeit.default_timer()
+    computed_ids, kms = models.lengths.route_lengths_of_rows(rows)
+    numpy_s = timeit.default_timer() - start_time
+    models.release_connection(conn)
+
+    drift = [abs(km - postgis[route_id]) for route_id, km in zip(computed_ids, kms)]
+    print("{} waypoints, {} routes".format(len(rows), len(computed_ids)))
+    print("postgis recompute:        {:>8.3f} s".format(postgis_s))
+    print(
+        "numpy fetch + compute:    {:>8.3f} s + {:.3f} s".format(fetch_s, numpy_s)
+    )
+    print("max drift:                {:>12.3e} km".format(max(drift or [0.0])))
+    models.drop_database()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    ingest = subparsers.add_parser(
+        "ingest", help="waypoints/sec, single-point vs batch endpoint"
+    )
+    ingest.add_argument("--points", type=int, default=2000)
+    ingest.add_argument("--batch-size", type=int, default=500)
+    ingest.set_defaults(func=run_ingest)
+
+    latency = subparsers.add_parser(
+        "latency", help="single waypoint POST throughput and latency percentiles"
+    )
+    latency.add_argument("--label", default="service")
+    latency.add_argument("--service", default=SERVICE_ENDPOINT)
+    latency.add_argument("--clients", type=int, default=20)
+    latency.add_argument("--points", type=int, default=200)
+    latency.set_defaults(func=run_latency)
+
+    compare = subparsers.add_parser(
+        "compare", help="latency benchmark of several deployments side by side"
+    )
+    compare.add_argument(
+        "--services",
+        nargs="+",
+        default=["uwsgi=" + SERVICE_ENDPOINT, "asyncio=" + ASYNC_SERVICE_ENDPOINT],
+        help="label=url pairs",
+    )
+    compare.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000])
+    compare.add_argument("--points", type=int, default=50)
+    compare.set_defaults(func=run_compare)
+
+    explain = subparsers.add_parser(
+        "explain", help="EXPLAIN ANALYZE of the hot queries before/after migrations"
+    )
+    explain.add_argument("--db-host", default="localhost")
+    explain.add_argument("--routes", type=int, default=10000)
+    explain.add_argument("--points-per-route", type=int, default=1000)
+    explain.add_argument("--days", type=int, default=28)
+    explain.set_defaults(func=run_explain)
+
+    planning = subparsers.add_parser(
+        "planning", help="planning time per endpoint, SQL text vs prepared"
+    )
+    planning.add_argument("--db-host", default="localhost")
+    planning.add_argument("--routes", type=int, default=10000)
+    planning.add_argument("--points-per-route", type=int, default=100)
+    planning.add_argument("--days", type=int, default=28)
+    planning.add_argument("--executions", type=int, default=6)
+    planning.set_defaults(func=run_planning)
+
+    length_engine = subparsers.add_parser(
+        "lengths", help="numpy route lengths, and agreement with PostGIS"
+    )
+    length_engine.add_argument("--points", type=int, default=10000000)
+    length_engine.add_argument("--routes", type=int, default=10000)
+    length_engine.add_argument(
+        "--db-host", help="also compare with PostGIS on a scratch database"
+    )
+    length_engine.add_argument("--points-per-route", type=int, default=100)
+    length_engine.add_argument("--days", type=int, default=28)
+    length_engine.set_defaults(func=run_lengths)
+
+    payloads = subparsers.add_parser(
+        "payloads", help="bytes and ms per route of every route read format"
+    )
+    payloads.add_argument("--points", type=int, default=100000)
+    payloads.add_argument("--tolerance", type=float, default=0.0001)
+    payloads.add_argument("--repeat", type=int, default=5)
+    payloads.set_defaults(func=run_payloads)
+
+    bulk_export = subparsers.add_parser(
+        "export", help="rows/sec of the COPY day export on a scratch database"
+    )
+    bulk_export.add_argument("--db-host", default="localhost")
+    bulk_export.add_argument("--routes", type=int, default=10000)
+    bulk_export.add_argument("--points-per-route", type=int, default=1000)
+    bulk_export.add_argument("--days", type=int, default=28)
+    bulk_export.set_defaults(func=run_export)
+
+    logging_modes = subparsers.add_parser(
+        "logging", help="request latency with logging off, sync, queued, sampled"
+    )
+    logging_modes.add_argument("--requests", type=int, default=2000)
+    logging_modes.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["off", "sync", "queued", "sampled"],
+        default=["off", "sync", "queued", "sampled"],
+    )
+    logging_modes.add_argument("--sample-rate", type=float, default=0.01)
+    logging_modes.add_argument("--log-file", default="benchmark.log")
+    logging_modes.set_defaults(func=run_logging)
+
+    parse = subparsers.add_parser(
+        "parse", help="decode throughput of every waypoint upload content type"
+    )
+    parse.add_argument("--points", type=int, default=5000)
+    parse.add_argument("--repeat", type=int, default=50)
+    parse.set_defaults(func=run_parse)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""cache.py contains the bounded LRU caches used by controller.py.
+
+Under uWSGI, a cache named in app.ini (cache2 = name=...) lives in shared
+memory, so every worker of the master reads and fills the same entries.
+Outside uWSGI (e.g. `python views.py`, scripts) the same interface is served
+by a process-local LRU.
+
+Example:
+    $ route_meta = cache.get_cache("route_meta", 100000)
+    $ route_meta.set("42", "2019-09-01", expires=3600)
+    $ route_meta.get("42")
+    '2019-09-01'
+
+"""
+import collections
+import datetime
+import threading
+import time
+
+try:
+    import uwsgi
+except ImportError:  # not running under uWSGI
+    uwsgi = None
+
+# Holds the shared hit/miss counters of every uWSGI cache, see app.ini
+STATS_CACHE_NAME = "cache_stats"
+
+
+class LocalLRUCache(object):
+    """A thread-safe, size-bounded LRU cache local to the current process
+
+    Args:
+        name (str): the name reported in stats()
+        max_items (int): entries kept before the least recently used is evicted
+
+    """
+
+    def __init__(self, name, max_items):
+        self.name = name
+        self.max_items = max_items
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
+
+    def get(self, key):
+        """
+        Returns:
+            str: the cached value, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires=0):
+        """Stores value under key
+
+        Args:
+            key (str): the cache key
+            value (str): the value to store
+            expires (int): seconds until the entry is dropped, 0 for never
+        """
+        expires_at = time.time() + expires if expires else 0
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, evictions and the current number of items
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "items": len(self._entries),
+                "max_items": self.max_items,
+                "shared": False,
+            }
+
+
+class UWSGICache(object):
+    """A cache2 cache of the uWSGI master, shared by all of its workers
+
+    The cache must be declared in app.ini with purge_lru=1, which makes uWSGI
+    evict the least recently used entry once max_items are stored. uWSGI does
+    not count those evictions, so stats() reports them as None.
+
+    Args:
+        name (str): the cache2 name declared in app.ini
+        max_items (int): the items= value declared in app.ini
+
+    """
+
+    def __init__(self, name, max_items):
+        self.name = name
+        self.max_items = max_items
+
+    def _count(self, counter):
+        uwsgi.cache_inc("{}:{}".format(self.name, counter), 1, 0, STATS_CACHE_NAME)
+
+    def _counter(self, counter):
+        return uwsgi.cache_num("{}:{}".format(self.name, counter), STATS_CACHE_NAME)
+
+    def get(self, key):
+        """
+        Returns:
+            str: the cached value, or None on a miss
+        """
+        value = uwsgi.cache_get(key, self.name)
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return value.decode("utf-8")
+
+    def set(self, key, value, expires=0):
+        """Stores value under key
+
+        Args:
+            key (str): the cache key
+            value (str): the value to store
+            expires (int): seconds until the entry is dropped, 0 for never
+        """
+        uwsgi.cache_update(key, value.encode("utf-8"), expires, self.name)
+
+    def stats(self):
+        """
+        Returns:
+            dict: the keys of LocalLRUCache.stats(), hits and misses summed
+                over all workers, evictions None as uWSGI does not count them,
+                and items None on uWSGI versions without cache_keys()
+        """
+        items = None
+        if hasattr(uwsgi, "cache_keys"):
+            items = len(uwsgi.cache_keys(self.name))
+        return {
+            "hits": self._counter("hits"),
+            "misses": self._counter("misses"),
+            "evictions": None,
+            "items": items,
+            "max_items": self.max_items,
+            "shared": True,
+        }
+
+
+def declared_uwsgi_caches():
+    """Reads the cache2 options uWSGI was started with
+
+    Returns:
+        dict: cache name -> items, empty when not running under uWSGI
+    """
+    if uwsgi is None:
+        return {}
+    declared = uwsgi.opt.get("cache2", [])
+    if not isinstance(declared, list):
+        declared = [declared]
+    caches = {}
+    for option in declared:
+        settings = dict(
+            item.partition("=")[::2] for item in option.decode("utf-8").split(",")
+        )
+        if "name" in settings:
+            caches[settings["name"]] = int(settings.get("items", 0))
+    return caches
+
+
+def get_cache(name, max_items):
+    """Returns the shared uWSGI cache name if declared, else a local LRU
+
+    Args:
+        name (str): the cache2 name declared in app.ini
+        max_items (int): the bound used by the local fallback
+
+    Returns:
+        UWSGICache or LocalLRUCache
+
+    """
+    declared = declared_uwsgi_caches()
+    if name in declared:
+        return UWSGICache(name, declared[name] or max_items)
+    return LocalLRUCache(name, max_items)
+
+
+def seconds_until_midnight():
+    """
+    Returns:
+        int: seconds left in the current day of the server clock, at least 1
+    """
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time()
+    )
+    return max(1, int((midnight - now).total_seconds()))
@@ -1,46 +1,75 @@
 import logging
 import json
 import models
+import csv
 import datetime
-import sys
+import io
+import os
+import time
 
+import cache
+import ingest
+import polyline
+import spool
+import storage
 
-logging.basicConfig(
-    stream=sys.stdout,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p",
+LOGGER = logging.getLogger(__name__)
+
+LONGEST_ROUTE_CACHE_ITEMS = int(os.environ.get("LONGEST_ROUTE_CACHE_ITEMS", 4096))
+LONGEST_ROUTE_CACHE_WARM_DAYS = int(
+    os.environ.get("LONGEST_ROUTE_CACHE_WARM_DAYS", 365)
 )
 
-LONGEST_ROUTE_IN_DAY_CACHE = {"1984-01-28": [0, 833.77]}
+# query_date (%Y-%m-%d) -> JSON [route_id, km], or [] for a day without
+# routes. Past days never change, so entries do not expire; the LRU bound
+# keeps it from growing without limit. Shared by the uWSGI workers.
+LONGEST_ROUTE_IN_DAY_CACHE = cache.get_cache("longest_route", LONGEST_ROUTE_CACHE_ITEMS)
+
+# Seconds after midnight by which tasks.finalize_previous_days(), scheduled
+# at 00:01, has finalized the previous day. Days it has not finalized yet
+# are answered with a Retry-After of the time left until then.
+FINALIZATION_RETRY_SECONDS = int(os.environ.get("FINALIZATION_RETRY_SECONDS", 300))
+
+# route_id -> creation date (%Y-%m-%d), shared by the uWSGI workers. Entries
+# expire at midnight, when every route they describe has become stale.
+ROUTE_META_CACHE = cache.get_cache("route_meta", 100000)
+
+# Waypoints read from the database and sent per chunk of an export
+WAY_POINT_EXPORT_CHUNK_SIZE = int(os.environ.get("WAY_POINT_EXPORT_CHUNK_SIZE", 1000))
+
+# route_ids read from the database and sent per chunk of a bulk length lookup
+ROUTE_LENGTHS_CHUNK_SIZE = int(os.environ.get("ROUTE_LENGTHS_CHUNK_SIZE", 1000))
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# route_id is an INTEGER column, no route_id at or above this exists
+ROUTE_ID_LIMIT = 2 ** 31
+
+# format of a waypoint export -> its content type
+WAY_POINT_EXPORT_FORMATS = {
+    "geojson": "application/geo+json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
 
 def create_route():
     """
-    If there are no records in the DB, the service returns 0 as the route_id
-    else, it returns the max route_id from the route_lengths table + 1 as
-    the route_id.
-
-    In both case, a new row,
+    A new row,
         (route_id, creation_time, route_length)
-    is stored in the route_lengths table.
+    is stored in the route_lengths table, and its route_id is returned.
+
+    The route_id is drawn from the route_lengths sequence by the same INSERT
+    statement, so concurrent requests from any number of workers never get
+    the same route_id.
 
     Returns:
         dict
             'route_id' (str): route_id (int)
     """
-    conn, cur = models.execute_pgscript(models.querys.GET_NEW_ROUTE_ID)
-    new_route_id = cur.fetchone()
-    if str(new_route_id[0]) == "None":
-        logging.info( # This check is essential to the test
-            "Our first track on route_id 0!" # The body of the condition
-            ) # should only ever execute after the first zero transaction.
-        cur.execute(models.querys.START_NEW_ROUTE.format(0))
-        models.close_and_commit(cur, conn)
-        return {"route_id": 0}
-    logging.debug("Assigning route_id {} to new route...".format(new_route_id[0]))
-    cur.execute(models.querys.START_NEW_ROUTE.format(new_route_id[0]))
-    models.close_and_commit(cur, conn)
-    return {"route_id": str(new_route_id[0])}
+    new_route_id, creation_time = storage.get_storage().create_route()
+    cache_route_creation_date(new_route_id, creation_time)
+    LOGGER.debug("Assigned route_id %s to new route...", new_route_id)
+    return {"route_id": str(new_route_id)}
 
 
 def update_route(route_id, longitude, latitude):
@@ -48,6 +77,11 @@ def update_route(route_id, longitude, latitude):
     If the user tries to update an stale route (older than 1 day),
         then they receive a 403 response with a helpful message for debugging.
 
+    The freshness check and the insert are one conditional statement, so
+    an accepted waypoint costs a single round trip. Only when nothing was
+    inserted does rejected_way_point() look up why. In the buffered ingest
+    mode, the waypoint is handed to buffer_way_point() instead.
+
     Args:
         route_id (int): A route_id supplied by the user in the POST
         longitude (float): the longitude supplied by the user in the POST
@@ -55,103 +89,470 @@ def update_route(route_id, longitude, latitude):
 
     Returns:
         dict, 201 response code: success
+        dict, 202 response code: the database is unavailable, the waypoint was spooled
         dict, 404 response code: if the route_id does not exist in the route_lengths table
         dict, 403 response code: if the creation time of the route_id is older than today
+        dict, 503 response code: the database is unavailable and the spool is full
 
     """
-    route_id_exist = route_id_exists(route_id)
-    if not route_id_exist:
-        # Now would be a good time to check on the client ip address
-        return json.dumps({"Error": "route_id does not exist!"}), 404
+    if ingest.is_buffered():
+        return buffer_way_point(route_id, longitude, latitude)
+    if is_cached_route_stale(route_id):
+        return rejected_way_point(route_id)
+    try:
+        inserted = storage.get_storage().add_way_point(route_id, longitude, latitude)
+    except models.UNAVAILABLE_ERRORS as err:
+        return spool_way_points(route_id, [(longitude, latitude)], err)
+    if not inserted:
+        return rejected_way_point(route_id)
+    return json.dumps({"Ok": "Updated waypoint for route_id {}".format(route_id)}), 201
+
+
+def buffer_way_point(route_id, longitude, latitude):
+    """
+    Validates a waypoint against the route metadata and queues it in the
+    write-behind buffer of this worker, stamped with the time it arrived.
 
-    older_than_today = is_origin_time_older_than_today(route_id)
-    # Is this a kind of window function?
-    if older_than_today:
-        logging.debug("Error: You can not add more data points to this object.")
-        # When we find that there are requests coming in from the previous
-        # day, we should then trigger the update all routes in day
-        # script. For each update request that comes in, we will waste
-        # our computational power if we do the update. We just need to
-        # be certain that we have triggered this call once, and that is
-        # at the time of transition from yesterday to today.
-        # See also: query_longest_route_in_day()
-        conn, cur = models.execute_pgscript(
-            models.querys.UPDATE_ALL_ROUTES_IN_DAY_LENGTH.format(
-                yesterday(), yesterday()
-            )
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+        longitude (float): the longitude supplied by the user in the POST
+        latitude (float): the latitude supplied by the user in the POST
+
+    Returns:
+        dict, 202 response code: the waypoint was queued
+        dict, 404 response code: if the route_id does not exist in the route_lengths table
+        dict, 403 response code: if the creation time of the route_id is older than today
+        dict, 429 response code: if the buffer is full
+    """
+    creation_date = route_creation_date(route_id)
+    if creation_date is None or is_query_date_older_than_today(creation_date):
+        return rejected_way_point(route_id)
+    if not ingest.get_buffer().put(route_id, time.time(), longitude, latitude):
+        return json.dumps({"Error": "Too many waypoints, retry later."}), 429
+    return json.dumps({"Ok": "Queued waypoint for route_id {}".format(route_id)}), 202
+
+
+def update_route_batch(route_id, coordinates):
+    """
+    Adds a batch of waypoints to a route with a single multi-row insert.
+
+    The route is checked once for the whole batch, inside the insert, with
+    the same 404 and 403 rules as update_route().
+
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+        coordinates (list): (longitude, latitude) tuples in the order the
+            device recorded them
+
+    Returns:
+        dict, 201 response code: success, with the per-batch counts
+        dict, 202 response code: the database is unavailable, the batch was spooled
+        dict, 404 response code: if the route_id does not exist in the route_lengths table
+        dict, 403 response code: if the creation time of the route_id is older than today
+        dict, 503 response code: the database is unavailable and the spool is full
+
+    """
+    longitudes = [longitude for longitude, _ in coordinates]
+    latitudes = [latitude for _, latitude in coordinates]
+    return update_route_columns(route_id, longitudes, latitudes)
+
+
+def update_route_columns(route_id, longitudes, latitudes, epochs=None):
+    """
+    Same as update_route_batch(), for a batch already split in columns, as
+    the decoders of uploads.py return it.
+
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+        longitudes (list): of floats, in the order the device recorded them
+        latitudes (list): of floats
+        epochs (list): the unix timestamps of the waypoints, None where the
+            server stamps them, or None if it stamps all of them
+
+    Returns:
+        dict, 201 response code: success, with the per-batch counts, also if
+            no waypoint was new or on the day of the route
+        dict, 202 response code: the database is unavailable, the batch was spooled
+        dict, 404 response code: if the route_id does not exist in the route_lengths table
+        dict, 403 response code: if the creation time of the route_id is older than today
+        dict, 503 response code: the database is unavailable and the spool is full
+
+    """
+    if is_cached_route_stale(route_id):
+        return rejected_way_point(route_id)
+    try:
+        inserted = storage.get_storage().add_way_points(
+            route_id, longitudes, latitudes, epochs
         )
-        return (
-            json.dumps(
-                {
-                    "Error": "You can not add more data points to this object."
-                }
-            ),
-            403,
+    except models.UNAVAILABLE_ERRORS as err:
+        return spool_way_points(route_id, list(zip(longitudes, latitudes)), err, epochs)
+    if not inserted:
+        creation_date = route_creation_date(route_id)
+        if creation_date is None or is_query_date_older_than_today(creation_date):
+            return rejected_way_point(route_id)
+    LOGGER.debug("Added %s waypoints to route_id %s", inserted, route_id)
+    return (
+        json.dumps(
+            {"route_id": route_id, "received": len(longitudes), "inserted": inserted}
+        ),
+        201,
+    )
+
+
+def spool_way_points(route_id, coordinates, error, epochs=None):
+    """
+    Appends waypoints that could not be written to the spool of this worker,
+    stamped with the time they arrived unless the device stamped them, to be
+    replayed once the database is back. The route is not looked up here;
+    waypoints of unknown or stale routes are discarded by the replay, like
+    any rejected insert. Only a route_id outside the INTEGER range, which
+    can not exist and would fail every replay, is rejected at once. The
+    replay also writes to the routes of earlier days, so waypoints the
+    device stamped with another day than today are dropped here.
+
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+        coordinates (list): (longitude, latitude) tuples in the order sent
+        error (Exception): why the database could not be written to
+        epochs (list): the unix timestamps of the waypoints, None where the
+            server stamps them, or None if it stamps all of them
+
+    Returns:
+        dict, 202 response code: the waypoints were spooled
+        dict, 404 response code: if the route_id is out of range
+        dict, 503 response code: if the spool is full
+    """
+    if not 0 <= route_id < ROUTE_ID_LIMIT:
+        return json.dumps({"Error": "route_id does not exist!"}), 404
+    epoch = time.time()
+    today = epoch - epoch % SECONDS_PER_DAY
+    epochs = epochs or [None] * len(coordinates)
+    way_points = [
+        (
+            route_id,
+            epoch + offset * 1e-6 if sent_epoch is None else sent_epoch,
+            longitude,
+            latitude,
+        )
+        for offset, (sent_epoch, (longitude, latitude)) in enumerate(
+            zip(epochs, coordinates)
+        )
+        if sent_epoch is None or today <= sent_epoch < today + SECONDS_PER_DAY
+    ]
+    if not spool.get_spool().append(way_points):
+        LOGGER.error(
+            "Spool full, rejected %s waypoints of route_id %s: %s",
+            len(way_points),
+            route_id,
+            error,
         )
+        return json.dumps({"Error": "Service unavailable, retry later."}), 503
+    LOGGER.warning(
+        "Spooled %s waypoints of route_id %s: %s", len(way_points), route_id, error
+    )
+    return (
+        json.dumps(
+            {
+                "route_id": route_id,
+                "received": len(coordinates),
+                "spooled": len(way_points),
+            }
+        ),
+        202,
+    )
+
+
+def way_point_buffer_stats():
+    """
+    Returns:
+        dict: the counters of the write-behind buffer of this worker, see
+            ingest.WaypointBuffer.stats(), or None if waypoints are not
+            buffered
+    """
+    if not ingest.is_buffered():
+        return None
+    return ingest.get_buffer().stats()
 
-    conn, cur = models.execute_pgscript(
-        models.querys.UPDATE_ROUTE.format(route_id, longitude, latitude)
+
+def rejected_way_point(route_id):
+    """Tells apart the reasons a conditional waypoint insert stored nothing
+
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+
+    Returns:
+        dict, 404 response code: if the route_id does not exist in the route_lengths table
+        dict, 403 response code: if the creation time of the route_id is older than today
+    """
+    if not route_id_exists(route_id):
+        # Now would be a good time to check on the client ip address
+        return json.dumps({"Error": "route_id does not exist!"}), 404
+    LOGGER.debug("Error: You can not add more data points to this object.")
+    # The lengths of the previous day's routes are finalized by the
+    # scheduled tasks.finalize_previous_days() job, not here.
+    return (
+        json.dumps(
+            {
+                "Error": "You can not add more data points to this object."
+            }
+        ),
+        403,
     )
-    models.close_and_commit(cur, conn)
-    return json.dumps({"Ok": "Updated waypoint for route_id".format(route_id)}), 201
 
-def route_id_exists(route_id):
-    """Checks that the route_id exists in the route_lengths table
+
+def route_creation_time(route_id):
+    """Looks up the creation time of a route_id in one query
 
     Args:
         route_id (int): A route_id supplied by the user in a POST
 
     Returns:
-        bool: True if exist; false otherwise
+        datetime.datetime: the creation time, or None if route_id does not exist
     """
-    conn, cur = models.execute_pgscript(models.querys.ROUTE_ID_EXISTS.format(route_id))
-    route_id_exists = cur.fetchone()
-    models.close_and_commit(cur, conn)
-    if not route_id_exists:
-        return False
-    return True
+    return storage.get_storage().route_creation_time(route_id)
 
 
-def is_origin_time_older_than_today(route_id):
-    """A check that prevent updating waypoints for route_ids that are stale
+def route_creation_date(route_id):
+    """Looks up the creation date of a route_id, from ROUTE_META_CACHE if possible
+
+    Unknown route_ids are not cached, as they may be created at any moment.
 
     Args:
         route_id (int): A route_id supplied by the user in a POST
 
     Returns:
-        bool:
-            True if the route_id was created in a previous day,
-            False otherwise
+        str: the creation date as %Y-%m-%d, or None if route_id does not exist
+    """
+    creation_date = ROUTE_META_CACHE.get(str(route_id))
+    if creation_date is not None:
+        return creation_date
+    creation_time = route_creation_time(route_id)
+    if creation_time is None:
+        return None
+    return cache_route_creation_date(route_id, creation_time)
+
+
+def cache_route_creation_date(route_id, creation_time):
+    """Stores the creation date of route_id in ROUTE_META_CACHE until midnight
+
+    Returns:
+        str: the creation date as %Y-%m-%d
+    """
+    creation_date = creation_time.strftime("%Y-%m-%d")
+    ROUTE_META_CACHE.set(
+        str(route_id), creation_date, expires=cache.seconds_until_midnight()
+    )
+    return creation_date
+
+
+def is_cached_route_stale(route_id):
+    """A database-free check for waypoints sent to routes of a previous day
+
+    Returns:
+        bool: True if ROUTE_META_CACHE knows route_id was created before today
     """
-    conn, cur = models.execute_pgscript(
-        models.querys.CHECK_ORIGIN_TIME.format(route_id)
+    creation_date = ROUTE_META_CACHE.get(str(route_id))
+    return creation_date is not None and is_query_date_older_than_today(
+        creation_date
     )
-    creation_time = cur.fetchone()
-    models.close_and_commit(cur, conn)
-    creation_time = creation_time[0].strftime("%Y-%m-%d")
-    older_than_today = is_query_date_older_than_today(creation_time)
-    return older_than_today
 
 
+def route_id_exists(route_id):
+    """Checks that the route_id exists in the route_lengths table
+
+    Args:
+        route_id (int): A route_id supplied by the user in a POST
+
+    Returns:
+        bool: True if exist; false otherwise
+    """
+    return route_creation_date(route_id) is not None
+
 
 def get_length_of_single_route(route_id):
     """
     The Postgres server is called on to service a request for the length of
     a route.
 
+    The length is maintained incrementally as waypoints are inserted, so this
+    is a single-row lookup in the route_lengths table.
+
     Args:
         route_id (int): A route_id supplied by the user in a POST
 
     Returns:
-        length_of_route (float): length (km) of route_id
+        length_of_route (tuple): (length (km) of route_id,), or None if the
+            route_id has no waypoints
     """
-    logging.debug("Finding the length of route_id = {}".format(route_id))
-    conn, cur = models.execute_pgscript(
-        models.querys.SINGLE_ROUTE_LENGTH.format(route_id)
-    )
-    length_of_route = cur.fetchone()
-    models.close_and_commit(cur, conn)
-    return length_of_route
+    LOGGER.debug("Finding the length of route_id = %s", route_id)
+    length_of_route = storage.get_storage().route_length(route_id)
+    if length_of_route is None:
+        return None
+    return (length_of_route,)
+
+
+def stream_route_lengths(route_ids):
+    """Streams the stored lengths of many routes as one JSON document
+
+    The lengths are read with a single query for all of route_ids, and sent
+    on in chunks of ROUTE_LENGTHS_CHUNK_SIZE routes as they are read.
+    route_ids outside the INTEGER range can not exist and are not looked up.
+
+    Args:
+        route_ids (list): of distinct route_ids supplied by the user
+
+    Yields:
+        str: the next part of {"routes": [{"route_id": ..., "km": ...}, ...],
+            "unknown": [route_id, ...]}, with km null for a route without
+            waypoints, and the route_ids that do not exist in "unknown"
+    """
+    unknown = []
+    out_of_range = [
+        route_id for route_id in route_ids if not 0 <= route_id < ROUTE_ID_LIMIT
+    ]
+    route_ids = [route_id for route_id in route_ids if 0 <= route_id < ROUTE_ID_LIMIT]
+    yield '{"routes": ['
+    separator = ""
+    chunks = storage.get_storage().route_lengths(route_ids, ROUTE_LENGTHS_CHUNK_SIZE)
+    for chunk in chunks if route_ids else ():
+        known = [(route_id, km) for route_id, km, exists in chunk if exists]
+        unknown.extend(route_id for route_id, _, exists in chunk if not exists)
+        if known:
+            yield separator + ",".join(
+                json.dumps({"route_id": route_id, "km": km}) for route_id, km in known
+            )
+            separator = ","
+    yield '], "unknown": {}}}'.format(json.dumps(unknown + out_of_range))
+
+
+def verify_length_of_single_route(route_id):
+    """Compares the stored length of a route with a full scan of its waypoints
+
+    Args:
+        route_id (int): A route_id supplied by the user in a POST
+
+    Returns:
+        dict: the stored 'km', the 'recomputed_km' and their 'drift_km', or
+            None if the route_id has no waypoints
+    """
+    length_of_route = get_length_of_single_route(route_id)
+    if length_of_route is None:
+        return None
+    recomputed = storage.get_storage().full_scan_route_length(route_id)
+    return {
+        "route_id": route_id,
+        "km": length_of_route[0],
+        "recomputed_km": recomputed,
+        "drift_km": length_of_route[0] - recomputed,
+    }
+
+
+def export_way_points(route_id, export_format, tolerance=None):
+    """Streams the waypoints of a route, in timestamp order
+
+    Every chunk of WAY_POINT_EXPORT_CHUNK_SIZE waypoints read from the
+    storage backend is serialized and yielded on its own, so the first bytes
+    go out after the first chunk and memory does not grow with the route.
+    A simplified route is read whole first, see simplified_way_points().
+
+    Args:
+        route_id (int): A route_id supplied by the user in a GET
+        export_format (str): a key of WAY_POINT_EXPORT_FORMATS
+        tolerance (float): simplify the route to this many degrees, or None
+
+    Yields:
+        str: the next part of the export; geojson is a FeatureCollection of
+            Points, ndjson and csv have one timestamp, lon, lat per line
+    """
+    chunks = storage.get_storage().way_points(route_id, WAY_POINT_EXPORT_CHUNK_SIZE)
+    if tolerance is not None:
+        chunks = simplified_way_points(chunks, tolerance)
+    if export_format == "geojson":
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ""
+        for chunk in chunks:
+            yield separator + ",".join(
+                json.dumps(
+                    {
+                        "type": "Feature",
+                        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                        "properties": {"timestamp": timestamp.isoformat()},
+                    }
+                )
+                for timestamp, lon, lat in chunk
+            )
+            separator = ","
+        yield "]}"
+    elif export_format == "ndjson":
+        for chunk in chunks:
+            yield "".join(
+                json.dumps({"timestamp": timestamp.isoformat(), "lon": lon, "lat": lat})
+                + "\n"
+                for timestamp, lon, lat in chunk
+            )
+    else:
+        yield "timestamp,lon,lat\r\n"
+        for chunk in chunks:
+            text = io.StringIO()
+            csv.writer(text).writerows(
+                (timestamp.isoformat(), lon, lat) for timestamp, lon, lat in chunk
+            )
+            yield text.getvalue()
+
+
+def read_way_points(chunks):
+    """
+    Returns:
+        tuple: (timestamps, longitudes, latitudes) lists of every waypoint
+            of chunks
+    """
+    timestamps, longitudes, latitudes = [], [], []
+    for chunk in chunks:
+        for timestamp, longitude, latitude in chunk:
+            timestamps.append(timestamp)
+            longitudes.append(longitude)
+            latitudes.append(latitude)
+    return timestamps, longitudes, latitudes
+
+
+def simplified_way_points(chunks, tolerance):
+    """The waypoints of chunks that polyline.simplify() keeps
+
+    Yields:
+        list: of up to WAY_POINT_EXPORT_CHUNK_SIZE (timestamp, longitude,
+            latitude) tuples
+    """
+    timestamps, longitudes, latitudes = read_way_points(chunks)
+    kept = polyline.simplify(longitudes, latitudes, tolerance).nonzero()[0]
+    for start in range(0, len(kept), WAY_POINT_EXPORT_CHUNK_SIZE):
+        yield [
+            (timestamps[index], longitudes[index], latitudes[index])
+            for index in kept[start:start + WAY_POINT_EXPORT_CHUNK_SIZE]
+        ]
+
+
+def encode_way_points(route_id, precision, tolerance=None):
+    """The waypoints of a route as an encoded polyline
+
+    Args:
+        route_id (int): A route_id supplied by the user in a GET
+        precision (int): decimal places kept by the encoding
+        tolerance (float): simplify the route to this many degrees, or None
+
+    Returns:
+        dict: the route_id, the number of 'points' encoded and the
+            'polyline'
+    """
+    chunks = storage.get_storage().way_points(route_id, WAY_POINT_EXPORT_CHUNK_SIZE)
+    if tolerance is not None:
+        chunks = simplified_way_points(chunks, tolerance)
+    _, longitudes, latitudes = read_way_points(chunks)
+    return {
+        "route_id": route_id,
+        "points": len(longitudes),
+        "precision": precision,
+        "polyline": polyline.encode_polyline(longitudes, latitudes, precision),
+    }
 
 
 def route_id_has_waypoints(route_id):
@@ -166,74 +567,101 @@ def route_id_has_waypoints(route_id):
             False otherwise
 
     """
-    conn, cur = models.execute_pgscript(
-        models.querys.ROUTE_ID_HAS_WAYPOINTS.format(route_id)
-    )
-    route_id_exists = cur.fetchone()
-    models.close_and_commit(cur, conn)
-    if not route_id_exists:
-        return False
-    return True
+    return storage.get_storage().route_has_way_points(route_id)
+
+def query_longest_route_in_day(query_date):
+    """Looks up the longest route of a past day in the storage backend
+
+    With Postgres, the answer is precomputed by
+    tasks.finalize_previous_days(), see storage.PostgresStorage.
+
+    Args:
+        query_date (str): in the form of %Y-%m-%d, older than today
+
+    Returns:
+        tuple: (route_id, km), or None if no routes were recorded that day
+
+    Raises:
+        storage.DayNotFinalized: if tasks.finalize_previous_days() has not
+            finalized query_date yet
+    """
+    return storage.get_storage().longest_route_in_day(query_date)
+
+
+def day_not_finalized(day):
+    """
+    Args:
+        day (datetime.date): a past day that is not finalized yet
 
-def query_longest_route_in_day():
-    # TODO:
-    # We will have made this code obsolete if we can place a gaurantee
-    # that all records for past days have been calculated accurately and
-    # and stored as a result of keeping track of each day's balances.
-    # Instead, if there is a request for the longest route in the day,
-    # we can give it to them quickly from the stored result in ram, or in
-    # the database.
-    # We should have better tables
-    # We should have one table that maps from date to route id for servicing
-    # requests for the longest route of a day
-    # and one table that maps from the route_id to its length
-    # And then we have also, the route_id and their waypoints
-
-    # 1. Final_length_table
-    # |route_id||final_length|
-    # Fourth, routes are assigned a final length.
-
-    # 2. Longest_route_of_day_table
-    # |date||route_id|
-    # Third, we calculate the lengths of finalized routes.
-    # At the end of the day, some routes may still be in progress.
-    # If so, they will trigger the service to update the previous days
-    # calculations for route lengths. The server currently uses a 24 hour
-    # period / window over which to compute the sum of waypoints for routes
-    # from the previous day. This window is fixed, but we could make it a
-    # sliding window so that we are always computing the previous 24 hours
-    # for waypoints and never computing the sum of waypoints that were created
-    # more than 24 hours ago as we now are.
-
-    # 3. Waypoint_table
-    # |route_id||waypoint|
-    # Second, new routes log waypoints.
-    # We allow fresh routes to update themselves with new waypoints.
-    # Fresh routes are defined as routes that have had their IDs assigned
-    # today as defined by the server clock.
-
-    # 4. Creation_time_table
-    # |route_id||time|
-    # New routes come through here first.
-    # We respond to them by starting a record in the table.
-
-    # So those are the final tables I really need.
-    conn, cur = models.execute_pgscript(
-        models.querys.LONGEST_ROUTE_IN_DAY.format(query_date, query_date)
+    Returns:
+        dict, 503 response code, headers: with a Retry-After of the seconds
+            until the scheduled finalization has run
+    """
+    LOGGER.info("Day %s is not finalized yet", day)
+    retry_after = cache.seconds_until_midnight() + FINALIZATION_RETRY_SECONDS
+    return (
+        json.dumps({"Error": "{} is not finalized yet, retry later.".format(day)}),
+        503,
+        {"Retry-After": str(retry_after)},
     )
-    longest_route_in_a_day = cur.fetchone()
-    models.close_and_commit(cur, conn)
 
 
+def query_longest_routes(first_day, last_day, k):
+    """Looks up the k longest routes of a range of past days, and the longest
+    route of each day, in the storage backend
 
-def query_date_is_in_cache(query_date):
-    """A simple check that the query date is in the check
+    With Postgres, both are read from the final lengths stored by
+    tasks.finalize_previous_days(), see storage.PostgresStorage.
+
+    Args:
+        first_day (datetime.date): the first day of the range
+        last_day (datetime.date): the last day of the range, older than today
+        k (int): the number of routes
+
+    Returns:
+        dict: 'routes', the k longest routes, longest first, and 'days', the
+            longest route of every day of the range, null for days without
+            routes
+
+    Raises:
+        storage.DayNotFinalized: if tasks.finalize_previous_days() has not
+            finalized last_day yet
+    """
+    longest, longest_per_day = storage.get_storage().longest_routes(
+        first_day, last_day, k
+    )
+    longest_per_day = {day: (route_id, km) for day, route_id, km in longest_per_day}
+    days = []
+    for ordinal in range(first_day.toordinal(), last_day.toordinal() + 1):
+        day = datetime.date.fromordinal(ordinal)
+        route_id, km = longest_per_day.get(day, (None, None))
+        days.append({"date": day.strftime("%Y-%m-%d"), "route_id": route_id, "km": km})
+    return {
+        "from": first_day.strftime("%Y-%m-%d"),
+        "to": last_day.strftime("%Y-%m-%d"),
+        "k": k,
+        "routes": [
+            {"route_id": route_id, "date": day.strftime("%Y-%m-%d"), "km": km}
+            for route_id, day, km in longest
+        ],
+        "days": days,
+    }
+
+
+def cached_longest_route_in_day(query_date):
+    """Looks up the longest route of query_date in LONGEST_ROUTE_IN_DAY_CACHE
 
     Args:
         query_date (str): in the form of %Y-%m-%d
 
+    Returns:
+        list: [route_id, km], [] if no routes were recorded that day, or
+            None if query_date is not cached
     """
-    return query_date in LONGEST_ROUTE_IN_DAY_CACHE
+    cached = LONGEST_ROUTE_IN_DAY_CACHE.get(query_date)
+    if cached is None:
+        return None
+    return json.loads(cached)
 
 
 def update_long_route_cache(query_date, longest_route_in_a_day):
@@ -245,22 +673,30 @@ def update_long_route_cache(query_date, longest_route_in_a_day):
     Args:
         query_date (str): %Y-%m-%d format
 
-        longest_route_in_a_day (dict):
-            e.g.
-            {
-            'date' (str): val (str) - date for which the route_id is the longest,
-            'route_id': val (int) - id of route,
-            'km' (str): val (float) - length in km of route
-             }
+        longest_route_in_a_day (tuple): (route_id, km) as returned by
+            query_longest_route_in_day(), or None if no routes were
+            recorded on query_date
     """
-    LONGEST_ROUTE_IN_DAY_CACHE.update(
-        {query_date: [longest_route_in_a_day[0], longest_route_in_a_day[1]]}
+    LONGEST_ROUTE_IN_DAY_CACHE.set(
+        query_date, json.dumps(list(longest_route_in_a_day or []))
     )
 
-def yesterday():
-    return datetime.date.fromordinal(
-                datetime.date.today().toordinal()-1
-            ).strftime("%F")
+
+def warm_long_route_cache(days):
+    """Fills LONGEST_ROUTE_IN_DAY_CACHE with the most recent finalized days
+
+    Args:
+        days (int): the number of finalized days to load
+
+    Returns:
+        int: the number of days loaded
+    """
+    recent_days = storage.get_storage().recent_longest_routes(days)
+    for day, route_id, km in recent_days:
+        longest_route_in_a_day = (route_id, km) if route_id is not None else None
+        update_long_route_cache(day.strftime("%Y-%m-%d"), longest_route_in_a_day)
+    return len(recent_days)
+
 
 def is_query_date_older_than_today(query_date):
     """A check that prevents longest route querys for the current day.
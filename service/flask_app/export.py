@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""export.py exports whole days of waypoints or route lengths in bulk.
+
+The rows come straight from Postgres COPY ... TO STDOUT, as CSV or in the
+binary COPY format, see models.copy_days(). stream_days() turns the copy into
+an iterable of chunks for a streamed HTTP response (GET /export/<table>/ in
+views.py); run as a script, the copy goes to a local file.
+
+Example:
+    The waypoints of a week, from the database of docker-compose,
+
+        $ python export.py way_points 2019-09-01 --last-day 2019-09-07 \
+            --db-host localhost --output week.csv
+
+    The lengths of the routes of a day, in the binary COPY format,
+
+        $ python export.py route_lengths 2019-09-01 --format binary \
+            --db-host localhost --output lengths.bin
+
+Constants:
+    EXPORT_QUEUE_CHUNKS (int): chunks copied ahead of a slow client before
+        the copy waits for it
+
+"""
+import argparse
+import datetime
+import os
+import queue
+import sys
+import threading
+import timeit
+
+import models
+
+EXPORT_QUEUE_CHUNKS = int(os.environ.get("EXPORT_QUEUE_CHUNKS", 64))
+
+# The tables of a bulk export
+TABLES = tuple(sorted(models.COPY_TABLES))
+
+# format of a bulk export -> its content type
+CONTENT_TYPES = {"csv": "text/csv", "binary": "application/octet-stream"}
+
+
+class ExportCancelled(IOError):
+    """The consumer of stream_days() stopped before the copy was done"""
+
+
+class ChunkPipe(object):
+    """A file-like object that hands what COPY writes to another thread
+
+    write() blocks while max_chunks are waiting, so a slow client slows the
+    copy down instead of filling the memory of the worker.
+
+    Args:
+        max_chunks (int): chunks written but not read yet, at most
+
+    """
+
+    def __init__(self, max_chunks):
+        self.chunks = queue.Queue(max_chunks)
+        self.cancelled = False
+
+    def write(self, data):
+        self._put(data)
+
+    def close_writer(self):
+        self._put(None)
+
+    def _put(self, data):
+        while True:
+            if self.cancelled:
+                raise ExportCancelled("The export was cancelled by its reader")
+            try:
+                self.chunks.put(data, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+
+def stream_days(table, first_day, last_day, copy_format):
+    """Streams models.copy_days() from a background thread
+
+    Args:
+        table (str): a key of models.COPY_TABLES
+        first_day (datetime.date): the first day exported
+        last_day (datetime.date): the last day exported, inclusive
+        copy_format (str): a key of models.COPY_FORMATS
+
+    Yields:
+        bytes: the export, in the chunks Postgres sent
+    """
+    pipe = ChunkPipe(EXPORT_QUEUE_CHUNKS)
+    outcome = {}
+
+    def copy():
+        try:
+            outcome["rows"] = models.copy_days(
+                table, first_day, last_day, copy_format, pipe
+            )
+        except Exception as err:
+            outcome["error"] = err
+        try:
+            pipe.close_writer()
+        except ExportCancelled:
+            pass
+
+    copier = threading.Thread(target=copy, name="export-{}".format(table))
+    copier.daemon = True
+    copier.start()
+    try:
+        chunk = pipe.chunks.get()
+        while chunk is not None:
+            yield chunk
+            chunk = pipe.chunks.get()
+    finally:
+        pipe.cancelled = True
+    if "error" in outcome:
+        raise outcome["error"]
+
+
+def parse_day(day):
+    """
+    Returns:
+        datetime.date: of a %Y-%m-%d string
+    """
+    return datetime.datetime.strptime(day, "%Y-%m-%d").date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("first_day", type=parse_day, help="%%Y-%%m-%%d")
+    parser.add_argument(
+        "--last-day", type=parse_day, help="inclusive, first_day by default"
+    )
+    parser.add_argument("--format", choices=sorted(models.COPY_FORMATS), default="csv")
+    parser.add_argument("--output", default="-", help="a file, or - for stdout")
+    parser.add_argument("--db-host", default=models.DB_HOST)
+    args = parser.parse_args(argv)
+    models.DB_HOST = args.db_host
+
+    last_day = args.last_day or args.first_day
+    start_time = timeit.default_timer()
+    if args.output == "-":
+        rows = models.copy_days(
+            args.table, args.first_day, last_day, args.format, sys.stdout.buffer
+        )
+    else:
+        with open(args.output, "wb") as out:
+            rows = models.copy_days(
+                args.table, args.first_day, last_day, args.format, out
+            )
+    elapsed = timeit.default_timer() - start_time
+    sys.stderr.write(
+        "Exported {} rows in {:.2f} s ({:.0f} rows/sec)\n".format(
+            rows, elapsed, rows / elapsed if elapsed else 0.0
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
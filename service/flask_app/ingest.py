@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""ingest.py contains the optional write-behind buffer for waypoints.
+
+With WAYPOINT_INGEST_MODE=buffered, controller.update_route() validates a
+waypoint, stamps it and queues it here, and the request returns at once.
+A background thread per uWSGI worker writes the queue to the routes table in
+batches, whenever WAYPOINT_FLUSH_BATCH_SIZE points are waiting or
+WAYPOINT_FLUSH_INTERVAL seconds have passed. The buffer holds at most
+WAYPOINT_BUFFER_SIZE points and is flushed when the worker shuts down.
+Batches that cannot be written while the database is unavailable are moved
+to the spool of the worker (see spool.py) instead of being dropped.
+Background threads need `enable-threads = true` in app.ini.
+
+Example:
+    $ buffer = ingest.get_buffer()
+    $ buffer.put(42, time.time(), 13.404954, 52.520008)
+    True
+
+"""
+import atexit
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+import models
+import spool
+import storage
+
+LOGGER = logging.getLogger(__name__)
+
+WAYPOINT_INGEST_MODE = os.environ.get("WAYPOINT_INGEST_MODE", "sync")
+WAYPOINT_BUFFER_SIZE = int(os.environ.get("WAYPOINT_BUFFER_SIZE", 10000))
+WAYPOINT_FLUSH_BATCH_SIZE = int(os.environ.get("WAYPOINT_FLUSH_BATCH_SIZE", 500))
+WAYPOINT_FLUSH_INTERVAL = float(os.environ.get("WAYPOINT_FLUSH_INTERVAL", 0.5))
+
+_BUFFER = None
+_BUFFER_LOCK = threading.Lock()
+
+
+def is_buffered():
+    """
+    Returns:
+        bool: True if waypoints are written behind through the buffer
+    """
+    return WAYPOINT_INGEST_MODE == "buffered"
+
+
+class WaypointBuffer(object):
+    """A bounded queue of waypoints drained by a background flusher thread
+
+    Args:
+        max_size (int): points held before put() refuses new ones
+        batch_size (int): points that trigger a flush
+        flush_interval (float): seconds after which waiting points are flushed
+        write (callable): write(route_id, epochs, longitudes, latitudes),
+            stores the points of one route and returns how many were stored
+
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, write):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self._write = write
+        self._queue = queue.Queue(max_size)
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="waypoint-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, route_id, epoch, longitude, latitude):
+        """Queues a waypoint without blocking
+
+        Returns:
+            bool: False if the buffer is full (or shutting down)
+        """
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait((route_id, epoch, longitude, latitude))
+        except queue.Full:
+            self._count("rejected", 1)
+            return False
+        self._count("queued", 1)
+        return True
+
+    def _count(self, counter, amount):
+        with self._counts_lock:
+            self._counts[counter] += amount
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+
+    def _take_batch(self):
+        """Waits until batch_size points are queued or flush_interval passed"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        """Writes batch with one statement per route, in the order queued"""
+        by_route = collections.OrderedDict()
+        for route_id, epoch, longitude, latitude in batch:
+            by_route.setdefault(route_id, []).append((epoch, longitude, latitude))
+        with self._flush_lock:
+            for route_id, way_points in by_route.items():
+                epochs, longitudes, latitudes = (list(v) for v in zip(*way_points))
+                try:
+                    stored = self._write(route_id, epochs, longitudes, latitudes)
+                except models.UNAVAILABLE_ERRORS as err:
+                    if not self._spool_way_points(route_id, way_points, err):
+                        self._count("dropped", len(way_points))
+                    continue
+                except Exception:
+                    LOGGER.exception(
+                        "Dropped %s buffered waypoints of route_id %s",
+                        len(way_points),
+                        route_id,
+                    )
+                    self._count("dropped", len(way_points))
+                    continue
+                self._count("flushed", stored)
+                self._count("dropped", len(way_points) - stored)
+
+    def _spool_way_points(self, route_id, way_points, error):
+        """Keeps the points of a failed write in the spool of this worker
+
+        Returns:
+            bool: False if the spool is full and the points were dropped
+        """
+        spooled = spool.get_spool().append(
+            [(route_id,) + way_point for way_point in way_points]
+        )
+        if not spooled:
+            LOGGER.error(
+                "Dropped %s buffered waypoints of route_id %s, spool full: %s",
+                len(way_points),
+                route_id,
+                error,
+            )
+            return False
+        LOGGER.warning(
+            "Spooled %s buffered waypoints of route_id %s: %s",
+            len(way_points),
+            route_id,
+            error,
+        )
+        self._count("spooled", len(way_points))
+        return True
+
+    def flush(self):
+        """Synchronously writes every queued waypoint"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._flush(batch)
+
+    def close(self):
+        """Stops accepting points, stops the flusher and flushes what is left"""
+        self._stopping.set()
+        self._thread.join(self.flush_interval * 2)
+        self.flush()
+
+    def stats(self):
+        """
+        Returns:
+            dict: queued, flushed, spooled, dropped and rejected points, and
+                the backlog
+        """
+        with self._counts_lock:
+            stats = dict(self._counts)
+        stats["backlog"] = self._queue.qsize()
+        return stats
+
+
+def get_buffer():
+    """Returns the buffer of the current process, starting it on first use
+
+    Returns:
+        WaypointBuffer
+
+    """
+    global _BUFFER
+    current = _BUFFER
+    if current is not None and current.pid == os.getpid():
+        return current
+    with _BUFFER_LOCK:
+        if _BUFFER is None or _BUFFER.pid != os.getpid():
+            _BUFFER = WaypointBuffer(
+                WAYPOINT_BUFFER_SIZE,
+                WAYPOINT_FLUSH_BATCH_SIZE,
+                WAYPOINT_FLUSH_INTERVAL,
+                _write_way_points,
+            )
+        return _BUFFER
+
+
+def _write_way_points(route_id, epochs, longitudes, latitudes):
+    return storage.get_storage().add_way_points(
+        route_id, longitudes, latitudes, epochs, replay=True
+    )
+
+
+@atexit.register
+def close_buffer():
+    """Flushes the buffer of the current process on graceful shutdown"""
+    if _BUFFER is not None and _BUFFER.pid == os.getpid():
+        _BUFFER.close()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""lengths.py computes route lengths from raw coordinates with NumPy.
+
+It is the in-process alternative to summing ST_DistanceSphere over the
+waypoints in Postgres, selected with LENGTH_BACKEND=numpy (see models.py).
+The distance between consecutive waypoints is the haversine distance on the
+sphere ST_DistanceSphere uses, so both backends agree to floating point
+precision. The lengths of any number of routes are computed in one
+vectorized pass over the coordinates, summed per route with np.add.reduceat.
+sphere_distance_km() is the same distance for a single pair of points, for
+the backends of storage.py that extend a route one waypoint at a time.
+
+Example:
+    $ route_ids, kms = lengths.route_lengths(
+    $     [7, 7, 7, 9, 9], [13.40, 13.41, 13.42, 2.35, 2.36],
+    $     [52.52, 52.52, 52.53, 48.85, 48.86])
+
+Constants:
+    EARTH_RADIUS_M (float): the radius of the sphere of ST_DistanceSphere
+
+"""
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6370986.0
+
+
+def haversine_km(longitudes_1, latitudes_1, longitudes_2, latitudes_2):
+    """Great-circle distances between two arrays of WGS84 points
+
+    Returns:
+        numpy.ndarray: the distances in km
+    """
+    lon_1, lat_1, lon_2, lat_2 = (
+        np.radians(np.asarray(degrees, dtype=np.float64))
+        for degrees in (longitudes_1, latitudes_1, longitudes_2, latitudes_2)
+    )
+    a = (
+        np.sin((lat_2 - lat_1) / 2) ** 2
+        + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M / 1000 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def sphere_distance_km(longitude_1, latitude_1, longitude_2, latitude_2):
+    """haversine_km() of a single pair of points, without NumPy's overhead
+
+    Returns:
+        float: the great-circle distance in km between two WGS84 points
+    """
+    lon_1, lat_1, lon_2, lat_2 = map(
+        math.radians, (longitude_1, latitude_1, longitude_2, latitude_2)
+    )
+    a = (
+        math.sin((lat_2 - lat_1) / 2) ** 2
+        + math.cos(lat_1) * math.cos(lat_2) * math.sin((lon_2 - lon_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M / 1000 * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def route_lengths(route_ids, longitudes, latitudes):
+    """Lengths of the routes whose waypoints are given, one pass for all
+
+    The waypoints of a route must be contiguous and in timestamp order, as
+    returned by ORDER BY route_id, timestamp.
+
+    Args:
+        route_ids (sequence): the route_id of every waypoint
+        longitudes (sequence): of floats
+        latitudes (sequence): of floats
+
+    Returns:
+        tuple: (numpy.ndarray of route_ids, numpy.ndarray of lengths in km)
+    """
+    route_ids = np.asarray(route_ids, dtype=np.int64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    if not len(route_ids):
+        return route_ids, np.zeros(0)
+    new_route = np.empty(len(route_ids), dtype=bool)
+    new_route[0] = True
+    np.not_equal(route_ids[1:], route_ids[:-1], out=new_route[1:])
+    # km from the previous waypoint, 0 for the first waypoint of each route
+    km = np.zeros(len(route_ids))
+    km[1:] = haversine_km(
+        longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:]
+    )
+    km[new_route] = 0.0
+    starts = np.flatnonzero(new_route)
+    return route_ids[starts], np.add.reduceat(km, starts)
+
+
+def route_lengths_of_rows(rows):
+    """route_lengths() of (route_id, longitude, latitude) rows
+
+    Returns:
+        tuple: (numpy.ndarray of route_ids, numpy.ndarray of lengths in km)
+    """
+    if not rows:
+        return route_lengths([], [], [])
+    route_ids, longitudes, latitudes = zip(*rows)
+    return route_lengths(route_ids, longitudes, latitudes)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""This module drives the HTTP API with many concurrent simulated devices.
+
+Every device creates a route, streams waypoints to it (one per request, or in
+batches), polls the length of its route and now and then asks for the longest
+route of a past day. The latency and status of every request are recorded
+and reported per endpoint as throughput and p50/p95/p99 latency. With
+--output the report is also written as JSON, and two reports can be compared.
+
+Example:
+    Against the docker-compose stack,
+
+        $ python loadtest.py run --devices 200 --points 100 --output before.json
+
+    Against the Flask app in this process, without any server (use
+    STORAGE_BACKEND=memory to run without a database, too),
+
+        $ STORAGE_BACKEND=memory python loadtest.py run --flask-client
+
+    Comparing two runs,
+
+        $ python loadtest.py compare before.json after.json
+
+    Constants:
+        SERVICE_ENDPOINT (str): the default --endpoint
+
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import random
+import sys
+import timeit
+
+from benchmark import percentile, random_way_points
+
+SERVICE_ENDPOINT = "http://localhost:5000/"
+
+
+class HTTPClient(object):
+    """Requests against a running service, over one keep-alive session
+
+    Args:
+        endpoint (str): the base URL of the service, ending in /
+
+    """
+
+    def __init__(self, endpoint):
+        import requests
+
+        self.endpoint = endpoint
+        self._session = requests.Session()
+
+    def request(self, method, path, body=None):
+        """
+        Returns:
+            tuple: (status code, decoded JSON body or None)
+        """
+        response = self._session.request(method, self.endpoint + path, json=body)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+class FlaskClient(object):
+    """Requests against views.APP in this process, through its test client"""
+
+    def __init__(self):
+        import views
+
+        self._client = views.APP.test_client()
+
+    def request(self, method, path, body=None):
+        """
+        Returns:
+            tuple: (status code, decoded JSON body or None)
+        """
+        response = self._client.open("/" + path, method=method, json=body)
+        try:
+            return response.status_code, json.loads(response.get_data(as_text=True))
+        except ValueError:
+            return response.status_code, None
+
+
+class Recorder(object):
+    """Collects (endpoint, status, latency) of every request of every device"""
+
+    def __init__(self):
+        self.samples = []
+
+    def request(self, client, endpoint, method, path, body=None):
+        """Times one request of client and records it under endpoint
+
+        Returns:
+            tuple: (status code, decoded JSON body or None)
+        """
+        start_time = timeit.default_timer()
+        try:
+            status, response = client.request(method, path, body)
+        except Exception:  # connection refused, reset, timed out
+            status, response = None, None
+        self.samples.append((endpoint, status, timeit.default_timer() - start_time))
+        return status, response
+
+
+def past_date(days):
+    """
+    Returns:
+        str: a random day, %Y-%m-%d, between yesterday and days ago
+    """
+    day = datetime.date.today() - datetime.timedelta(days=random.randint(1, days))
+    return day.strftime("%Y-%m-%d")
+
+
+def simulate_device(new_client, recorder, args):
+    """One device: a new route, its waypoint stream and the queries on it"""
+    client = new_client()
+    status, response = recorder.request(client, "POST /route/", "POST", "route/")
+    if status != 201:
+        return
+    route_id = response["route_id"]
+    way_points = random_way_points(args.points)
+    for sent in range(0, args.points, args.batch_size):
+        if args.batch_size == 1:
+            recorder.request(
+                client,
+                "POST /route/<id>/way_point/",
+                "POST",
+                "route/{}/way_point/".format(route_id),
+                way_points[sent],
+            )
+        else:
+            recorder.request(
+                client,
+                "POST /route/<id>/way_points/",
+                "POST",
+                "route/{}/way_points/".format(route_id),
+                way_points[sent:sent + args.batch_size],
+            )
+        requests_sent = sent // args.batch_size + 1
+        if args.poll_every and requests_sent % args.poll_every == 0:
+            recorder.request(
+                client,
+                "GET /route/<id>/length/",
+                "GET",
+                "route/{}/length/".format(route_id),
+            )
+        if args.longest_every and requests_sent % args.longest_every == 0:
+            recorder.request(
+                client,
+                "GET /longest-route/<date>",
+                "GET",
+                "longest-route/{}".format(past_date(args.days)),
+            )
+
+
+def summarize(samples, elapsed):
+    """
+    Returns:
+        dict: endpoint -> requests, errors, throughput (requests/sec) and
+            the p50/p95/p99 latency in ms
+    """
+    by_endpoint = collections.defaultdict(list)
+    for endpoint, status, latency in samples:
+        by_endpoint[endpoint].append((latency, status))
+    summary = {}
+    for endpoint, results in sorted(by_endpoint.items()):
+        latencies = sorted(latency for latency, _ in results)
+        summary[endpoint] = {
+            "requests": len(results),
+            "errors": sum(
+                1 for _, status in results if status is None or status >= 500
+            ),
+            "throughput": len(results) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(
+        "{:<32} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+            "endpoint", "requests", "errors", "req/sec", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for endpoint, stats in summary.items():
+        print(
+            "{:<32} {:>8} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                endpoint,
+                stats["requests"],
+                stats["errors"],
+                stats["throughput"],
+                stats["p50_ms"],
+                stats["p95_ms"],
+                stats["p99_ms"],
+            )
+        )
+
+
+def run(args):
+    """Runs the devices concurrently and reports per endpoint"""
+    if args.flask_client:
+        target, new_client = "flask test client", FlaskClient
+    else:
+        target = args.endpoint
+        new_client = lambda: HTTPClient(args.endpoint)  # noqa: E731
+    recorder = Recorder()
+    start_time = timeit.default_timer()
+    with concurrent.futures.ThreadPoolExecutor(args.devices) as pool:
+        devices = [
+            pool.submit(simulate_device, new_client, recorder, args)
+            for _ in range(args.devices)
+        ]
+        for device in devices:
+            device.result()
+    elapsed = timeit.default_timer() - start_time
+    summary = summarize(recorder.samples, elapsed)
+    print(
+        "{} devices x {} waypoints against {} in {:.2f} s".format(
+            args.devices, args.points, target, elapsed
+        )
+    )
+    print_summary(summary)
+    if args.output:
+        report = {
+            "target": target,
+            "started": datetime.datetime.now().isoformat(),
+            "elapsed_s": elapsed,
+            "config": {
+                "devices": args.devices,
+                "points": args.points,
+                "batch_size": args.batch_size,
+                "poll_every": args.poll_every,
+                "longest_every": args.longest_every,
+            },
+            "endpoints": summary,
+        }
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+def compare(args):
+    """Prints the change of every endpoint's numbers from one report to another"""
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(
+        "{:<32} {:>18} {:>18} {:>18}".format(
+            "endpoint", "req/sec", "p95 ms", "p99 ms"
+        )
+    )
+    for endpoint, stats in sorted(after["endpoints"].items()):
+        old = before["endpoints"].get(endpoint)
+        if old is None:
+            continue
+        print(
+            (
+                "{:<32} {:>8.1f} -> {:>6.1f} {:>8.2f} -> {:>6.2f}"
+                " {:>8.2f} -> {:>6.2f}"
+            ).format(
+                endpoint,
+                old["throughput"],
+                stats["throughput"],
+                old["p95_ms"],
+                stats["p95_ms"],
+                old["p99_ms"],
+                stats["p99_ms"],
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="run a load test")
+    run_parser.add_argument("--endpoint", default=SERVICE_ENDPOINT)
+    run_parser.add_argument(
+        "--flask-client",
+        action="store_true",
+        help="call views.APP in this process instead of --endpoint",
+    )
+    run_parser.add_argument("--devices", type=int, default=50)
+    run_parser.add_argument("--points", type=int, default=100)
+    run_parser.add_argument(
+        "--batch-size", type=int, default=1, help="waypoints per request"
+    )
+    run_parser.add_argument(
+        "--poll-every", type=int, default=10, help="length poll every n requests"
+    )
+    run_parser.add_argument(
+        "--longest-every",
+        type=int,
+        default=25,
+        help="longest-route query every n requests",
+    )
+    run_parser.add_argument(
+        "--days", type=int, default=7, help="longest-route queries go this far back"
+    )
+    run_parser.add_argument("--output", help="write the report as JSON")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""logs.py configures logging off the request path.
+
+A request only puts its log records on an in-memory queue; a background
+thread of each process formats them and writes them to stdout. Levels are
+set per module from the environment, and DEBUG records are sampled and
+rate limited before they are queued, so debug logging on the hot endpoints
+costs little even when it is switched on.
+
+Example:
+    All modules at INFO, the controller at DEBUG with 1 in 10 debug records
+    kept and at most 50 per second,
+
+        $ LOG_LEVEL=INFO LOG_LEVELS=controller=DEBUG \
+            LOG_DEBUG_SAMPLE_RATE=0.1 LOG_DEBUG_MAX_PER_SECOND=50 \
+            uwsgi --ini app.ini
+
+Constants:
+    LOG_LEVEL (str): level of the root logger, and so of every module
+    LOG_LEVELS (str): comma separated module=LEVEL overrides of LOG_LEVEL
+    LOG_DEBUG_SAMPLE_RATE (float): fraction of DEBUG records that are kept
+    LOG_DEBUG_MAX_PER_SECOND (float): DEBUG records kept per second and
+        process, 0 for no limit
+    LOG_QUEUE_SIZE (int): records waiting for the writer before new ones
+        are dropped
+
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1.0))
+LOG_DEBUG_MAX_PER_SECOND = float(os.environ.get("LOG_DEBUG_MAX_PER_SECOND", 100))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+LOG_DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+_HANDLER = None
+_HANDLER_LOCK = threading.Lock()
+
+
+class DebugSampler(logging.Filter):
+    """Keeps a sample of the DEBUG records, and at most max_per_second
+
+    Records above DEBUG always pass.
+
+    Args:
+        sample_rate (float): the fraction of DEBUG records kept
+        max_per_second (float): the DEBUG records kept per second, 0 for
+            no limit
+
+    """
+
+    def __init__(self, sample_rate, max_per_second):
+        super(DebugSampler, self).__init__()
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self._lock = threading.Lock()
+        self._tokens = max_per_second
+        self._refilled_at = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if not self.max_per_second:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.max_per_second,
+                self._tokens + (now - self._refilled_at) * self.max_per_second,
+            )
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a QueueListener thread that writes them to stdout
+
+    Threads do not survive a fork, so a forked uWSGI worker starts a
+    listener of its own with its first record. When the queue is full the
+    record is dropped rather than blocking the request.
+
+    Args:
+        queue_size (int): records waiting for the writer before new ones
+            are dropped
+        stream: where the records are written, sys.stdout by default
+
+    """
+
+    def __init__(self, queue_size, stream=None):
+        super(BackgroundQueueHandler, self).__init__(queue.Queue(queue_size))
+        stream_handler = logging.StreamHandler(
+            sys.stdout if stream is None else stream
+        )
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        self._stream_handler = stream_handler
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = logging.handlers.QueueListener(
+                self.queue, self._stream_handler, respect_handler_level=True
+            )
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Writes the records still queued and stops the listener thread"""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+
+def module_levels(levels):
+    """Parses LOG_LEVELS
+
+    Args:
+        levels (str): e.g. "controller=DEBUG,models=WARNING"
+
+    Returns:
+        dict: logger name -> level name
+    """
+    parsed = {}
+    for override in levels.split(","):
+        if "=" in override:
+            name, level = override.split("=", 1)
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def setup_logging():
+    """Routes the records of every logger through the queue, once per process
+
+    Replaces any handler of the root logger. Calling it again is a no-op.
+
+    Returns:
+        BackgroundQueueHandler: the handler of the root logger
+    """
+    global _HANDLER
+    with _HANDLER_LOCK:
+        if _HANDLER is not None:
+            return _HANDLER
+        handler = BackgroundQueueHandler(LOG_QUEUE_SIZE)
+        handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE, LOG_DEBUG_MAX_PER_SECOND))
+        root = logging.getLogger()
+        for old_handler in list(root.handlers):
+            root.removeHandler(old_handler)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in module_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+        atexit.register(handler.stop)
+        _HANDLER = handler
+        return handler
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""metrics.py records request and query latencies for Prometheus.
+
+models.py times how long every query waits for a pooled connection
+("connect") and how long it runs ("execute"), labelled with its name in
+querys.py. views.py times every request, labelled with its route and status
+code. GET /metrics serves them in the Prometheus text format.
+
+Under uWSGI each worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR, and /metrics, whichever worker serves it, adds up
+the files of all workers. The directory is created when this module is
+imported, by any entry point; the uWSGI master also empties it on startup,
+see wsgi.py. Without PROMETHEUS_MULTIPROC_DIR, /metrics reports the current
+process only.
+
+Example:
+    $ with metrics.time_query("update_route", "execute"):
+    $     cur.execute(pgscript, params)
+
+Constants:
+    PROMETHEUS_MULTIPROC_DIR (str): the directory shared by the workers, or
+        None for a single process
+
+"""
+import contextlib
+import os
+import shutil
+import timeit
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+import querys
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Waypoint inserts take a few ms, longest-route misses and batches up to seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+QUERY_SECONDS = Histogram(
+    "gps_tracker_query_seconds",
+    "Time to check out a connection (connect) and to run a query (execute)",
+    ["query", "phase"],
+    buckets=LATENCY_BUCKETS,
+)
+QUERY_ERRORS = Counter(
+    "gps_tracker_query_errors_total", "Queries that raised an error", ["query"]
+)
+REQUEST_SECONDS = Histogram(
+    "gps_tracker_request_seconds",
+    "Time to handle a request, by route and status code",
+    ["method", "endpoint", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# SQL script -> its name in querys.py, for the scripts of execute_pgscript()
+_QUERY_NAMES = {
+    value: name.lower()
+    for name, value in vars(querys).items()
+    if name.isupper() and isinstance(value, str)
+}
+
+
+def query_name(pgscript):
+    """
+    Returns:
+        str: the lower-cased querys.py name of pgscript, or "other"
+    """
+    return _QUERY_NAMES.get(pgscript, "other")
+
+
+@contextlib.contextmanager
+def time_query(name, phase):
+    """Observes the duration of the block in QUERY_SECONDS
+
+    An error raised in the block is counted in QUERY_ERRORS and re-raised.
+
+    Args:
+        name (str): the query, a querys.STATEMENTS key or query_name()
+        phase (str): "connect" or "execute"
+    """
+    start_time = timeit.default_timer()
+    try:
+        yield
+    except Exception:
+        QUERY_ERRORS.labels(name).inc()
+        raise
+    finally:
+        QUERY_SECONDS.labels(name, phase).observe(timeit.default_timer() - start_time)
+
+
+def observe_request(method, endpoint, status, seconds):
+    REQUEST_SECONDS.labels(method, endpoint, str(status)).observe(seconds)
+
+
+def reset_multiprocess_dir():
+    """Empties PROMETHEUS_MULTIPROC_DIR of the files of previous runs
+
+    Must run in the uWSGI master, before the workers are forked.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+
+
+def exposition():
+    """
+    Returns:
+        tuple: (the metrics of all workers in the Prometheus text format,
+            its content type)
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
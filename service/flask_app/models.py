@@ -5,9 +5,16 @@ models.py is imported by the views.py Flask application.
 
 """
 
+import os
+import threading
+import weakref
+
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
+import lengths
+import metrics
+import pool
 import querys
 
 PERSISTENCE_PROVIDER = "postgres"
@@ -17,6 +24,40 @@ DB_USER = "postgres"
 DB_PASS = "password"
 DB_NAME = "gps_tracker_service"
 
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 4))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5.0))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(
+    os.environ.get("DB_POOL_HEALTH_CHECK_INTERVAL", 30.0)
+)
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 2))
+
+# Where recomputed route lengths are summed: "postgis" (ST_DistanceSphere in
+# the database) or "numpy" (lengths.py, in this process)
+LENGTH_BACKEND = os.environ.get("LENGTH_BACKEND", "postgis")
+
+# Raised while the database is down, restarting or out of connections
+UNAVAILABLE_ERRORS = (
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    pool.PoolError,
+)
+
+# table of a bulk export -> its COPY script
+COPY_TABLES = {
+    "way_points": querys.COPY_DAYS_WAY_POINTS,
+    "route_lengths": querys.COPY_DAYS_ROUTE_LENGTHS,
+}
+
+# format of a bulk export -> its COPY options
+COPY_FORMATS = {"csv": "FORMAT csv, HEADER", "binary": "FORMAT binary"}
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# connection -> names of the querys.STATEMENTS prepared on it
+_PREPARED = weakref.WeakKeyDictionary()
+
 
 def create_new_database():
     """
@@ -98,11 +139,288 @@ def bootstrap_tables():
     close_and_commit(cur, conn)
 
 
-def execute_pgscript(pgscript):
+def init_pool():
+    """Creates the connection pool for the current process
+
+    Called from the uWSGI postfork hook in wsgi.py, so every worker opens its
+    own DB_POOL_MIN connections after the fork instead of sharing sockets
+    with the master. A pool inherited from a parent process is dropped
+    without closing its connections, which still belong to the parent.
+
+    Returns:
+        pool.ConnectionPool: the pool owned by this process
+
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.closed or _POOL.pid != os.getpid():
+            _POOL = pool.ConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                timeout=DB_POOL_TIMEOUT,
+                health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+                host=DB_HOST,
+                port=DB_PORT,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASS,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+            )
+        return _POOL
+
+
+def get_pool():
+    """Returns the connection pool of the current process, creating it lazily
+
+    Returns:
+        pool.ConnectionPool: the pool owned by this process
+
+    """
+    current = _POOL
+    if current is None or current.closed or current.pid != os.getpid():
+        return init_pool()
+    return current
+
+
+def close_pool():
+    """Closes the idle connections of the current process's pool"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL.pid == os.getpid():
+            _POOL.closeall()
+        _POOL = None
+
+
+def migrate_db():
+    """Applies the querys.MIGRATIONS that are missing from schema_migrations
+
+    Every migration runs in its own transaction together with the row that
+    records it, under a table lock, so concurrent calls apply each migration
+    exactly once.
+
+    Returns:
+        list: the versions applied by this call
+
+    """
+    conn, cur = execute_pgscript(querys.CREATE_SCHEMA_MIGRATIONS_TABLE)
+    close_and_commit(cur, conn)
+    applied = []
+    for version, pgscript in querys.MIGRATIONS:
+        conn, cur = execute_pgscript(querys.LOCK_SCHEMA_MIGRATIONS)
+        try:
+            cur.execute(querys.MIGRATION_APPLIED, (version,))
+            if cur.fetchone() is None:
+                cur.execute(pgscript)
+                cur.execute(querys.RECORD_MIGRATION, (version,))
+                applied.append(version)
+        except psycopg2.Error:
+            conn.rollback()
+            release_connection(conn)
+            raise
+        close_and_commit(cur, conn)
+    return applied
+
+
+def insert_way_points(route_id, longitudes, latitudes, epochs=None, replay=False):
+    """Inserts a batch of waypoints of one route with a single statement
+
+    Only the points that fall on the day the route was created are stored,
+    and the stored route_length is updated in the same statement. Unless the
+    batch is replayed, the route must have been created today; a replayed
+    batch is dropped once the day of the route is finalized.
+
+    Args:
+        route_id (int): the route the waypoints belong to
+        longitudes (list): of floats
+        latitudes (list): of floats
+        epochs (list): the unix timestamps of the points, or None to have
+            the server stamp them in the order given
+        replay (bool): the batch comes from the buffer or the spool, which
+            write behind to the routes of earlier days
+
+    Returns:
+        int: the number of waypoints stored, 0 if none were
+
+    """
+    conn, cur = execute_statement(
+        "replay_route_batch" if replay else "update_route_batch",
+        (route_id, epochs, longitudes, latitudes),
+    )
+    inserted = cur.fetchone()
+    close_and_commit(cur, conn)
+    return inserted[0] if inserted else 0
+
+
+def recompute_route_lengths(route_ids):
+    """Rebuilds the stored lengths of route_ids from a full scan of waypoints
+
+    The lengths are summed by the LENGTH_BACKEND.
+
+    Args:
+        route_ids (list): the route_ids to recompute
+
+    Returns:
+        int: the number of route_lengths rows updated
+
+    """
+    if LENGTH_BACKEND == "numpy":
+        conn, cur = execute_pgscript(
+            querys.ROUTE_COORDINATES, {"route_ids": list(route_ids)}
+        )
+        try:
+            updated = store_computed_lengths(cur)
+        except Exception:
+            release_connection(conn)
+            raise
+    else:
+        conn, cur = execute_pgscript(
+            querys.RECOMPUTE_ROUTE_LENGTHS, {"route_ids": list(route_ids)}
+        )
+        updated = cur.rowcount
+    close_and_commit(cur, conn)
+    return updated
+
+
+def store_computed_lengths(cur):
+    """Sums the coordinates cur just selected with lengths.py and stores them
+
+    Args:
+        cur: a cursor that executed querys.ROUTE_COORDINATES or
+            querys.DAYS_COORDINATES
+
+    Returns:
+        int: the number of route_lengths rows updated
+
+    """
+    route_ids, kms = lengths.route_lengths_of_rows(cur.fetchall())
+    cur.execute(querys.STORE_ROUTE_LENGTHS, (route_ids.tolist(), kms.tolist()))
+    return cur.rowcount
+
+
+def finalize_days(wait=False):
+    """Finalizes every past day that has not been finalized yet
+
+    Recomputes the lengths of the routes created on those days from their
+    waypoints with the LENGTH_BACKEND, marks them final and stores the
+    longest route of each day in longest_route_per_day. Runs in one
+    transaction under an advisory lock, so only one worker finalizes at a
+    time.
+
+    Args:
+        wait (bool): wait for a finalization running elsewhere to finish,
+            instead of returning at once
+
+    Returns:
+        tuple: the (first_day, last_day) finalized, or None if there was
+            nothing to finalize or another worker holds the lock
+
+    """
+    lock = querys.LOCK_FINALIZATION if wait else querys.TRY_LOCK_FINALIZATION
+    conn, cur = execute_pgscript(lock)
+    try:
+        finalized = None
+        if wait or cur.fetchone()[0]:
+            cur.execute(querys.PENDING_FINALIZATION_DAYS)
+            first_day, last_day = cur.fetchone()
+            if first_day is not None and first_day <= last_day:
+                days = {"first_day": first_day, "last_day": last_day}
+                if LENGTH_BACKEND == "numpy":
+                    cur.execute(querys.DAYS_COORDINATES, days)
+                    store_computed_lengths(cur)
+                else:
+                    cur.execute(querys.FINALIZE_ROUTE_LENGTHS, days)
+                cur.execute(querys.FINALIZE_DAYS, days)
+                finalized = (first_day, last_day)
+    except Exception:
+        conn.rollback()
+        release_connection(conn)
+        raise
+    close_and_commit(cur, conn)
+    return finalized
+
+
+def compact_days():
+    """Compacts the routes of every finalized day that is not compacted yet
+
+    The waypoints of each route are folded into a single LineString row of
+    compact_routes, with their timestamps as M values, and deleted from
+    routes. Runs in one transaction under the finalization advisory lock,
+    and returns at once if another worker holds it.
+
+    Returns:
+        tuple: the (first_day, last_day) compacted, or None if there was
+            nothing to compact or another worker holds the lock
+
+    """
+    conn, cur = execute_pgscript(querys.TRY_LOCK_FINALIZATION)
+    try:
+        compacted = None
+        if cur.fetchone()[0]:
+            cur.execute(querys.PENDING_COMPACTION_DAYS)
+            first_day, last_day = cur.fetchone()
+            if first_day is not None:
+                cur.execute(
+                    querys.COMPACT_DAYS, {"first_day": first_day, "last_day": last_day}
+                )
+                compacted = (first_day, last_day)
+    except Exception:
+        conn.rollback()
+        release_connection(conn)
+        raise
+    close_and_commit(cur, conn)
+    return compacted
+
+
+def create_route_partitions(days_ahead):
+    """Creates the daily partitions of the routes table ahead of time
+
+    Args:
+        days_ahead (int): partitions are created for today and this many
+            following days, if they do not exist yet
+
+    Returns:
+        list: the names of the partitions created by this call
+
+    """
+    conn, cur = execute_pgscript(querys.CREATE_ROUTES_PARTITIONS, (days_ahead,))
+    created = [row[0] for row in cur.fetchall() if row[0]]
+    close_and_commit(cur, conn)
+    return created
+
+
+def detach_route_partitions(before, drop=False):
+    """Detaches the daily partitions of the routes table older than before
+
+    Their waypoints no longer count towards the length queries. The stored
+    lengths in route_lengths are kept.
+
+    Args:
+        before (datetime.date): partitions of earlier days are detached
+        drop (bool): also drop the detached partitions
+
+    Returns:
+        list: the names of the detached partitions
+
+    """
+    conn, cur = execute_pgscript(querys.DETACH_ROUTES_PARTITIONS, (before, drop))
+    detached = [row[0] for row in cur.fetchall()]
+    close_and_commit(cur, conn)
+    return detached
+
+
+def execute_pgscript(pgscript, params=None):
     """General method for querying the database DB_NAME with the supplied pgscript
 
+    The connection is checked out of the per-process pool and must be handed
+    back with close_and_commit(). If the script fails, the connection is
+    rolled back and returned to the pool before the error is re-raised.
+    The checkout and the query are timed in metrics.py under the name of
+    pgscript in querys.py.
+
     Args:
         pgscript (str): a postgres SQL script from the querys.py module
+        params (tuple): optional parameters bound to the %s placeholders
+            of pgscript by psycopg2
 
     Returns:
         tuple (conn, cur)
@@ -111,14 +429,160 @@ def execute_pgscript(pgscript):
             cur is the cursor used to retrieve results from the query
 
     """
-    conn = psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASS
-    )
-    cur = conn.cursor()
-    cur.execute(pgscript)
+    name = metrics.query_name(pgscript)
+    db_pool = get_pool()
+    with metrics.time_query(name, "connect"):
+        conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        with metrics.time_query(name, "execute"):
+            cur.execute(pgscript, params)
+    except Exception:
+        db_pool.putconn(conn, close=conn.closed != 0)
+        raise
+    return conn, cur
+
+
+def stream_pgscript(pgscript, params=None, chunk_size=1000):
+    """Yields the rows of pgscript in chunks, from a named server-side cursor
+
+    Only chunk_size rows are held in memory at a time, however many the
+    script returns. The connection stays checked out of the pool until the
+    generator is exhausted or closed, e.g. by the WSGI server once a
+    streamed response is sent or the client has gone away.
+
+    Args:
+        pgscript (str): a postgres SQL script from the querys.py module
+        params (tuple): optional parameters bound to the %s placeholders
+        chunk_size (int): rows fetched from the server per round trip
+
+    Yields:
+        list: of up to chunk_size row tuples
+
+    """
+    name = metrics.query_name(pgscript)
+    db_pool = get_pool()
+    with metrics.time_query(name, "connect"):
+        conn = db_pool.getconn()
+    try:
+        cur = conn.cursor(name="stream_{}".format(name))
+        cur.itersize = chunk_size
+        with metrics.time_query(name, "execute"):
+            cur.execute(pgscript, params)
+            rows = cur.fetchmany(chunk_size)
+        while rows:
+            yield rows
+            rows = cur.fetchmany(chunk_size)
+        cur.close()
+        conn.commit()
+    except BaseException:
+        # GeneratorExit included: the consumer stopped before the last row
+        if conn.closed == 0:
+            conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+
+def copy_days(table, first_day, last_day, copy_format, out):
+    """Copies the rows of table for a range of days into out with COPY TO STDOUT
+
+    Postgres streams the rows in its COPY format and psycopg2 hands the data
+    to out.write() as it arrives, so no rows are materialized in Python.
+
+    Args:
+        table (str): a key of COPY_TABLES
+        first_day (datetime.date): the first day exported
+        last_day (datetime.date): the last day exported, inclusive
+        copy_format (str): a key of COPY_FORMATS
+        out: a binary file-like object with a write() method
+
+    Returns:
+        int: the number of rows copied
+
+    """
+    pgscript = COPY_TABLES[table]
+    name = metrics.query_name(pgscript)
+    db_pool = get_pool()
+    with metrics.time_query(name, "connect"):
+        conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        copy_script = cur.mogrify(
+            pgscript.format(options=COPY_FORMATS[copy_format]),
+            {"first_day": first_day, "last_day": last_day},
+        ).decode("utf-8")
+        with metrics.time_query(name, "execute"):
+            cur.copy_expert(copy_script, out)
+        copied = cur.rowcount
+    except Exception:
+        if conn.closed == 0:
+            conn.rollback()
+        release_connection(conn)
+        raise
+    close_and_commit(cur, conn)
+    return copied
+
+
+def execute_statement(name, params=()):
+    """Executes the statement querys.STATEMENTS[name] with bound parameters
+
+    The statement is prepared the first time it runs on a pooled connection
+    and executed by name from then on, so Postgres parses and plans it once
+    per connection. Like execute_pgscript(), the connection must be handed
+    back with close_and_commit(), and the checkout and the query are timed
+    in metrics.py, under name.
+
+    Args:
+        name (str): a key of querys.STATEMENTS
+        params (tuple): the values of the $1, $2, ... parameters
+
+    Returns:
+        tuple (conn, cur)
+            WHERE
+            conn is the connection used to connect to the db DB_NAME
+            cur is the cursor used to retrieve results from the query
+
+    """
+    db_pool = get_pool()
+    with metrics.time_query(name, "connect"):
+        conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        with metrics.time_query(name, "execute"):
+            prepared = _PREPARED.setdefault(conn, set())
+            if name not in prepared:
+                cur.execute(prepare_statement(name))
+                prepared.add(name)
+            cur.execute(execute_prepared(name, len(params)), params)
+    except Exception:
+        db_pool.putconn(conn, close=conn.closed != 0)
+        raise
     return conn, cur
 
 
+def prepare_statement(name):
+    """
+    Returns:
+        str: the PREPARE script of querys.STATEMENTS[name]
+    """
+    types, pgscript = querys.STATEMENTS[name]
+    if not types:
+        return "PREPARE {} AS {}".format(name, pgscript)
+    return "PREPARE {} ({}) AS {}".format(name, ", ".join(types), pgscript)
+
+
+def execute_prepared(name, param_count):
+    """
+    Returns:
+        str: the EXECUTE script of a prepared statement, with psycopg2
+            placeholders for its param_count parameters
+    """
+    if not param_count:
+        return "EXECUTE {};".format(name)
+    return "EXECUTE {} ({});".format(name, ", ".join(["%s"] * param_count))
+
+
 def db_exists(db_name):
     """Checks that the db db_name exists in the public schemas of PERSISTENCE_PROVIDER
 
@@ -165,7 +629,6 @@ def table_exists(table_name):
         conn, cur = execute_pgscript(querys.TABLE_EXISTS.format(table_name))
         exists = cur.fetchone()[0]
     except psycopg2.Error as err:
-        close_and_commit(cur, conn)
         return err
     close_and_commit(cur, conn)
     return exists
@@ -193,6 +656,7 @@ def drop_database():
         bool: True for success
 
     """
+    close_pool()
     conn = psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
@@ -208,17 +672,34 @@ def drop_database():
 
 
 def close_and_commit(cur, conn):
-    """Closes the cursor and connection used to query a db,
-    also commits the transaction.
+    """Closes the cursor, commits the transaction and releases the connection.
+
+    Pooled connections go back to the pool of the current process; the
+    direct maintenance connections (e.g. create_new_database) are closed.
 
     Args:
         cur (int): the connection used to connect to the db DB_NAME
         conn (str): the cursor used to retrieve results from the query
 
     """
-    cur.close()
-    conn.commit()
-    conn.close()
+    try:
+        cur.close()
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+
+def release_connection(conn):
+    """Hands conn back to the pool, closing it if it was not pooled
+
+    Args:
+        conn: a psycopg2 connection
+
+    """
+    if _POOL is not None and _POOL.pid == os.getpid():
+        _POOL.putconn(conn, close=conn.closed != 0)
+    else:
+        conn.close()
 
 
 def initialize_db():
@@ -228,9 +709,11 @@ def initialize_db():
     exist, the function creates it and activates the postgis extension. Next,
     it checks for the existence of the tables, routes and route_lengths, and
     creates them if they do not exist, adding a Geometry type column to the
-    routes table. Finally, it bootstraps both tables by adding route_id 0
+    routes table. It then bootstraps both tables by adding route_id 0
     to the routes_lengths table with a date in the far past, and two way points
-    for the route_id 0 in the routes table.
+    for the route_id 0 in the routes table. Finally, it applies the schema
+    migrations, which also upgrades databases created by earlier versions,
+    and creates the routes partitions of the coming week.
 
     Returns:
         bool: True for success.
@@ -248,4 +731,6 @@ def initialize_db():
     if not exists:
         create_route_length_table()
         bootstrap_tables()
+    migrate_db()
+    create_route_partitions(7)
     return True
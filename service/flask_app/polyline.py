@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""polyline.py shrinks routes for clients that only draw them, with NumPy.
+
+encode_polyline() writes coordinates in the encoded polyline format of the
+Google Maps APIs: every coordinate is stored as the difference to the
+previous one, rounded to a number of decimal places and packed in 5 bit
+groups of printable characters, about 6 bytes per point instead of ~40 for
+JSON; decode_polyline() reads it back. simplify() drops the points a route
+can lose without moving further than a tolerance from its original path
+(Douglas-Peucker, like ST_Simplify). Both work on whole arrays at once
+rather than point by point.
+
+Example:
+    $ polyline.encode_polyline([-120.2, -120.95, -126.453], [38.5, 40.7, 43.252])
+    '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    $ polyline.decode_polyline(b'_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+    (array([-120.2  , -120.95 , -126.453]), array([38.5  , 40.7  , 43.252]))
+    $ keep = polyline.simplify(longitudes, latitudes, 0.0001)
+
+"""
+import numpy as np
+
+
+def encode_polyline(longitudes, latitudes, precision=5):
+    """Encodes a path as an encoded polyline
+
+    Args:
+        longitudes (sequence): of floats
+        latitudes (sequence): of floats
+        precision (int): decimal places kept, 5 for the Google Maps APIs
+
+    Returns:
+        str: the encoded polyline, latitude first in every point
+    """
+    factor = 10 ** precision
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    if not len(longitudes):
+        return ""
+    coordinates = np.empty(2 * len(longitudes), dtype=np.int64)
+    coordinates[0::2] = np.round(latitudes * factor)
+    coordinates[1::2] = np.round(longitudes * factor)
+    deltas = coordinates.copy()
+    deltas[2:] -= coordinates[:-2]
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # every value is written as 5 bit groups, least significant first, with
+    # 0x20 set on every group but the last and 63 added to each
+    group_count = max(1, (int(values.max()).bit_length() + 4) // 5)
+    shifts = 5 * np.arange(group_count)
+    groups = (values[:, None] >> shifts) & 0x1F
+    lengths = np.maximum(1, np.sum((values[:, None] >> shifts) > 0, axis=1))
+    position = np.arange(group_count)
+    groups |= np.where(position < lengths[:, None] - 1, 0x20, 0)
+    characters = (groups + 63)[position < lengths[:, None]]
+    return characters.astype(np.uint8).tobytes().decode("ascii")
+
+
+def decode_polyline(encoded, precision=5):
+    """Decodes an encoded polyline, without a Python loop over its characters
+
+    Args:
+        encoded (bytes): the encoded polyline, as ASCII bytes
+        precision (int): decimal places it was encoded with
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: the longitudes and the latitudes
+
+    Raises:
+        ValueError: if encoded is not a well formed polyline
+    """
+    characters = np.frombuffer(encoded, dtype=np.uint8)
+    if not len(characters):
+        return np.empty(0), np.empty(0)
+    if characters.min() < 63 or characters.max() > 126:
+        raise ValueError("An encoded polyline only has characters ? to ~.")
+    groups = characters.astype(np.int64) - 63
+    last = (groups & 0x20) == 0
+    if not last[-1]:
+        raise ValueError("The encoded polyline is truncated.")
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    value_index = np.cumsum(np.concatenate(([0], last[:-1])))
+    position = np.arange(len(groups)) - starts[value_index]
+    if position.max() > 11:
+        raise ValueError("The encoded polyline has a value out of range.")
+    values = np.bitwise_or.reduceat((groups & 0x1F) << (5 * position), starts)
+    if len(values) % 2:
+        raise ValueError("The encoded polyline has a latitude without longitude.")
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    coordinates = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10.0 ** precision
+    return coordinates[:, 1], coordinates[:, 0]
+
+
+def simplify(longitudes, latitudes, tolerance):
+    """Douglas-Peucker simplification of a path, in the units of its coordinates
+
+    Every point of the path is within tolerance of the simplified path. The
+    first and last points are always kept. Each split of the path measures
+    the distances of all of its points in one vectorized pass.
+
+    Args:
+        longitudes (sequence): of floats
+        latitudes (sequence): of floats
+        tolerance (float): in degrees, like ST_Simplify on SRID 4326
+
+    Returns:
+        numpy.ndarray: a boolean mask of the points kept
+    """
+    x = np.asarray(longitudes, dtype=np.float64)
+    y = np.asarray(latitudes, dtype=np.float64)
+    keep = np.zeros(len(x), dtype=bool)
+    if len(x) < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+    segments = [(0, len(x) - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        squared_length = dx * dx + dy * dy
+        if squared_length == 0:
+            distances = np.hypot(px, py)
+        else:
+            # the distance to the segment, not to its line, so that paths
+            # that double back on themselves keep their turning points
+            along = np.clip((px * dx + py * dy) / squared_length, 0.0, 1.0)
+            distances = np.hypot(px - along * dx, py - along * dy)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            segments.append((start, split))
+            segments.append((split, end))
+    return keep
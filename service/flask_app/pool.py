@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""pool.py contains the psycopg2 connection pool used by models.py.
+
+Each uWSGI worker owns exactly one ConnectionPool. The pool remembers the pid
+of the process that created it, so a pool inherited across a fork is never
+used (or closed) by the child; models.get_pool() simply builds a new one.
+
+Example:
+    $ pool = ConnectionPool(1, 4, timeout=5.0, host="db", dbname="postgres")
+    $ conn = pool.getconn()
+    $ pool.putconn(conn)
+
+"""
+import collections
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeoutError(PoolError):
+    """Raised when no connection could be checked out within the timeout"""
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of psycopg2 connections
+
+    Args:
+        minconn (int): connections opened up front and kept idle
+        maxconn (int): upper bound on connections checked out at once
+        timeout (float): seconds getconn() waits for a free connection
+        health_check_interval (float): idle connections older than this
+            (seconds) are probed with a `SELECT 1` before being handed out
+        **connect_kwargs: passed through to psycopg2.connect()
+
+    """
+
+    def __init__(
+        self, minconn, maxconn, timeout=5.0, health_check_interval=30.0,
+        **connect_kwargs
+    ):
+        if not 0 <= minconn <= maxconn or maxconn < 1:
+            raise PoolError("expected 0 <= minconn <= maxconn and maxconn >= 1")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+        self._connect_kwargs = connect_kwargs
+        self._idle = collections.deque()
+        self._checked_out = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.closed = False
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _is_healthy(self, conn, idle_since):
+        """Checks an idle connection before it is handed out
+
+        Returns:
+            bool: True if the connection can be reused, False otherwise
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """Checks out a connection, waiting at most self.timeout seconds
+
+        Returns:
+            conn: a psycopg2 connection that must be returned with putconn()
+
+        Raises:
+            PoolTimeoutError: if every connection stayed checked out
+            psycopg2.Error: if a new connection could not be opened
+        """
+        if self.closed:
+            raise PoolError("connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError(
+                "no connection available after {}s".format(self.timeout)
+            )
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    idle = self._idle.popleft() if self._idle else None
+                if idle is None:
+                    conn = self._connect()
+                elif self._is_healthy(*idle):
+                    conn = idle[0]
+                else:
+                    _close_quietly(idle[0])
+            with self._lock:
+                self._checked_out.add(id(conn))
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool
+
+        Connections that were not checked out of this pool (e.g. the direct
+        maintenance connections in models.py) are simply closed.
+
+        Args:
+            conn: the psycopg2 connection to return
+            close (bool): close the connection instead of keeping it idle
+        """
+        with self._lock:
+            owned = id(conn) in self._checked_out
+            self._checked_out.discard(id(conn))
+        if not owned:
+            _close_quietly(conn)
+            return
+        try:
+            if not (close or conn.closed or self.closed):
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            if close or conn.closed or self.closed:
+                _close_quietly(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            _close_quietly(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts"""
+        self.closed = True
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
@@ -3,13 +3,15 @@
 
 This module provides scripts for querying the service's postgres sql database.
 All member variables are strings. Some member variables require formatting by
-the calling function from models.py
+the calling function from models.py. The statements of the request paths take
+$n parameters instead; they are listed in STATEMENTS and executed with
+models.execute_statement(), which prepares each once per pooled connection.
 
 Example:
     $ import querys
     $ querys.CREATE_DB.format('gps_tracker_service')
     $ querys.ADD_POSTGIS_TO_DB
-    $ querys.UPDATE_ROUTE_LENGTH.format(0, 1234.5678)
+    $ models.execute_statement("update_route", (42, 13.404954, 52.520008))
 
 Attributes:
     CREATE_DB (str): format with the database name
@@ -23,21 +25,107 @@ Attributes:
     ADD_GEOM_COLUMN_TO_TABLE (str): format with the table name, requires postgis
         is activated by ADD_POSTGIS_TO_DB script.
     CREATE_ROUTE_LEN_TABLE (str): no format required, specific for the service
-    GET_NEW_ROUTE_ID (str): no format required, specific for the service
-        route_lengths table
-    START_NEW_ROUTE (str): format with the new route_id
-    ROUTE_ID_EXISTS (str): format with the route_id to check if exists
-    ROUTE_ID_HAS_WAYPOINTS (str): format with the route_id to check if it has waypoints
-    UPDATE_ROUTE (str): format with (route_id, longitude, latitude)
-    SELECT_ALL (str): format with the table name
-    SINGLE_ROUTE_LENGTH (str): format with the route_id to query for its length
-    UPDATE_ROUTE_LENGTH (str): format with the (route_length, route_id)
-    UPDATE_ALL_ROUTES_IN_DAY_LENGTH (str): format with a string "%Y-%m-%d"
-    LONGEST_ROUTE_IN_DAY (str): format with the a string "%Y-%m-%d"
-    CHECK_ORIGIN_TIME (str): format with a route_id
+    START_NEW_ROUTE (str): no format required, allocates the next route_id
+        from the route_lengths sequence and returns (route_id, creation_time)
+    ROUTE_ID_EXISTS (str): $1 route_id, to check if exists, only compared
+        before and after migrate_db() by benchmark.py
+    ROUTE_ID_HAS_WAYPOINTS (str): $1 route_id, to check if it has waypoints,
+        in routes or compacted
+    UPDATE_ROUTE (str): $1 route_id, $2 longitude, $3 latitude, inserts
+        only if the route was created today, adds the new segment to the
+        stored route_length, or recomputes it if the route has a later
+        point, and returns the route_id, or no row if rejected
+    UPDATE_ROUTE_BATCH (str): $1 route_id, $2 epochs [float or None, ...]
+        or None, $3 longitudes [float, ...], $4 latitudes [float, ...],
+        inserts only if the route was created today the points that fall on
+        that day (server time if epochs is None) and are not stored yet, adds
+        the new segments to the stored route_length and returns the inserted
+        count, or no row if nothing was inserted
+    REPLAY_ROUTE_BATCH (str): the parameters of UPDATE_ROUTE_BATCH, for the
+        buffer and the spool only, which replay points of earlier days, so
+        the route may have been created before today, as long as its day is
+        not finalized
+    SINGLE_ROUTE_LENGTH (str): $1 route_id, to query for its length with a
+        full scan of its waypoints, or of its compacted LineString
+    STORED_ROUTE_LENGTH (str): $1 route_id, to query for its incrementally
+        maintained length
+    STORED_ROUTE_LENGTHS (str): execute with the parameters
+        {'route_ids': [int, ...]}, returns (route_id, km, known) of every
+        route_id in the order given, km NULL without waypoints and known
+        false for route_ids that do not exist
+    RECOMPUTE_ROUTE_LENGTHS (str): execute with the parameters
+        {'route_ids': [int, ...]} to rebuild the stored lengths from a full
+        scan of the routes and compact_routes tables
+    ROUTE_COORDINATES (str): execute with the parameters
+        {'route_ids': [int, ...]}, returns (route_id, longitude, latitude)
+        ordered by route and time, of the routes and compact_routes tables
+    DAYS_COORDINATES (str): execute with the parameters
+        {'first_day': date, 'last_day': date}, returns (route_id, longitude,
+        latitude) of those days ordered by route and time, compacted or not
+    ROUTE_WAY_POINTS (str): execute with the parameters {'route_id': int},
+        returns (timestamp, longitude, latitude) in timestamp order, of the
+        routes and compact_routes tables
+    COPY_DAYS_WAY_POINTS (str): format with the COPY options, then bind
+        {'first_day': date, 'last_day': date}, copies (route_id, timestamp,
+        lon, lat) of the waypoints of those days to STDOUT
+    COPY_DAYS_ROUTE_LENGTHS (str): like COPY_DAYS_WAY_POINTS, copies
+        (route_id, creation_time, km, finalized) of the routes of those days
+    STORE_ROUTE_LENGTHS (str): execute with the parameters
+        ([route_id, ...], [km, ...]) to store lengths computed by lengths.py
+    LONGEST_ROUTE_IN_DAY (str): $1 day, reads a single routes partition,
+        only compared before and after migrate_db() by benchmark.py
+    LONGEST_ROUTE_OF_FINALIZED_DAY (str): $1 day, returns (route_id, km) of
+        a finalized day, NULLs for a day without routes and no row if the
+        day is not finalized yet
+    LAST_FINALIZED_DAY (str): no parameters, returns the last finalized day,
+        NULL before the first finalization
+    RECENT_LONGEST_ROUTES (str): $1 number of days, returns
+        (day, route_id, km) of the most recent finalized days
+    LONGEST_ROUTES_IN_DAYS (str): $1 first day, $2 last day, $3 k, returns
+        (route_id, day, km) of the k longest finalized routes of those days
+    LONGEST_ROUTE_OF_FINALIZED_DAYS (str): $1 first day, $2 last day,
+        returns (day, route_id, km) of the finalized days among them, in
+        order, with NULLs for days without routes
+    LOCK_FINALIZATION (str): no format required, waits for the finalization
+        advisory lock
+    TRY_LOCK_FINALIZATION (str): no format required, returns whether the
+        finalization advisory lock was taken
+    PENDING_FINALIZATION_DAYS (str): no format required, returns the
+        (first_day, last_day) still to be finalized
+    FINALIZE_ROUTE_LENGTHS (str): execute with the parameters
+        {'first_day': date, 'last_day': date}, recomputes the lengths of the
+        routes created on those days with PostGIS
+    FINALIZE_DAYS (str): execute with the parameters
+        {'first_day': date, 'last_day': date}, marks the routes final and
+        stores the longest route of each day
+    CHECK_ORIGIN_TIME (str): $1 route_id
     ADD_TRANSACTION_ROW_1 (str): no format required, specific for the service
     ADD_TRANSACTION_ROW_0 (str): no format required, specific for the service
     ADD_TRANSACTION_ROW_2 (str): no format required, specific for the service
+    CREATE_SCHEMA_MIGRATIONS_TABLE (str): no format required
+    LOCK_SCHEMA_MIGRATIONS (str): no format required, serializes migrations
+    MIGRATION_APPLIED (str): execute with the parameter (version,)
+    RECORD_MIGRATION (str): execute with the parameter (version,)
+    CREATE_COMPACT_ROUTES_TABLE (str): no format required, creates
+        compact_routes, which the route queries read besides routes
+    ADD_ROUTE_COMPACTION (str): no format required, creates compact_routes
+        and marks the compacted days in longest_route_per_day
+    ADD_LONGEST_ROUTES_INDEX (str): no format required, indexes the final
+        lengths of every day for LONGEST_ROUTES_IN_DAYS
+    MIGRATIONS (tuple): (version, script) pairs applied in order by
+        models.migrate_db()
+    CREATE_ROUTES_PARTITIONS (str): execute with the parameter (days_ahead,)
+        to create the daily routes partitions from today on
+    DETACH_ROUTES_PARTITIONS (str): execute with the parameters
+        (before_date, drop) to detach (and drop) the partitions of older days
+    PENDING_COMPACTION_DAYS (str): no format required, returns the
+        (first_day, last_day) finalized but not compacted yet
+    COMPACT_DAYS (str): execute with the parameters
+        {'first_day': date, 'last_day': date}, folds the waypoints of each
+        finalized route of those days into a compact_routes LineString and
+        deletes them from routes
+    STATEMENTS (dict): name -> (parameter types, statement) of the
+        statements executed by models.execute_statement()
 
 """
 
@@ -79,58 +167,378 @@ CREATE_ROUTE_LEN_TABLE = """
     );
 """
 
-GET_NEW_ROUTE_ID = "SELECT max(route_id) + 1 FROM route_lengths;"
-
 START_NEW_ROUTE = """
-    INSERT INTO route_lengths (route_id, creation_time, route_length)
-    VALUES ({}, now(),  0.00);
+    INSERT INTO route_lengths (creation_time, route_length)
+    VALUES (now(),  0.00)
+    RETURNING route_id, creation_time;
 """
 
 ROUTE_ID_EXISTS = """
-    SELECT route_id FROM route_lengths WHERE route_id = {} LIMIT 1;
+    SELECT route_id FROM route_lengths WHERE route_id = $1 LIMIT 1;
 """
 
+# Every waypoint of a route is on the day the route was created. Bounding
+# the timestamp to that day, read from route_lengths, lets Postgres prune the
+# other daily partitions of routes at run time, instead of probing the
+# route_id index of every partition.
 ROUTE_ID_HAS_WAYPOINTS = """
-    SELECT route_id FROM routes WHERE route_id = {} LIMIT 1;
+    (
+        SELECT route_id FROM routes
+        WHERE route_id = $1
+            AND timestamp >= (
+                SELECT creation_time::date FROM route_lengths WHERE route_id = $1
+            )
+            AND timestamp < (
+                SELECT creation_time::date + 1 FROM route_lengths WHERE route_id = $1
+            )
+        LIMIT 1
+    )
+    UNION ALL
+    (SELECT route_id FROM compact_routes WHERE route_id = $1)
+    LIMIT 1;
 """
 
+# The buffer and the spool write points stamped by the device or the app
+# server, which can be later than now(). If the route already has a later
+# point, its length is recomputed from all of its points, like ROUTE_BATCH,
+# and its last point is kept.
 UPDATE_ROUTE = """
-    INSERT INTO routes (route_id, timestamp, geom)
-    VALUES ({}, now(), 'SRID=4326; POINT({} {})');
+    WITH fresh_route AS (
+        SELECT route_id, creation_time::date AS day FROM route_lengths
+        WHERE route_id = $1 AND creation_time >= current_date
+    ), new_way_point AS (
+        INSERT INTO routes (route_id, timestamp, geom)
+        SELECT route_id, now(), ST_SetSRID(ST_MakePoint($2, $3), 4326)
+        FROM fresh_route
+        RETURNING route_id, timestamp, geom
+    ), full_scan AS (
+        SELECT coalesce(sum(km), 0) AS km
+        FROM (
+            SELECT
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (ORDER BY timestamp)) / 1000 as km
+            FROM (
+                SELECT timestamp, geom FROM routes
+                WHERE route_id = $1
+                    AND timestamp >= (SELECT day FROM fresh_route)
+                    AND timestamp < (SELECT day + 1 FROM fresh_route)
+                UNION ALL
+                SELECT timestamp, geom FROM new_way_point
+            ) AS all_way_points
+        ) AS segments
+    )
+    UPDATE route_lengths
+    SET route_length = CASE
+            WHEN new_way_point.timestamp < route_lengths.last_timestamp
+                THEN (SELECT km FROM full_scan)
+            ELSE route_length
+                + coalesce(ST_DistanceSphere(last_geom, new_way_point.geom) / 1000, 0)
+        END,
+        last_geom = CASE
+            WHEN new_way_point.timestamp < route_lengths.last_timestamp
+                THEN route_lengths.last_geom
+            ELSE new_way_point.geom
+        END,
+        last_timestamp = greatest(route_lengths.last_timestamp, new_way_point.timestamp)
+    FROM new_way_point
+    WHERE route_lengths.route_id = new_way_point.route_id
+    RETURNING route_lengths.route_id;
 """
 
-SELECT_ALL = "SELECT * FROM {};"
+# Epochs are seconds since the unix epoch, read as UTC like the M values of
+# compact_routes. Points without one (epoch NULL) are stamped by the server,
+# spaced one microsecond apart so that the ORDER BY timestamp of the length
+# queries keeps the order they were sent in. Only points on the day the route
+# was created are stored, and its points in routes are only looked up within
+# that day, in one partition. Buffered or replayed points can be older than
+# the route's last point; the route length is then recomputed from all of
+# its points instead of being extended. Points with a timestamp that the
+# route already has, in routes or folded into compact_routes, are skipped,
+# which makes replaying the spool idempotent.
+# Devices only add points to the routes of today, like UPDATE_ROUTE; the
+# buffer and the spool also write behind to routes of the days before.
+ROUTE_BATCH = """
+    WITH route AS (
+        SELECT route_id, creation_time::date AS day FROM route_lengths
+        WHERE route_id = $1{route_filter}
+    ), compacted AS (
+        SELECT to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC' AS timestamp,
+            ST_Force2D(point.geom) AS geom
+        FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+        WHERE compact_routes.route_id = $1
+    ), new_way_points AS (
+        INSERT INTO routes (route_id, timestamp, geom)
+        SELECT
+            route.route_id,
+            way_point.timestamp,
+            ST_SetSRID(ST_MakePoint(way_point.lon, way_point.lat), 4326)
+        FROM route, (
+            SELECT
+                coalesce(
+                    to_timestamp(epoch) AT TIME ZONE 'UTC',
+                    now()::timestamp + ordinality * interval '1 microsecond'
+                ) AS timestamp,
+                epoch,
+                lon,
+                lat
+            FROM unnest(
+                $2::double precision[],
+                $3::double precision[],
+                $4::double precision[]
+            ) WITH ORDINALITY AS sent(epoch, lon, lat, ordinality)
+        ) AS way_point
+        WHERE way_point.timestamp >= route.day
+            AND way_point.timestamp < route.day + 1
+            AND (way_point.epoch IS NULL OR NOT EXISTS (
+                SELECT 1 FROM routes
+                WHERE routes.route_id = route.route_id
+                    AND routes.timestamp = way_point.timestamp
+                    AND routes.timestamp >= route.day
+                    AND routes.timestamp < route.day + 1
+                UNION ALL
+                SELECT 1 FROM compacted
+                WHERE compacted.timestamp = way_point.timestamp
+            ))
+        RETURNING timestamp, geom
+    ), batch AS (
+        SELECT
+            count(*) AS inserted,
+            coalesce(sum(km), 0) AS km,
+            (array_agg(geom ORDER BY timestamp))[1] AS first_geom,
+            (array_agg(geom ORDER BY timestamp DESC))[1] AS last_geom,
+            min(timestamp) AS first_timestamp,
+            max(timestamp) AS last_timestamp
+        FROM (
+            SELECT timestamp, geom,
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (ORDER BY timestamp)) / 1000 as km
+            FROM new_way_points
+        ) AS segments
+    ), full_scan AS (
+        SELECT coalesce(sum(km), 0) AS km
+        FROM (
+            SELECT
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (ORDER BY timestamp)) / 1000 as km
+            FROM (
+                SELECT timestamp, geom FROM routes
+                WHERE route_id = $1
+                    AND timestamp >= (SELECT day FROM route)
+                    AND timestamp < (SELECT day + 1 FROM route)
+                UNION ALL
+                SELECT timestamp, geom FROM compacted
+                UNION ALL
+                SELECT timestamp, geom FROM new_way_points
+            ) AS all_way_points
+        ) AS segments
+    )
+    UPDATE route_lengths
+    SET route_length = CASE
+            WHEN batch.first_timestamp < route_lengths.last_timestamp
+                THEN (SELECT km FROM full_scan)
+            ELSE route_length + batch.km
+                + coalesce(ST_DistanceSphere(route_lengths.last_geom, batch.first_geom) / 1000, 0)
+        END,
+        last_geom = CASE
+            WHEN batch.last_timestamp < route_lengths.last_timestamp
+                THEN route_lengths.last_geom
+            ELSE batch.last_geom
+        END,
+        last_timestamp = greatest(route_lengths.last_timestamp, batch.last_timestamp)
+    FROM batch
+    WHERE route_lengths.route_id = $1 AND batch.inserted > 0
+    RETURNING batch.inserted;
+"""
+
+UPDATE_ROUTE_BATCH = ROUTE_BATCH.format(
+    route_filter=" AND creation_time >= current_date"
+)
+
+# A replayed point of an earlier day is only stored while its route is not
+# finalized and no finalization is running or waiting: the shared lock makes
+# finalize_days() wait for the replay, and FOR SHARE rereads a route that a
+# finalization committed meanwhile. Otherwise the point is dropped, so the
+# final lengths and longest_route_per_day never change after the fact.
+REPLAY_ROUTE_BATCH = ROUTE_BATCH.format(
+    route_filter="""
+            AND CASE
+                WHEN creation_time >= current_date THEN true
+                WHEN finalized THEN false
+                ELSE pg_try_advisory_xact_lock_shared(hashtext('finalize_days'))
+            END
+        FOR SHARE"""
+)
 
 SINGLE_ROUTE_LENGTH = """
     SELECT sum(route_length) *.001 as km from (
         SELECT
         ST_DistanceSphere(geom, lag(geom, 1) OVER (ORDER BY timestamp)) as route_length
-        FROM routes
-        WHERE route_id = {}
+        FROM (
+            SELECT timestamp, geom FROM routes
+            WHERE route_id = $1
+                AND timestamp >= (
+                    SELECT creation_time::date FROM route_lengths WHERE route_id = $1
+                )
+                AND timestamp < (
+                    SELECT creation_time::date + 1 FROM route_lengths
+                    WHERE route_id = $1
+                )
+            UNION ALL
+            SELECT to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+                ST_Force2D(point.geom)
+            FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+            WHERE compact_routes.route_id = $1
+        ) AS way_points
     ) as route_length_table;
 """
 
-UPDATE_ROUTE_LENGTH = """
-    UPDATE route_lengths SET route_length = {} WHERE route_id = {};
-"""
-# TODO - NOT IN USE, REMOVE AFTER SEPT 2019
-UPDATE_ALL_ROUTES_IN_DAY_LENGTH = """
-    with new_values as (
-       SELECT route_id, sum(km) as total_km
-        FROM
-        	(SELECT route_id, km as km
-        	 FROM (
-        		SELECT route_id, ST_DistanceSphere(geom, lag(geom, 1) OVER (partition by route_id ORDER BY timestamp)) / 1000 as km
-        		FROM routes
-        	 	WHERE timestamp BETWEEN '{}' and '{}'::date + interval '24 hours'
-        	 ) as route_length_table)
-        	as table_two
-        group by route_id
+STORED_ROUTE_LENGTH = """
+    SELECT route_length, last_timestamp FROM route_lengths WHERE route_id = $1;
+"""
+
+STORED_ROUTE_LENGTHS = """
+    SELECT ids.route_id,
+        CASE WHEN rl.last_timestamp IS NOT NULL THEN rl.route_length END,
+        rl.route_id IS NOT NULL
+    FROM unnest(%(route_ids)s::integer[]) WITH ORDINALITY AS ids(route_id, ordinality)
+    LEFT JOIN route_lengths rl ON rl.route_id = ids.route_id
+    ORDER BY ids.ordinality;
+"""
+
+RECOMPUTE_ROUTE_LENGTHS = """
+    WITH full_scan AS (
+        SELECT
+            route_id,
+            coalesce(sum(km), 0) AS total_km,
+            (array_agg(geom ORDER BY timestamp DESC))[1] AS last_geom,
+            max(timestamp) AS last_timestamp
+        FROM (
+            SELECT route_id, timestamp, geom,
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (partition by route_id ORDER BY timestamp)) / 1000 as km
+            FROM (
+                SELECT route_id, timestamp, geom FROM routes
+                WHERE route_id = ANY(%(route_ids)s)
+                UNION ALL
+                SELECT compact_routes.route_id,
+                    to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+                    ST_Force2D(point.geom)
+                FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+                WHERE compact_routes.route_id = ANY(%(route_ids)s)
+            ) AS way_points
+        ) AS route_length_table
+        GROUP BY route_id
     )
     UPDATE route_lengths rl
-      set route_length = new_values.total_km
-    from new_values
-    where new_values.route_id = rl.route_id;
+    SET route_length = full_scan.total_km,
+        last_geom = full_scan.last_geom,
+        last_timestamp = full_scan.last_timestamp
+    FROM full_scan
+    WHERE full_scan.route_id = rl.route_id;
+"""
+
+# The raw coordinates for the numpy length backend (lengths.py), grouped by
+# route and in timestamp order, of the routes and compact_routes tables
+ROUTE_COORDINATES = """
+    SELECT route_id, lon, lat FROM (
+        SELECT route_id, timestamp, ST_X(geom) AS lon, ST_Y(geom) AS lat
+        FROM routes
+        WHERE route_id = ANY(%(route_ids)s)
+        UNION ALL
+        SELECT compact_routes.route_id,
+            to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+            ST_X(point.geom),
+            ST_Y(point.geom)
+        FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+        WHERE compact_routes.route_id = ANY(%(route_ids)s)
+    ) AS way_points
+    ORDER BY route_id, timestamp;
+"""
+
+DAYS_COORDINATES = """
+    SELECT route_id, lon, lat FROM (
+        SELECT route_id, timestamp, ST_X(geom) AS lon, ST_Y(geom) AS lat
+        FROM routes
+        WHERE timestamp >= %(first_day)s::date
+            AND timestamp < %(last_day)s::date + interval '1 day'
+        UNION ALL
+        SELECT compact_routes.route_id,
+            to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+            ST_X(point.geom),
+            ST_Y(point.geom)
+        FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+        WHERE compact_routes.day BETWEEN %(first_day)s::date AND %(last_day)s::date
+    ) AS way_points
+    ORDER BY route_id, timestamp;
+"""
+
+# The waypoints of one route in timestamp order, read through a named
+# (server-side) cursor by models.stream_pgscript(). A compacted route is
+# unfolded from its LineString, with the timestamps from the M values.
+ROUTE_WAY_POINTS = """
+    SELECT timestamp, ST_X(geom), ST_Y(geom) FROM routes
+    WHERE route_id = %(route_id)s
+        AND timestamp >= (
+            SELECT creation_time::date FROM route_lengths
+            WHERE route_id = %(route_id)s
+        )
+        AND timestamp < (
+            SELECT creation_time::date + 1 FROM route_lengths
+            WHERE route_id = %(route_id)s
+        )
+    UNION ALL
+    SELECT to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+        ST_X(point.geom), ST_Y(point.geom)
+    FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+    WHERE compact_routes.route_id = %(route_id)s
+    ORDER BY timestamp;
+"""
+
+# Bulk exports of whole days, streamed by models.copy_days(). Format with
+# the COPY options, e.g. "FORMAT csv, HEADER", then bind the days.
+COPY_DAYS_WAY_POINTS = """
+    COPY (
+        SELECT route_id, timestamp, ST_X(geom) AS lon, ST_Y(geom) AS lat
+        FROM routes
+        WHERE timestamp >= %(first_day)s::date
+            AND timestamp < %(last_day)s::date + interval '1 day'
+        UNION ALL
+        SELECT route_id, to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+            ST_X(point.geom), ST_Y(point.geom)
+        FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+        WHERE day BETWEEN %(first_day)s::date AND %(last_day)s::date
+        ORDER BY route_id, timestamp
+    ) TO STDOUT WITH ({options});
+"""
+
+COPY_DAYS_ROUTE_LENGTHS = """
+    COPY (
+        SELECT route_id, creation_time, route_length AS km, finalized
+        FROM route_lengths
+        WHERE creation_time >= %(first_day)s::date
+            AND creation_time < %(last_day)s::date + interval '1 day'
+        ORDER BY route_id
+    ) TO STDOUT WITH ({options});
+"""
+
+STORE_ROUTE_LENGTHS = """
+    UPDATE route_lengths rl
+    SET route_length = computed.km,
+        last_geom = last_point.geom,
+        last_timestamp = last_point.timestamp
+    FROM unnest(%s::integer[], %s::double precision[]) AS computed(route_id, km)
+    CROSS JOIN LATERAL (
+        SELECT geom, timestamp FROM (
+            (
+                SELECT geom, timestamp FROM routes
+                WHERE routes.route_id = computed.route_id
+                ORDER BY timestamp DESC LIMIT 1
+            )
+            UNION ALL
+            SELECT ST_Force2D(ST_EndPoint(path)),
+                to_timestamp(ST_M(ST_EndPoint(path))) AT TIME ZONE 'UTC'
+            FROM compact_routes
+            WHERE compact_routes.route_id = computed.route_id
+        ) AS last_points
+        ORDER BY timestamp DESC LIMIT 1
+    ) AS last_point
+    WHERE rl.route_id = computed.route_id;
 """
 
 LONGEST_ROUTE_IN_DAY = """
@@ -140,7 +548,7 @@ LONGEST_ROUTE_IN_DAY = """
     	 FROM (
     		SELECT route_id, ST_DistanceSphere(geom, lag(geom, 1) OVER (partition by route_id ORDER BY timestamp)) / 1000 as km
     		FROM routes
-    	 	WHERE timestamp BETWEEN '{}' and '{}'::date + interval '24 hours'
+    	 	WHERE timestamp >= $1::date AND timestamp < $1::date + interval '1 day'
     	 ) as route_length_table)
     	as table_two
     group by route_id
@@ -148,7 +556,7 @@ LONGEST_ROUTE_IN_DAY = """
 """
 
 CHECK_ORIGIN_TIME = """
-    SELECT creation_time FROM route_lengths WHERE route_id = {};
+    SELECT creation_time FROM route_lengths WHERE route_id = $1;
 """
 # Longitude / Latitude Philadelphia
 ADD_TRANSACTION_ROW_1 = """
@@ -164,3 +572,419 @@ ADD_TRANSACTION_ROW_2 = """
     INSERT INTO route_lengths (route_id, creation_time, route_length)
     VALUES (0, '1984-01-28 00:00:01',  1520.7042);
 """
+
+CREATE_SCHEMA_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT now()
+    );
+"""
+
+LOCK_SCHEMA_MIGRATIONS = "LOCK TABLE schema_migrations IN EXCLUSIVE MODE;"
+
+MIGRATION_APPLIED = "SELECT version FROM schema_migrations WHERE version = %s;"
+
+RECORD_MIGRATION = "INSERT INTO schema_migrations (version) VALUES (%s);"
+
+# Keeps route_lengths.route_length up to date as waypoints land, instead of
+# re-aggregating every waypoint of a route on each length request. The last
+# point of each route is stored so the next segment can be added on insert.
+ADD_RUNNING_ROUTE_LENGTH = """
+    ALTER TABLE route_lengths
+        ALTER COLUMN route_length TYPE DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS last_timestamp TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS last_geom geometry(Point, 4326);
+
+    WITH full_scan AS (
+        SELECT
+            route_id,
+            coalesce(sum(km), 0) AS total_km,
+            (array_agg(geom ORDER BY timestamp DESC))[1] AS last_geom,
+            max(timestamp) AS last_timestamp
+        FROM (
+            SELECT route_id, timestamp, geom,
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (partition by route_id ORDER BY timestamp)) / 1000 as km
+            FROM routes
+        ) AS route_length_table
+        GROUP BY route_id
+    )
+    UPDATE route_lengths rl
+    SET route_length = full_scan.total_km,
+        last_geom = full_scan.last_geom,
+        last_timestamp = full_scan.last_timestamp
+    FROM full_scan
+    WHERE full_scan.route_id = rl.route_id;
+"""
+
+# route_lengths.route_id is a SERIAL, but route_ids used to be assigned with
+# max(route_id) + 1, so the sequence has to catch up before START_NEW_ROUTE
+# can draw from it.
+SYNC_ROUTE_ID_SEQUENCE = """
+    SELECT setval(
+        pg_get_serial_sequence('route_lengths', 'route_id'),
+        (SELECT coalesce(max(route_id), 0) + 1 FROM route_lengths),
+        false
+    );
+"""
+
+# Without these, every lookup by route_id and every day filter is a
+# sequential scan. Duplicate route_ids handed out by the old max() + 1
+# allocation are dropped, keeping the first row, before the primary key is
+# added.
+ADD_ROUTE_INDEXES = """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conrelid = 'route_lengths'::regclass AND contype = 'p'
+        ) THEN
+            DELETE FROM route_lengths a USING route_lengths b
+            WHERE a.route_id = b.route_id AND a.ctid > b.ctid;
+            ALTER TABLE route_lengths ADD PRIMARY KEY (route_id);
+        END IF;
+    END $$;
+    CREATE INDEX IF NOT EXISTS routes_route_id_timestamp_idx
+        ON routes (route_id, timestamp);
+    CREATE INDEX IF NOT EXISTS routes_timestamp_brin_idx
+        ON routes USING brin (timestamp);
+    CREATE INDEX IF NOT EXISTS routes_geom_gist_idx
+        ON routes USING gist (geom);
+    ANALYZE routes;
+    ANALYZE route_lengths;
+"""
+
+# Turns routes into a table range-partitioned by day, so that day filters
+# read a single partition, vacuum and index maintenance stay bounded to one
+# day of data, and retention is a DETACH (and DROP) of old partitions.
+# Existing waypoints are moved into one partition per day. The default
+# partition only catches days whose partition was not created ahead of
+# time; create_routes_partition() moves them out again.
+# Declarative partitioning with default partitions and partitioned indexes
+# needs Postgres 11, on older servers routes stays a single heap and the
+# partition functions do nothing.
+PARTITION_ROUTES_BY_DAY = """
+    CREATE OR REPLACE FUNCTION create_routes_partition(day DATE)
+    RETURNS TEXT AS $fn$
+    DECLARE
+        partition TEXT := 'routes_' || to_char(day, 'YYYYMMDD');
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'routes'::regclass) <> 'p'
+            OR to_regclass(partition) IS NOT NULL THEN
+            RETURN NULL;
+        END IF;
+        PERFORM pg_advisory_xact_lock(hashtext('create_routes_partition'));
+        IF to_regclass(partition) IS NOT NULL THEN
+            RETURN NULL;
+        END IF;
+        CREATE TEMP TABLE routes_moved (LIKE routes) ON COMMIT DROP;
+        WITH moved AS (
+            DELETE FROM routes_default
+            WHERE timestamp >= day AND timestamp < day + 1
+            RETURNING *
+        )
+        INSERT INTO routes_moved SELECT * FROM moved;
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF routes FOR VALUES FROM (%L) TO (%L)',
+            partition, day, day + 1
+        );
+        INSERT INTO routes SELECT * FROM routes_moved;
+        DROP TABLE routes_moved;
+        RETURN partition;
+    END
+    $fn$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION detach_routes_partitions(
+        before DATE, drop_detached BOOLEAN
+    )
+    RETURNS SETOF TEXT AS $fn$
+    DECLARE
+        partition TEXT;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'routes'::regclass) <> 'p' THEN
+            RETURN;
+        END IF;
+        FOR partition IN
+            SELECT child.relname
+            FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'routes'::regclass
+                AND child.relname ~ '^routes_[0-9]{8}$'
+                AND to_date(substr(child.relname, 8), 'YYYYMMDD') < before
+            ORDER BY child.relname
+        LOOP
+            EXECUTE format('ALTER TABLE routes DETACH PARTITION %I', partition);
+            IF drop_detached THEN
+                EXECUTE format('DROP TABLE %I', partition);
+            END IF;
+            RETURN NEXT partition;
+        END LOOP;
+    END
+    $fn$ LANGUAGE plpgsql;
+
+    DO $$
+    DECLARE
+        day DATE;
+    BEGIN
+        IF current_setting('server_version_num')::int < 110000
+            OR (SELECT relkind FROM pg_class WHERE oid = 'routes'::regclass) = 'p' THEN
+            RETURN;
+        END IF;
+        ALTER TABLE routes RENAME TO routes_unpartitioned;
+        CREATE TABLE routes (
+            route_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            geom geometry(Point, 4326)
+        ) PARTITION BY RANGE (timestamp);
+        CREATE TABLE routes_default PARTITION OF routes DEFAULT;
+        FOR day IN SELECT DISTINCT timestamp::date FROM routes_unpartitioned LOOP
+            PERFORM create_routes_partition(day);
+        END LOOP;
+        INSERT INTO routes (route_id, timestamp, geom)
+        SELECT route_id, timestamp, geom FROM routes_unpartitioned;
+        DROP TABLE routes_unpartitioned;
+        CREATE INDEX routes_route_id_timestamp_idx ON routes (route_id, timestamp);
+        CREATE INDEX routes_timestamp_brin_idx ON routes USING brin (timestamp);
+        CREATE INDEX routes_geom_gist_idx ON routes USING gist (geom);
+        ANALYZE routes;
+    END $$;
+"""
+
+# Routes only accept waypoints on the day they are created, so once a day is
+# over, the lengths of its routes are final. longest_route_per_day maps every
+# finalized day to its longest route (NULLs if it had none), and
+# route_lengths.finalized marks the routes whose length is final.
+ADD_DAY_FINALIZATION = """
+    ALTER TABLE route_lengths
+        ADD COLUMN IF NOT EXISTS finalized BOOLEAN NOT NULL DEFAULT false;
+    CREATE INDEX IF NOT EXISTS route_lengths_creation_time_idx
+        ON route_lengths (creation_time);
+    CREATE TABLE IF NOT EXISTS longest_route_per_day (
+    day DATE PRIMARY KEY,
+    route_id INTEGER,
+    km DOUBLE PRECISION,
+    finalized_at TIMESTAMP DEFAULT now()
+    );
+"""
+
+# Once a day is finalized, the waypoints of each of its routes are folded
+# into one LINESTRINGM row of compact_routes, with the epoch of every point
+# as its M value, and deleted from routes. longest_route_per_day.compacted_at
+# marks the days done.
+CREATE_COMPACT_ROUTES_TABLE = """
+    CREATE TABLE IF NOT EXISTS compact_routes (
+    route_id INTEGER PRIMARY KEY,
+    day DATE NOT NULL,
+    points INTEGER NOT NULL,
+    km DOUBLE PRECISION NOT NULL,
+    path geometry(LINESTRINGM, 4326) NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS compact_routes_day_idx ON compact_routes (day);
+"""
+
+ADD_ROUTE_COMPACTION = CREATE_COMPACT_ROUTES_TABLE + """
+    ALTER TABLE longest_route_per_day
+        ADD COLUMN IF NOT EXISTS compacted_at TIMESTAMP;
+"""
+
+# The final lengths of each day, longest first, so that the top routes of a
+# range of days are read from the head of one index range per day.
+ADD_LONGEST_ROUTES_INDEX = """
+    CREATE INDEX IF NOT EXISTS route_lengths_final_length_idx
+        ON route_lengths ((creation_time::date), route_length DESC)
+        WHERE finalized AND last_timestamp IS NOT NULL;
+    ANALYZE route_lengths;
+"""
+
+MIGRATIONS = (
+    (1, ADD_RUNNING_ROUTE_LENGTH),
+    (2, SYNC_ROUTE_ID_SEQUENCE),
+    (3, ADD_ROUTE_INDEXES),
+    (4, PARTITION_ROUTES_BY_DAY),
+    (5, ADD_DAY_FINALIZATION),
+    (6, ADD_ROUTE_COMPACTION),
+    (7, ADD_LONGEST_ROUTES_INDEX),
+)
+
+CREATE_ROUTES_PARTITIONS = """
+    SELECT create_routes_partition(current_date + day)
+    FROM generate_series(0, %s) AS day;
+"""
+
+DETACH_ROUTES_PARTITIONS = "SELECT detach_routes_partitions(%s, %s);"
+
+LONGEST_ROUTE_OF_FINALIZED_DAY = """
+    SELECT route_id, km FROM longest_route_per_day WHERE day = $1;
+"""
+
+LAST_FINALIZED_DAY = "SELECT max(day) FROM longest_route_per_day;"
+
+RECENT_LONGEST_ROUTES = """
+    SELECT day, route_id, km FROM longest_route_per_day ORDER BY day DESC LIMIT $1;
+"""
+
+# At most k routes are read per day, from route_lengths_final_length_idx, so
+# the cost grows with k and the number of days, not with the waypoints.
+LONGEST_ROUTES_IN_DAYS = """
+    SELECT longest.route_id, day::date, longest.route_length
+    FROM generate_series($1::timestamp, $2::timestamp, interval '1 day') AS day
+    CROSS JOIN LATERAL (
+        SELECT route_id, route_length
+        FROM route_lengths
+        WHERE finalized AND last_timestamp IS NOT NULL
+            AND creation_time::date = day::date
+        ORDER BY route_length DESC LIMIT $3
+    ) AS longest
+    ORDER BY longest.route_length DESC, longest.route_id LIMIT $3;
+"""
+
+LONGEST_ROUTE_OF_FINALIZED_DAYS = """
+    SELECT day, route_id, km FROM longest_route_per_day
+    WHERE day BETWEEN $1 AND $2 ORDER BY day;
+"""
+
+LOCK_FINALIZATION = "SELECT pg_advisory_xact_lock(hashtext('finalize_days'));"
+
+TRY_LOCK_FINALIZATION = """
+    SELECT pg_try_advisory_xact_lock(hashtext('finalize_days'));
+"""
+
+PENDING_FINALIZATION_DAYS = """
+    SELECT
+        coalesce(
+            (SELECT max(day) + 1 FROM longest_route_per_day),
+            (SELECT min(creation_time)::date FROM route_lengths)
+        ),
+        current_date - 1;
+"""
+
+FINALIZE_ROUTE_LENGTHS = """
+    WITH final_lengths AS (
+        SELECT route_id, coalesce(sum(km), 0) AS total_km
+        FROM (
+            SELECT route_id,
+            ST_DistanceSphere(geom, lag(geom, 1) OVER (partition by route_id ORDER BY timestamp)) / 1000 as km
+            FROM (
+                SELECT route_id, timestamp, geom FROM routes
+                WHERE timestamp >= %(first_day)s::date
+                    AND timestamp < %(last_day)s::date + interval '1 day'
+                UNION ALL
+                SELECT compact_routes.route_id,
+                    to_timestamp(ST_M(point.geom)) AT TIME ZONE 'UTC',
+                    ST_Force2D(point.geom)
+                FROM compact_routes, ST_DumpPoints(compact_routes.path) AS point
+                WHERE compact_routes.day
+                    BETWEEN %(first_day)s::date AND %(last_day)s::date
+            ) AS way_points
+        ) AS route_length_table
+        GROUP BY route_id
+    )
+    UPDATE route_lengths rl
+    SET route_length = final_lengths.total_km
+    FROM final_lengths
+    WHERE final_lengths.route_id = rl.route_id
+        AND rl.creation_time >= %(first_day)s::date
+        AND rl.creation_time < %(last_day)s::date + interval '1 day';
+"""
+
+FINALIZE_DAYS = """
+    UPDATE route_lengths SET finalized = true
+    WHERE creation_time >= %(first_day)s::date
+        AND creation_time < %(last_day)s::date + interval '1 day';
+
+    INSERT INTO longest_route_per_day (day, route_id, km)
+    SELECT day::date, longest.route_id, longest.route_length
+    FROM generate_series(
+        %(first_day)s::timestamp, %(last_day)s::timestamp, interval '1 day'
+    ) AS day
+    LEFT JOIN LATERAL (
+        SELECT route_id, route_length
+        FROM route_lengths
+        WHERE creation_time >= day AND creation_time < day + interval '1 day'
+            AND last_timestamp IS NOT NULL
+        ORDER BY route_length DESC LIMIT 1
+    ) AS longest ON true
+    ON CONFLICT (day) DO UPDATE
+    SET route_id = EXCLUDED.route_id, km = EXCLUDED.km, finalized_at = now();
+"""
+
+PENDING_COMPACTION_DAYS = """
+    SELECT min(day), max(day) FROM longest_route_per_day WHERE compacted_at IS NULL;
+"""
+
+# Routes with a single waypoint make no LineString and stay in routes. A
+# route compacted already keeps any waypoint replayed after its compaction
+# in routes, too; the reads above union both tables.
+COMPACT_DAYS = """
+    WITH compacted AS (
+        INSERT INTO compact_routes (route_id, day, points, km, path)
+        SELECT rl.route_id, rl.creation_time::date, count(*), rl.route_length,
+            ST_SetSRID(
+                ST_MakeLine(
+                    ST_MakePointM(
+                        ST_X(routes.geom),
+                        ST_Y(routes.geom),
+                        extract(epoch FROM routes.timestamp)
+                    )
+                    ORDER BY routes.timestamp
+                ),
+                4326
+            )
+        FROM routes
+        JOIN route_lengths rl ON rl.route_id = routes.route_id
+        WHERE routes.timestamp >= %(first_day)s::date
+            AND routes.timestamp < %(last_day)s::date + interval '1 day'
+            AND rl.finalized
+        GROUP BY rl.route_id, rl.creation_time, rl.route_length
+        HAVING count(*) > 1
+        ON CONFLICT (route_id) DO NOTHING
+        RETURNING route_id
+    )
+    DELETE FROM routes
+    USING compacted
+    WHERE routes.route_id = compacted.route_id
+        AND routes.timestamp >= %(first_day)s::date
+        AND routes.timestamp < %(last_day)s::date + interval '1 day';
+
+    UPDATE longest_route_per_day SET compacted_at = now()
+    WHERE day BETWEEN %(first_day)s::date AND %(last_day)s::date;
+"""
+
+# The statements of the request paths. Each is prepared once per pooled
+# connection (PREPARE name (types) AS statement) and then only executed, so
+# Postgres parses and plans it once instead of on every request.
+STATEMENTS = {
+    "start_new_route": ((), START_NEW_ROUTE),
+    "route_id_has_waypoints": (("integer",), ROUTE_ID_HAS_WAYPOINTS),
+    "check_origin_time": (("integer",), CHECK_ORIGIN_TIME),
+    "update_route": (
+        ("integer", "double precision", "double precision"),
+        UPDATE_ROUTE,
+    ),
+    "update_route_batch": (
+        (
+            "integer",
+            "double precision[]",
+            "double precision[]",
+            "double precision[]",
+        ),
+        UPDATE_ROUTE_BATCH,
+    ),
+    "replay_route_batch": (
+        (
+            "integer",
+            "double precision[]",
+            "double precision[]",
+            "double precision[]",
+        ),
+        REPLAY_ROUTE_BATCH,
+    ),
+    "stored_route_length": (("integer",), STORED_ROUTE_LENGTH),
+    "single_route_length": (("integer",), SINGLE_ROUTE_LENGTH),
+    "longest_route_of_finalized_day": (("date",), LONGEST_ROUTE_OF_FINALIZED_DAY),
+    "last_finalized_day": ((), LAST_FINALIZED_DAY),
+    "recent_longest_routes": (("integer",), RECENT_LONGEST_ROUTES),
+    "longest_routes_in_days": (("date", "date", "integer"), LONGEST_ROUTES_IN_DAYS),
+    "longest_route_of_finalized_days": (
+        ("date", "date"),
+        LONGEST_ROUTE_OF_FINALIZED_DAYS,
+    ),
+}
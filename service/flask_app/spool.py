@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""spool.py contains the local, durable spool for waypoints.
+
+When Postgres is down or too slow to hand out a connection, controller.py
+appends the waypoints it could not write to a memory-mapped spool file of
+the current worker instead of failing the request. A background thread
+replays the spool in bulk, one statement per route, once the database
+answers again. Replay is idempotent: waypoints already stored (same route_id
+and timestamp) are skipped, so a replay interrupted by a crash can simply
+run again. A route that fails for any other reason than an unavailable
+database, and would fail every replay, is logged and dropped from the spool.
+
+The file is a 16 byte header, b"WPSPOOL1" and the number of records as a
+little-endian uint64, followed by SPOOL_CAPACITY fixed-width records of
+(route_id int64, unix timestamp float64, longitude float64, latitude float64).
+
+Example:
+    $ spool.get_spool().append([(42, time.time(), 13.404954, 52.520008)])
+    True
+
+Constants:
+    SPOOL_DIR (str): directory of the spool files, one per worker
+    SPOOL_CAPACITY (int): waypoints a spool file holds
+    SPOOL_REPLAY_INTERVAL (float): seconds between replay attempts
+    SPOOL_SYNC (bool): msync after every append, so that spooled waypoints
+        also survive an OS crash and not only a process crash
+
+"""
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import models
+import storage
+
+try:
+    import uwsgi
+except ImportError:  # not running under uWSGI
+    uwsgi = None
+
+LOGGER = logging.getLogger(__name__)
+
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "/tmp/waypoint_spool")
+SPOOL_CAPACITY = int(os.environ.get("SPOOL_CAPACITY", 1000000))
+SPOOL_REPLAY_INTERVAL = float(os.environ.get("SPOOL_REPLAY_INTERVAL", 5.0))
+SPOOL_SYNC = os.environ.get("SPOOL_SYNC", "") == "true"
+
+MAGIC = b"WPSPOOL1"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<qddd")
+
+_SPOOL = None
+_SPOOL_LOCK = threading.Lock()
+
+
+class WaypointSpool(object):
+    """An append-only, memory-mapped file of fixed-width waypoint records
+
+    Args:
+        path (str): the spool file, created if missing
+        capacity (int): the number of records the file holds
+        sync (bool): msync the mapping after every append
+
+    """
+
+    def __init__(self, path, capacity, sync=False):
+        self.path = path
+        self.capacity = capacity
+        self.sync = sync
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        size = HEADER.size + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            count = 0
+            HEADER.pack_into(self._mmap, 0, MAGIC, count)
+        self._count = min(count, capacity)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, way_points):
+        """Appends waypoints, all of them or none
+
+        Args:
+            way_points (list): of (route_id, epoch, longitude, latitude) tuples
+
+        Returns:
+            bool: False if the spool has no room for all of them
+        """
+        with self._lock:
+            if self._count + len(way_points) > self.capacity:
+                return False
+            self._pack(self._count, way_points)
+            if self.sync:
+                self._mmap.flush()
+        return True
+
+    def _pack(self, index, records):
+        """Writes records from index on and makes them the end of the spool"""
+        for offset, record in enumerate(records):
+            RECORD.pack_into(
+                self._mmap, HEADER.size + (index + offset) * RECORD.size, *record
+            )
+        self._count = index + len(records)
+        HEADER.pack_into(self._mmap, 0, MAGIC, self._count)
+
+    def _unpack(self, start, stop):
+        """
+        Returns:
+            list: of the (route_id, epoch, longitude, latitude) records
+        """
+        return [
+            RECORD.unpack_from(self._mmap, HEADER.size + index * RECORD.size)
+            for index in range(start, stop)
+        ]
+
+    def replay(self, write):
+        """Writes every spooled waypoint, then drops them from the spool
+
+        Waypoints appended while the replay runs are kept for the next one.
+        If the database becomes unavailable, the waypoints of the routes not
+        written yet are kept too, and the error is raised. The waypoints of
+        a route that fails with any other error are logged and dropped.
+
+        Args:
+            write (callable): write(route_id, epochs, longitudes, latitudes),
+                stores the points of one route and returns how many were stored
+
+        Returns:
+            int: the number of waypoints replayed
+
+        Raises:
+            models.UNAVAILABLE_ERRORS: the database is still unavailable
+        """
+        with self._lock:
+            replaying = self._count
+        by_route = collections.OrderedDict()
+        for route_id, epoch, longitude, latitude in self._unpack(0, replaying):
+            by_route.setdefault(route_id, []).append((epoch, longitude, latitude))
+        stored = dropped = 0
+        try:
+            while by_route:
+                route_id, way_points = by_route.popitem(last=False)
+                way_points.sort()
+                epochs, longitudes, latitudes = (list(v) for v in zip(*way_points))
+                try:
+                    stored += write(route_id, epochs, longitudes, latitudes)
+                except models.UNAVAILABLE_ERRORS:
+                    by_route[route_id] = way_points
+                    raise
+                except Exception:
+                    LOGGER.exception(
+                        "Dropped %s spooled waypoints of route_id %s",
+                        len(way_points),
+                        route_id,
+                    )
+                    dropped += len(way_points)
+        finally:
+            kept = [
+                (route_id,) + way_point
+                for route_id, way_points in by_route.items()
+                for way_point in way_points
+            ]
+            with self._lock:
+                self._pack(0, kept + self._unpack(replaying, self._count))
+                self._mmap.flush()
+        LOGGER.info(
+            "Replayed %s spooled waypoints, %s were stored and %s dropped",
+            replaying,
+            stored,
+            dropped,
+        )
+        return replaying
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
+
+
+def _write_way_points(route_id, epochs, longitudes, latitudes):
+    return storage.get_storage().add_way_points(
+        route_id, longitudes, latitudes, epochs, replay=True
+    )
+
+
+def _replay_forever(spool, stop):
+    while not stop.wait(SPOOL_REPLAY_INTERVAL):
+        if not len(spool):
+            continue
+        try:
+            spool.replay(_write_way_points)
+        except models.UNAVAILABLE_ERRORS as err:
+            LOGGER.warning("Spool replay deferred: %s", err)
+
+
+def spool_path():
+    """One file per uWSGI worker id, so a restarted worker replays its own
+
+    Returns:
+        str: the path of the spool file of the current process
+    """
+    if uwsgi is not None:
+        name = "worker-{}.spool".format(uwsgi.worker_id())
+    else:
+        name = "pid-{}.spool".format(os.getpid())
+    return os.path.join(SPOOL_DIR, name)
+
+
+def get_spool():
+    """Returns the spool of the current process, opening it on first use
+
+    Opening the spool starts the background thread that replays it.
+
+    Returns:
+        WaypointSpool
+
+    """
+    global _SPOOL
+    current = _SPOOL
+    if current is not None and current.pid == os.getpid():
+        return current
+    with _SPOOL_LOCK:
+        if _SPOOL is None or _SPOOL.pid != os.getpid():
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            _SPOOL = WaypointSpool(spool_path(), SPOOL_CAPACITY, sync=SPOOL_SYNC)
+            threading.Thread(
+                target=_replay_forever,
+                args=(_SPOOL, threading.Event()),
+                name="waypoint-spool-replay",
+                daemon=True,
+            ).start()
+        return _SPOOL
+
+
+def resume_spool():
+    """Opens the spool of a restarted worker if it still holds waypoints
+
+    Returns:
+        int: the number of waypoints waiting to be replayed
+    """
+    path = spool_path()
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+        return 0
+    with open(path, "rb") as spool_file:
+        magic, count = HEADER.unpack(spool_file.read(HEADER.size))
+    if magic != MAGIC or not count:
+        return 0
+    return len(get_spool())
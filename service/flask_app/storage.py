@@ -0,0 +1,770 @@
+# -*- coding: utf-8 -*-
+"""storage.py contains the storage backends behind controller.py.
+
+Every backend offers the same methods: bootstrap, create_route,
+route_creation_time, add_way_point, add_way_points, way_points,
+route_length, route_lengths, full_scan_route_length, route_has_way_points,
+longest_route_in_day, longest_routes, recent_longest_routes, finalize_days
+and compact_days. STORAGE_BACKEND selects one:
+
+* postgres (default): the PostGIS database of models.py
+* memory: plain Python structures in the current process, for benchmarks
+  and tests; nothing survives a restart and every process has its own
+* sqlite: an embedded SQLite file (SQLITE_PATH), for single-node edge
+  deployments without a database server
+
+The memory and sqlite backends sum route lengths in Python, with the
+haversine distance on the sphere ST_DistanceSphere uses (see lengths.py).
+They keep every route length exact as waypoints arrive, so there is nothing
+to finalize or compact. Like the database, they keep their times in UTC.
+
+Example:
+    $ route_id, creation_time = storage.get_storage().create_route()
+
+Constants:
+    STORAGE_BACKEND (str): postgres, memory or sqlite
+    SQLITE_PATH (str): the database file of the sqlite backend
+
+"""
+import bisect
+import datetime
+import os
+import sqlite3
+import threading
+
+import lengths
+import models
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "gps_tracker_service.sqlite3")
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+_STORAGE = None
+_STORAGE_LOCK = threading.Lock()
+
+
+class DayNotFinalized(LookupError):
+    """The scheduled finalization job has not finalized the day yet"""
+
+
+def utc_today():
+    """
+    Returns:
+        datetime.date: the current date in UTC
+    """
+    return datetime.datetime.utcnow().date()
+
+
+def path_length_km(points):
+    """
+    Args:
+        points (list): (longitude, latitude) tuples in timestamp order
+
+    Returns:
+        float: the length in km of the path through points
+    """
+    return sum(
+        lengths.sphere_distance_km(*(start + end))
+        for start, end in zip(points, points[1:])
+    )
+
+
+def stamp_way_points(creation_time, longitudes, latitudes, epochs):
+    """Timestamps a batch of waypoints, like querys.UPDATE_ROUTE_BATCH
+
+    Points without an epoch are stamped with the current time, one
+    microsecond apart in the order given. Only points on the day the route
+    was created are kept, which also drops epochs too large for a datetime;
+    uploads.py answers those with 400 before they get here.
+
+    Returns:
+        list: of (timestamp, longitude, latitude) tuples
+    """
+    now = datetime.datetime.utcnow()
+    epochs = epochs or [None] * len(longitudes)
+    way_points = []
+    for ordinality, (epoch, longitude, latitude) in enumerate(
+        zip(epochs, longitudes, latitudes), 1
+    ):
+        if epoch is None:
+            timestamp = now + datetime.timedelta(microseconds=ordinality)
+        else:
+            try:
+                timestamp = datetime.datetime.utcfromtimestamp(epoch)
+            except (OverflowError, OSError, ValueError):
+                continue
+        if timestamp.date() == creation_time.date():
+            way_points.append((timestamp, float(longitude), float(latitude)))
+    return way_points
+
+
+class PostgresStorage(object):
+    """The PostGIS database of models.py, through the per-process pool"""
+
+    name = "postgres"
+
+    def bootstrap(self):
+        """(Re)creates the database, its tables and migrations
+
+        Returns:
+            bool: True if the database and both tables exist afterwards
+        """
+        models.initialize_db()
+        return (
+            models.db_exists(models.DB_NAME)
+            and models.table_exists("routes")
+            and models.table_exists("route_lengths")
+        )
+
+    def create_route(self):
+        """Stores a new, empty route
+
+        Returns:
+            tuple: (route_id, creation_time)
+        """
+        conn, cur = models.execute_statement("start_new_route")
+        route_id, creation_time = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        return route_id, creation_time
+
+    def route_creation_time(self, route_id):
+        """
+        Returns:
+            datetime.datetime: the creation time, or None if route_id does not exist
+        """
+        conn, cur = models.execute_statement("check_origin_time", (route_id,))
+        creation_time = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        return creation_time[0] if creation_time else None
+
+    def add_way_point(self, route_id, longitude, latitude):
+        """Stores a waypoint stamped now, if route_id was created today
+
+        Returns:
+            bool: False if the route does not exist or is stale
+        """
+        conn, cur = models.execute_statement(
+            "update_route", (route_id, longitude, latitude)
+        )
+        inserted = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        return inserted is not None
+
+    def add_way_points(
+        self, route_id, longitudes, latitudes, epochs=None, replay=False
+    ):
+        """Stores the waypoints of a batch that fall on the route's creation day
+
+        Devices only add waypoints to the routes of today; replay=True is for
+        the buffer and the spool, which write behind to earlier routes.
+
+        Returns:
+            int: the number of waypoints stored
+        """
+        return models.insert_way_points(route_id, longitudes, latitudes, epochs, replay)
+
+    def way_points(self, route_id, chunk_size):
+        """Reads the waypoints of a route back, in timestamp order
+
+        Only chunk_size waypoints are held in memory at a time.
+
+        Yields:
+            list: of up to chunk_size (timestamp, longitude, latitude) tuples
+        """
+        return models.stream_pgscript(
+            models.querys.ROUTE_WAY_POINTS, {"route_id": route_id}, chunk_size
+        )
+
+    def route_length(self, route_id):
+        """
+        Returns:
+            float: the stored length in km, or None if the route has no waypoints
+        """
+        conn, cur = models.execute_statement("stored_route_length", (route_id,))
+        length_of_route = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        if not length_of_route or length_of_route[1] is None:
+            return None
+        return length_of_route[0]
+
+    def route_lengths(self, route_ids, chunk_size):
+        """Reads the stored lengths of many routes with one query
+
+        The rows come from a server-side cursor, chunk_size at a time.
+
+        Yields:
+            list: of up to chunk_size (route_id, km, known) tuples in the
+                order of route_ids, km None for a route without waypoints
+                and known False for a route_id that does not exist
+        """
+        return models.stream_pgscript(
+            models.querys.STORED_ROUTE_LENGTHS, {"route_ids": route_ids}, chunk_size
+        )
+
+    def full_scan_route_length(self, route_id):
+        """
+        Returns:
+            float: the length in km summed over every waypoint of the route
+        """
+        conn, cur = models.execute_statement("single_route_length", (route_id,))
+        recomputed = cur.fetchone()[0]
+        models.close_and_commit(cur, conn)
+        return recomputed or 0.0
+
+    def route_has_way_points(self, route_id):
+        """
+        Returns:
+            bool: True if the route has waypoints
+        """
+        conn, cur = models.execute_statement("route_id_has_waypoints", (route_id,))
+        has_way_points = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        return bool(has_way_points)
+
+    def longest_route_in_day(self, query_date):
+        """Looks up the longest route of a past day
+
+        The answer is precomputed by finalize_days(), which the scheduled
+        tasks.finalize_previous_days() job runs once per day, so this is a
+        primary key lookup. Days are only finalized by the job, never here.
+
+        Args:
+            query_date (str): in the form of %Y-%m-%d, older than today
+
+        Returns:
+            tuple: (route_id, km), or None if no routes were recorded that day
+
+        Raises:
+            DayNotFinalized: if the job has not finalized query_date yet
+        """
+        longest_route_in_a_day = self._finalized_longest_route(query_date)
+        if longest_route_in_a_day is None:
+            self._check_finalized(
+                datetime.datetime.strptime(query_date, "%Y-%m-%d").date()
+            )
+            return None
+        if longest_route_in_a_day[0] is None:
+            return None
+        return longest_route_in_a_day
+
+    def _finalized_longest_route(self, query_date):
+        conn, cur = models.execute_statement(
+            "longest_route_of_finalized_day", (query_date,)
+        )
+        longest_route_in_a_day = cur.fetchone()
+        models.close_and_commit(cur, conn)
+        return longest_route_in_a_day
+
+    def _check_finalized(self, day):
+        """Days before the first route get no longest_route_per_day row, so a
+        day without a row is finalized if a later day is
+
+        Raises:
+            DayNotFinalized: if day is after the last finalized day
+        """
+        conn, cur = models.execute_statement("last_finalized_day", ())
+        last_finalized_day = cur.fetchone()[0]
+        models.close_and_commit(cur, conn)
+        if last_finalized_day is None or day > last_finalized_day:
+            raise DayNotFinalized(day)
+
+    def longest_routes(self, first_day, last_day, k):
+        """Looks up the k longest routes of a range of past days
+
+        Like longest_route_in_day(), the answer is read from the lengths
+        stored by finalize_days().
+
+        Args:
+            first_day (datetime.date): the first day of the range
+            last_day (datetime.date): the last day of the range, older than today
+            k (int): the number of routes
+
+        Returns:
+            list, list: (route_id, day, km) of the k longest routes, longest
+                first, and (day, route_id, km) of the longest route of every
+                day of the range that has routes, in day order
+
+        Raises:
+            DayNotFinalized: if the job has not finalized last_day yet
+        """
+        self._check_finalized(last_day)
+        longest_per_day = self._finalized_longest_routes(first_day, last_day)
+        conn, cur = models.execute_statement(
+            "longest_routes_in_days", (first_day, last_day, k)
+        )
+        longest = cur.fetchall()
+        models.close_and_commit(cur, conn)
+        return longest, [day for day in longest_per_day if day[1] is not None]
+
+    def _finalized_longest_routes(self, first_day, last_day):
+        conn, cur = models.execute_statement(
+            "longest_route_of_finalized_days", (first_day, last_day)
+        )
+        longest_per_day = cur.fetchall()
+        models.close_and_commit(cur, conn)
+        return longest_per_day
+
+    def recent_longest_routes(self, days):
+        """
+        Returns:
+            list: (day, route_id, km) of the most recent finalized days, with
+                route_id None for days without routes
+        """
+        conn, cur = models.execute_statement("recent_longest_routes", (days,))
+        recent_days = cur.fetchall()
+        models.close_and_commit(cur, conn)
+        return recent_days
+
+    def finalize_days(self, wait=False):
+        """See models.finalize_days()"""
+        return models.finalize_days(wait)
+
+    def compact_days(self):
+        """See models.compact_days()"""
+        return models.compact_days()
+
+
+class MemoryStorage(object):
+    """Routes kept in a dict of the current process, guarded by one lock"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bootstrap()
+
+    def bootstrap(self):
+        with self._lock:
+            # route_id -> {'creation_time', 'timestamps', 'points', 'km'},
+            # timestamps sorted and points the (lon, lat) in the same order
+            self._routes = {}
+            self._next_route_id = 1
+        return True
+
+    def create_route(self):
+        creation_time = datetime.datetime.utcnow()
+        with self._lock:
+            route_id = self._next_route_id
+            self._next_route_id += 1
+            self._routes[route_id] = {
+                "creation_time": creation_time,
+                "timestamps": [],
+                "points": [],
+                "km": 0.0,
+            }
+        return route_id, creation_time
+
+    def route_creation_time(self, route_id):
+        route = self._routes.get(route_id)
+        return route["creation_time"] if route else None
+
+    def add_way_point(self, route_id, longitude, latitude):
+        route = self._routes.get(route_id)
+        if route is None or route["creation_time"].date() < utc_today():
+            return False
+        return self.add_way_points(route_id, [longitude], [latitude]) == 1
+
+    def add_way_points(
+        self, route_id, longitudes, latitudes, epochs=None, replay=False
+    ):
+        route = self._routes.get(route_id)
+        if route is None or (
+            not replay and route["creation_time"].date() < utc_today()
+        ):
+            return 0
+        way_points = stamp_way_points(
+            route["creation_time"], longitudes, latitudes, epochs
+        )
+        inserted = 0
+        with self._lock:
+            timestamps, points = route["timestamps"], route["points"]
+            for timestamp, longitude, latitude in sorted(way_points):
+                index = bisect.bisect_left(timestamps, timestamp)
+                if index < len(timestamps) and timestamps[index] == timestamp:
+                    continue
+                if index == len(timestamps) and points:
+                    route["km"] += lengths.sphere_distance_km(
+                        *(points[-1] + (longitude, latitude))
+                    )
+                    out_of_order = False
+                else:
+                    out_of_order = index < len(timestamps)
+                timestamps.insert(index, timestamp)
+                points.insert(index, (longitude, latitude))
+                if out_of_order:
+                    route["km"] = path_length_km(points)
+                inserted += 1
+        return inserted
+
+    def way_points(self, route_id, chunk_size):
+        route = self._routes.get(route_id)
+        if route is None:
+            return
+        start = 0
+        while True:
+            with self._lock:
+                timestamps = route["timestamps"][start:start + chunk_size]
+                points = route["points"][start:start + chunk_size]
+            if not timestamps:
+                return
+            yield [
+                (timestamp, longitude, latitude)
+                for timestamp, (longitude, latitude) in zip(timestamps, points)
+            ]
+            start += chunk_size
+
+    def route_length(self, route_id):
+        route = self._routes.get(route_id)
+        if route is None or not route["points"]:
+            return None
+        return route["km"]
+
+    def route_lengths(self, route_ids, chunk_size):
+        for start in range(0, len(route_ids), chunk_size):
+            yield [
+                (route_id, self.route_length(route_id), route_id in self._routes)
+                for route_id in route_ids[start:start + chunk_size]
+            ]
+
+    def full_scan_route_length(self, route_id):
+        route = self._routes.get(route_id)
+        with self._lock:
+            return path_length_km(list(route["points"])) if route else 0.0
+
+    def route_has_way_points(self, route_id):
+        route = self._routes.get(route_id)
+        return bool(route and route["points"])
+
+    def longest_route_in_day(self, query_date):
+        day = datetime.datetime.strptime(query_date, "%Y-%m-%d").date()
+        with self._lock:
+            candidates = [
+                (route["km"], route_id)
+                for route_id, route in self._routes.items()
+                if route["creation_time"].date() == day and route["points"]
+            ]
+        if not candidates:
+            return None
+        km, route_id = max(candidates)
+        return route_id, km
+
+    def longest_routes(self, first_day, last_day, k):
+        with self._lock:
+            routes = [
+                (route["km"], route_id, route["creation_time"].date())
+                for route_id, route in self._routes.items()
+                if first_day <= route["creation_time"].date() <= last_day
+                and route["points"]
+            ]
+        longest_per_day = {}
+        for km, route_id, day in routes:
+            longest_per_day[day] = max(
+                longest_per_day.get(day, (-1.0, None)), (km, route_id)
+            )
+        routes.sort(key=lambda route: (-route[0], route[1]))
+        return (
+            [(route_id, day, km) for km, route_id, day in routes[:k]],
+            [
+                (day, route_id, km)
+                for day, (km, route_id) in sorted(longest_per_day.items())
+            ],
+        )
+
+    def recent_longest_routes(self, days):
+        today = utc_today()
+        longest = {}
+        with self._lock:
+            for route_id, route in self._routes.items():
+                day = route["creation_time"].date()
+                if day < today and route["points"]:
+                    longest[day] = max(
+                        longest.get(day, (-1.0, None)), (route["km"], route_id)
+                    )
+        return [
+            (day, route_id, km)
+            for day, (km, route_id) in sorted(longest.items(), reverse=True)[:days]
+        ]
+
+    def finalize_days(self, wait=False):
+        return None
+
+    def compact_days(self):
+        return None
+
+
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS route_lengths (
+        route_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        creation_time TEXT NOT NULL,
+        route_length REAL NOT NULL DEFAULT 0,
+        last_timestamp TEXT,
+        last_lon REAL,
+        last_lat REAL
+    );
+    CREATE INDEX IF NOT EXISTS route_lengths_creation_time_idx
+        ON route_lengths (creation_time);
+    CREATE TABLE IF NOT EXISTS routes (
+        route_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        lon REAL NOT NULL,
+        lat REAL NOT NULL,
+        PRIMARY KEY (route_id, timestamp)
+    ) WITHOUT ROWID;
+"""
+
+
+class SQLiteStorage(object):
+    """An embedded SQLite database, shared by the threads of a process
+
+    Timestamps are stored as text in TIMESTAMP_FORMAT, which sorts like time.
+
+    Args:
+        path (str): the database file, created with its tables if missing
+
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    def bootstrap(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM routes;")
+            self._conn.execute("DELETE FROM route_lengths;")
+        return True
+
+    def create_route(self):
+        creation_time = datetime.datetime.utcnow()
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO route_lengths (creation_time) VALUES (?);",
+                (creation_time.strftime(TIMESTAMP_FORMAT),),
+            )
+        return cur.lastrowid, creation_time
+
+    def _route(self, route_id):
+        row = self._conn.execute(
+            "SELECT creation_time, route_length, last_timestamp, last_lon, last_lat"
+            " FROM route_lengths WHERE route_id = ?;",
+            (route_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return (datetime.datetime.strptime(row[0], TIMESTAMP_FORMAT),) + row[1:]
+
+    def route_creation_time(self, route_id):
+        with self._lock:
+            route = self._route(route_id)
+        return route[0] if route else None
+
+    def add_way_point(self, route_id, longitude, latitude):
+        creation_time = self.route_creation_time(route_id)
+        if creation_time is None or creation_time.date() < utc_today():
+            return False
+        return self.add_way_points(route_id, [longitude], [latitude]) == 1
+
+    def add_way_points(
+        self, route_id, longitudes, latitudes, epochs=None, replay=False
+    ):
+        with self._lock, self._conn:
+            route = self._route(route_id)
+            if route is None:
+                return 0
+            creation_time, km, last_timestamp, last_lon, last_lat = route
+            if not replay and creation_time.date() < utc_today():
+                return 0
+            way_points = [
+                (route_id, timestamp.strftime(TIMESTAMP_FORMAT), longitude, latitude)
+                for timestamp, longitude, latitude in sorted(
+                    stamp_way_points(creation_time, longitudes, latitudes, epochs)
+                )
+            ]
+            inserted = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO routes (route_id, timestamp, lon, lat)"
+                " VALUES (?, ?, ?, ?);",
+                way_points,
+            )
+            inserted = self._conn.total_changes - inserted
+            if not inserted:
+                return 0
+            if last_timestamp is None or way_points[0][1] > last_timestamp:
+                points = [(last_lon, last_lat)] if last_timestamp else []
+                points.extend(way_point[2:] for way_point in way_points)
+                km += path_length_km(points)
+            else:
+                km = path_length_km(self._points(route_id))
+            last = self._conn.execute(
+                "SELECT timestamp, lon, lat FROM routes WHERE route_id = ?"
+                " ORDER BY timestamp DESC LIMIT 1;",
+                (route_id,),
+            ).fetchone()
+            self._conn.execute(
+                "UPDATE route_lengths SET route_length = ?, last_timestamp = ?,"
+                " last_lon = ?, last_lat = ? WHERE route_id = ?;",
+                (km,) + last + (route_id,),
+            )
+        return inserted
+
+    def way_points(self, route_id, chunk_size):
+        # Pages by timestamp instead of holding a cursor open across chunks:
+        # the connection is shared, and its commits would reset the cursor
+        last_timestamp = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT timestamp, lon, lat FROM routes"
+                    " WHERE route_id = ? AND timestamp > ?"
+                    " ORDER BY timestamp LIMIT ?;",
+                    (route_id, last_timestamp, chunk_size),
+                ).fetchall()
+            if not rows:
+                return
+            last_timestamp = rows[-1][0]
+            yield [
+                (datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT), lon, lat)
+                for timestamp, lon, lat in rows
+            ]
+
+    def _points(self, route_id):
+        return self._conn.execute(
+            "SELECT lon, lat FROM routes WHERE route_id = ? ORDER BY timestamp;",
+            (route_id,),
+        ).fetchall()
+
+    def route_length(self, route_id):
+        with self._lock:
+            route = self._route(route_id)
+        if route is None or route[2] is None:
+            return None
+        return route[1]
+
+    def route_lengths(self, route_ids, chunk_size):
+        # Older SQLite builds bind at most 999 parameters per statement
+        chunk_size = min(chunk_size, 500)
+        for start in range(0, len(route_ids), chunk_size):
+            chunk = route_ids[start:start + chunk_size]
+            with self._lock:
+                stored = self._conn.execute(
+                    "SELECT route_id, route_length, last_timestamp FROM route_lengths"
+                    " WHERE route_id IN ({});".format(",".join("?" * len(chunk))),
+                    chunk,
+                ).fetchall()
+            kms = {
+                route_id: km if last_timestamp is not None else None
+                for route_id, km, last_timestamp in stored
+            }
+            yield [(route_id, kms.get(route_id), route_id in kms) for route_id in chunk]
+
+    def full_scan_route_length(self, route_id):
+        with self._lock:
+            return path_length_km(self._points(route_id))
+
+    def route_has_way_points(self, route_id):
+        with self._lock:
+            return (
+                self._conn.execute(
+                    "SELECT 1 FROM routes WHERE route_id = ? LIMIT 1;", (route_id,)
+                ).fetchone()
+                is not None
+            )
+
+    def longest_route_in_day(self, query_date):
+        day = datetime.datetime.strptime(query_date, "%Y-%m-%d").date()
+        with self._lock:
+            longest = self._conn.execute(
+                "SELECT route_id, route_length FROM route_lengths"
+                " WHERE creation_time >= ? AND creation_time < ?"
+                " AND last_timestamp IS NOT NULL"
+                " ORDER BY route_length DESC LIMIT 1;",
+                (day.isoformat(), (day + datetime.timedelta(days=1)).isoformat()),
+            ).fetchone()
+        return tuple(longest) if longest else None
+
+    def longest_routes(self, first_day, last_day, k):
+        bounds = (
+            first_day.isoformat(),
+            (last_day + datetime.timedelta(days=1)).isoformat(),
+        )
+        with self._lock:
+            longest = self._conn.execute(
+                "SELECT route_id, substr(creation_time, 1, 10), route_length"
+                " FROM route_lengths"
+                " WHERE creation_time >= ? AND creation_time < ?"
+                " AND last_timestamp IS NOT NULL"
+                " ORDER BY route_length DESC, route_id LIMIT ?;",
+                bounds + (k,),
+            ).fetchall()
+            # SQLite returns the other columns of the row with the max() value
+            longest_per_day = self._conn.execute(
+                "SELECT substr(creation_time, 1, 10) AS day, route_id,"
+                " max(route_length) FROM route_lengths"
+                " WHERE creation_time >= ? AND creation_time < ?"
+                " AND last_timestamp IS NOT NULL"
+                " GROUP BY day ORDER BY day;",
+                bounds,
+            ).fetchall()
+        return (
+            [
+                (route_id, datetime.datetime.strptime(day, "%Y-%m-%d").date(), km)
+                for route_id, day, km in longest
+            ],
+            [
+                (datetime.datetime.strptime(day, "%Y-%m-%d").date(), route_id, km)
+                for day, route_id, km in longest_per_day
+            ],
+        )
+
+    def recent_longest_routes(self, days):
+        # SQLite returns the other columns of the row with the max() value
+        with self._lock:
+            recent_days = self._conn.execute(
+                "SELECT substr(creation_time, 1, 10) AS day, route_id,"
+                " max(route_length) FROM route_lengths"
+                " WHERE creation_time < ? AND last_timestamp IS NOT NULL"
+                " GROUP BY day ORDER BY day DESC LIMIT ?;",
+                (utc_today().isoformat(), days),
+            ).fetchall()
+        return [
+            (datetime.datetime.strptime(day, "%Y-%m-%d").date(), route_id, km)
+            for day, route_id, km in recent_days
+        ]
+
+    def finalize_days(self, wait=False):
+        return None
+
+    def compact_days(self):
+        return None
+
+
+def get_storage():
+    """Returns the STORAGE_BACKEND of the current process, opening it on first use
+
+    Returns:
+        PostgresStorage, MemoryStorage or SQLiteStorage
+
+    """
+    global _STORAGE
+    current = _STORAGE
+    if current is not None and current.pid == os.getpid():
+        return current
+    with _STORAGE_LOCK:
+        if _STORAGE is None or _STORAGE.pid != os.getpid():
+            if STORAGE_BACKEND == "memory":
+                _STORAGE = MemoryStorage()
+            elif STORAGE_BACKEND == "sqlite":
+                _STORAGE = SQLiteStorage(SQLITE_PATH)
+            elif STORAGE_BACKEND == "postgres":
+                _STORAGE = PostgresStorage()
+            else:
+                raise ValueError(
+                    "Unknown STORAGE_BACKEND {!r}".format(STORAGE_BACKEND)
+                )
+            _STORAGE.pid = os.getpid()
+        return _STORAGE
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""tasks.py contains the maintenance jobs that run outside the request path.
+
+Under uWSGI the jobs are registered with the cron of the master process by
+register_uwsgi_cron(), which wsgi.py calls, so each job runs once per
+schedule in a single worker. They can also be run by hand.
+
+Example:
+    $ python tasks.py finalize_previous_days
+    $ python tasks.py maintain_route_partitions
+    $ python tasks.py compact_finalized_days
+
+Constants:
+    ROUTES_PARTITIONS_AHEAD (int): daily routes partitions kept created
+        ahead of today
+    ROUTES_RETENTION_DAYS (int): partitions of days older than this are
+        detached, 0 keeps every day
+    ROUTES_RETENTION_DROP (bool): drop detached partitions instead of
+        keeping them as standalone tables
+
+"""
+import datetime
+import logging
+import os
+import sys
+
+import controller
+import models
+import storage
+
+try:
+    import uwsgidecorators
+except ImportError:  # not running under uWSGI
+    uwsgidecorators = None
+
+LOGGER = logging.getLogger(__name__)
+
+ROUTES_PARTITIONS_AHEAD = int(os.environ.get("ROUTES_PARTITIONS_AHEAD", 7))
+ROUTES_RETENTION_DAYS = int(os.environ.get("ROUTES_RETENTION_DAYS", 0))
+ROUTES_RETENTION_DROP = os.environ.get("ROUTES_RETENTION_DROP", "") == "true"
+
+
+def maintain_route_partitions():
+    """Creates the upcoming routes partitions and applies the retention policy
+
+    Only the postgres storage backend is partitioned.
+
+    Returns:
+        dict: the 'created' and 'detached' partition names
+    """
+    if storage.STORAGE_BACKEND != "postgres":
+        return {"created": [], "detached": []}
+    created = models.create_route_partitions(ROUTES_PARTITIONS_AHEAD)
+    detached = []
+    if ROUTES_RETENTION_DAYS:
+        before = datetime.date.today() - datetime.timedelta(days=ROUTES_RETENTION_DAYS)
+        detached = models.detach_route_partitions(before, drop=ROUTES_RETENTION_DROP)
+    LOGGER.info("Created partitions %s, detached partitions %s", created, detached)
+    return {"created": created, "detached": detached}
+
+
+def finalize_previous_days():
+    """Finalizes the route lengths and longest route of every finished day
+
+    Only one worker (or process) does the work. It waits for the
+    finalization lock, which replays of earlier days hold while they write
+    (see querys.REPLAY_ROUTE_BATCH), so an in-flight replay can not make it
+    skip a day; a finalization that ran meanwhile leaves nothing to do. The
+    finalized days are loaded into the shared longest-route cache.
+
+    Returns:
+        tuple: the (first_day, last_day) finalized, or None
+    """
+    finalized = storage.get_storage().finalize_days(wait=True)
+    LOGGER.info("Finalized days %s", finalized)
+    if finalized:
+        first_day, last_day = finalized
+        days = (last_day - first_day).days + 1
+        controller.warm_long_route_cache(
+            min(days, controller.LONGEST_ROUTE_CACHE_WARM_DAYS)
+        )
+    return finalized
+
+
+def compact_finalized_days():
+    """Folds the waypoints of every finalized route into one LineString row
+
+    Runs after finalize_previous_days(), and only compacts days that job has
+    finalized. Only the postgres storage backend keeps a row per waypoint.
+
+    Returns:
+        tuple: the (first_day, last_day) compacted, or None
+    """
+    compacted = storage.get_storage().compact_days()
+    LOGGER.info("Compacted days %s", compacted)
+    return compacted
+
+
+# (minute, hour, job) of every job run by the uWSGI cron
+SCHEDULE = (
+    (1, 0, finalize_previous_days),
+    (5, 0, maintain_route_partitions),
+    (15, 0, compact_finalized_days),
+)
+
+
+def register_uwsgi_cron():
+    """Registers the SCHEDULE with the uWSGI master's cron
+
+    Returns:
+        bool: True if running under uWSGI and the jobs were registered
+    """
+    if uwsgidecorators is None:
+        return False
+    for minute, hour, job in SCHEDULE:
+        uwsgidecorators.cron(minute, hour, -1, -1, -1)(_cron_handler(job))
+    return True
+
+
+def _cron_handler(job):
+    def handler(signum):
+        try:
+            job()
+        except Exception:
+            LOGGER.exception("Scheduled job %s failed", job.__name__)
+
+    handler.__name__ = job.__name__
+    return handler
+
+
+if __name__ == "__main__":
+    JOBS = {job.__name__: job for _, _, job in SCHEDULE}
+    if len(sys.argv) != 2 or sys.argv[1] not in JOBS:
+        sys.exit("usage: python tasks.py {}".format("|".join(sorted(JOBS))))
+    print(JOBS[sys.argv[1]]())
@@ -16,15 +16,33 @@ Example:
             to be created in the route_lengths table of the service
         ROUTE_ADD_WAY_POINT_ENDPOINT (str): POSTs to this endpoint will
             add the latitude and longitude coordinates to the service routes table
+        ROUTE_ADD_WAY_POINTS_ENDPOINT (str): POSTs of a list of coordinates to
+            this endpoint will add all of them to the routes table at once
         ROUTE_LENGTH_ENDPOINT (str): GETs to this endpoint formatted with a
             route_id (str) will return the length of the route_id
         ROUTE_LONGEST_ROUTE_IN_DAY_ENDPOINT (str): GETs to this endpoint
             formatted with a query_date (str) %Y-%m-%d will return the
             route_id and its length of the longest route in the query_date.
+        ROUTE_LENGTHS_ENDPOINT (str): GETs or POSTs of many route_ids to
+            this endpoint will return the lengths of all of them
+        LONGEST_ROUTES_ENDPOINT (str): GETs to this endpoint with from, to
+            and k will return the k longest routes of those days
+        ASYNC_SERVICE_ENDPOINT (str): the aiohttp app of asyncapp.py is
+            running here. Its tests are skipped if it is not.
+        DB_HOST (str): the database of the service, for the tests that run
+            the maintenance jobs of models.py against it directly. They are
+            skipped if it can not be reached.
 
 """
+import concurrent.futures
 import datetime
+import os
 import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
 import time
 import unittest
 import timeit
@@ -36,10 +54,20 @@ SERVICE_ENDPOINT = "http://localhost:5000/"
 BOOTSTRAP_ENDPOINT = "{}initialize_db/".format(SERVICE_ENDPOINT)
 ROUTE_ENDPOINT = "{}route/".format(SERVICE_ENDPOINT)
 ROUTE_ADD_WAY_POINT_ENDPOINT = "{}{}/way_point/".format(ROUTE_ENDPOINT, "{}")
+ROUTE_ADD_WAY_POINTS_ENDPOINT = "{}{}/way_points/".format(ROUTE_ENDPOINT, "{}")
 ROUTE_LENGTH_ENDPOINT = "{}{}/length/".format(ROUTE_ENDPOINT, "{}")
 ROUTE_LONGEST_ROUTE_IN_DAY_ENDPOINT = "{}longest-route/{}".format(
     SERVICE_ENDPOINT, "{}"
 )
+ROUTE_LENGTHS_ENDPOINT = "{}routes/lengths".format(SERVICE_ENDPOINT)
+LONGEST_ROUTES_ENDPOINT = "{}longest-routes".format(SERVICE_ENDPOINT)
+METRICS_ENDPOINT = "{}metrics".format(SERVICE_ENDPOINT)
+EXPORT_ENDPOINT = "{}export/{}/".format(SERVICE_ENDPOINT, "{}")
+ASYNC_SERVICE_ENDPOINT = "http://localhost:5001/"
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+
+# The first waypoint of the bootstrap route, Tampa on 1984-01-28 00:00:00 UTC
+BOOTSTRAP_WAY_POINT = (-82.45843, 27.94752, 444096000.0)
 
 
 class TestRoute(unittest.TestCase):
@@ -77,6 +105,264 @@ class TestRoute(unittest.TestCase):
         length = length_get.json()
         self.assertTrue(11750 < length["km"] < 11900)
 
+    def test_gps_tracker_service_batch(self):
+        """
+        Same as test_gps_tracker_service, but the waypoints are sent in one
+        batch. The service reports how many of them were stored.
+        """
+        route_id = self._start_new_route()
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=self.wgs84_coordinates,
+        )
+        self.assertEqual(response.status_code, 201)
+        counts = response.json()
+        self.assertEqual(counts["received"], len(self.wgs84_coordinates))
+        self.assertEqual(counts["inserted"], len(self.wgs84_coordinates))
+        length = self._get_route_id_length(route_id)
+        self.assertTrue(11750 < length["km"] < 11900)
+
+    def test_packed_way_points(self):
+        """
+        The same batch, sent as packed (timestamp, lon, lat) records with
+        server-side timestamps, gives the same route length.
+        """
+        route_id = self._start_new_route()
+        body = b"".join(
+            struct.pack("<3d", float("nan"), point["lon"], point["lat"])
+            for point in self.wgs84_coordinates
+        )
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            data=body,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["inserted"], len(self.wgs84_coordinates))
+        length = self._get_route_id_length(route_id)
+        self.assertTrue(11750 < length["km"] < 11900)
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            data=body[:-1],
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_duplicate_way_points(self):
+        """
+        Sending a batch twice stores it once. The second time, nothing is
+        new, which is not an error for a route of today.
+        """
+        route_id = self._start_new_route()
+        now = time.time()
+        way_points = [
+            dict(point, timestamp=now - now % (24 * 60 * 60) + offset)
+            for offset, point in enumerate(self.wgs84_coordinates)
+        ]
+        for inserted in (len(way_points), 0):
+            response = requests.post(
+                ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id), json=way_points
+            )
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json()["inserted"], inserted)
+
+    def test_unrepresentable_timestamp(self):
+        """
+        A timestamp too far in the future for the service to store is
+        answered with 400.
+        """
+        route_id = self._start_new_route()
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=[{"timestamp": 1e300, "lon": 13.404954, "lat": 52.520008}],
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_back_dated_way_points(self):
+        """
+        Waypoints stamped by the device do not reopen a route of a previous
+        day, such as the bootstrap route 0 of 1984-01-28.
+        """
+        back_dated = datetime.datetime(1984, 1, 28, 12) - datetime.datetime(1970, 1, 1)
+        body = struct.pack("<3d", back_dated.total_seconds(), -82.45843, 27.94752)
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(0),
+            data=body,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        self.assertEqual(response.status_code, 403)
+        response = requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(0),
+            json=[
+                {
+                    "timestamp": back_dated.total_seconds(),
+                    "lon": -82.45843,
+                    "lat": 27.94752,
+                }
+            ],
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_way_points(self):
+        """
+        The waypoints of a route are read back in the order they were sent,
+        as GeoJSON and as NDJSON.
+        """
+        route_id = self._start_new_route()
+        requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=self.wgs84_coordinates,
+        )
+        response = requests.get(ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id))
+        self.assertEqual(response.status_code, 200)
+        features = response.json()["features"]
+        coordinates = [feature["geometry"]["coordinates"] for feature in features]
+        self.assertEqual(
+            coordinates,
+            [[point["lon"], point["lat"]] for point in self.wgs84_coordinates],
+        )
+        response = requests.get(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id), params={"format": "ndjson"}
+        )
+        self.assertEqual(len(response.text.splitlines()), len(self.wgs84_coordinates))
+
+    def test_encoded_polyline(self):
+        """
+        A route is read back as an encoded polyline, and simplified to its
+        end points with a tolerance larger than the route.
+        """
+        route_id = self._start_new_route()
+        requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=self.wgs84_coordinates,
+        )
+        encoded = requests.get(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            params={"format": "polyline"},
+        ).json()
+        self.assertEqual(encoded["points"], len(self.wgs84_coordinates))
+        self.assertTrue(encoded["polyline"].startswith("dm`zCvi~kH"))
+        simplified = requests.get(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            params={"format": "polyline", "simplify": 180},
+        ).json()
+        self.assertEqual(simplified["points"], 2)
+
+    def test_export_day(self):
+        """
+        The routes created today are in the bulk CSV export of today.
+        """
+        route_id = self._start_new_route()
+        response = requests.get(
+            EXPORT_ENDPOINT.format("route_lengths"),
+            params={"first_day": datetime.date.today().strftime("%Y-%m-%d")},
+        )
+        self.assertEqual(response.status_code, 200)
+        lines = response.text.splitlines()
+        self.assertEqual(lines[0], "route_id,creation_time,km,finalized")
+        self.assertTrue(str(route_id) in [line.split(",")[0] for line in lines[1:]])
+
+    def test_bulk_route_lengths(self):
+        """
+        The lengths of several routes are looked up in one request, and
+        route_ids that do not exist are reported as unknown.
+        """
+        route_id = self._start_new_route()
+        requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=self.wgs84_coordinates,
+        )
+        empty_route_id = self._start_new_route()
+        unknown_route_id = 2 ** 31 - 1
+        response = requests.post(
+            ROUTE_LENGTHS_ENDPOINT,
+            json=[int(route_id), int(empty_route_id), unknown_route_id],
+        )
+        self.assertEqual(response.status_code, 200)
+        lengths = response.json()
+        self.assertEqual(
+            [route["route_id"] for route in lengths["routes"]],
+            [int(route_id), int(empty_route_id)],
+        )
+        self.assertTrue(11750 < lengths["routes"][0]["km"] < 11900)
+        self.assertIsNone(lengths["routes"][1]["km"])
+        self.assertEqual(lengths["unknown"], [unknown_route_id])
+        response = requests.get(
+            ROUTE_LENGTHS_ENDPOINT, params={"route_ids": "{},x".format(route_id)}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_route_lengths_of_any_route_id(self):
+        """
+        The bootstrap route 0 is a route like any other, and route_ids out
+        of range are reported as unknown rather than failing the request.
+        """
+        response = requests.get(
+            ROUTE_LENGTHS_ENDPOINT, params={"route_ids": "0,-1,{}".format(2 ** 31)}
+        )
+        self.assertEqual(response.status_code, 200)
+        lengths = response.json()
+        self.assertEqual([route["route_id"] for route in lengths["routes"]], [0])
+        self.assertTrue(isinstance(lengths["routes"][0]["km"], float))
+        self.assertEqual(lengths["unknown"], [-1, 2 ** 31])
+
+    def test_longest_routes_of_a_week(self):
+        """
+        The leaderboard of the past week has an entry for every day, and
+        only days in the past can be queried.
+        """
+        today = datetime.date.today()
+        response = requests.get(
+            LONGEST_ROUTES_ENDPOINT,
+            params={
+                "from": (today - datetime.timedelta(days=7)).strftime("%Y-%m-%d"),
+                "to": (today - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+                "k": 3,
+            },
+        )
+        if response.status_code == 503:
+            # tasks.finalize_previous_days() has not run since yesterday
+            self.assertTrue(int(response.headers["Retry-After"]) > 0)
+            return
+        self.assertEqual(response.status_code, 200)
+        leaderboard = response.json()
+        self.assertEqual(len(leaderboard["days"]), 7)
+        self.assertTrue(len(leaderboard["routes"]) <= 3)
+        today = today.strftime("%Y-%m-%d")
+        response = requests.get(
+            LONGEST_ROUTES_ENDPOINT, params={"from": today, "to": today}
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_stored_route_length_matches_full_scan(self):
+        """
+        The route length is maintained as waypoints land. Check that it
+        agrees with a recomputation over all of the route's waypoints.
+        """
+        route_id = self._start_new_route()
+        self._push_route(route_id)
+        requests.post(
+            ROUTE_ADD_WAY_POINTS_ENDPOINT.format(route_id),
+            json=self.wgs84_coordinates,
+        )
+        response = requests.get(
+            ROUTE_LENGTH_ENDPOINT.format(route_id), params={"verify": "true"}
+        )
+        verified = response.json()
+        self.assertAlmostEqual(verified["km"], verified["recomputed_km"], places=3)
+
+    def test_create_routes_concurrently(self):
+        """
+        Route ids are allocated by the database, so routes created in
+        parallel, and served by different workers, must never share an id.
+        """
+        number_of_routes = 2000
+        with concurrent.futures.ThreadPoolExecutor(max_workers=50) as pool:
+            route_ids = list(
+                pool.map(lambda _: self._start_new_route(), range(number_of_routes))
+            )
+        self.assertEqual(len(set(route_ids)), number_of_routes)
+
     def _start_new_route(self):
         """Basic method for starting a new route_id
 
@@ -132,6 +418,29 @@ class TestRoute(unittest.TestCase):
         )
         self.assertTrue(response.status_code in [403, 404])
 
+    def test_rejected_way_point(self):
+        """
+        A waypoint for a route that does not exist is answered with 404,
+        one for a route of a previous day, the bootstrap route 0, with 403,
+        and one for a route of today names the route it was added to.
+        """
+        berlin = {"lat": 52.520008, "lon": 13.404954}
+        response = requests.post(
+            ROUTE_ADD_WAY_POINT_ENDPOINT.format(2 ** 31 - 1), json=berlin
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["Error"], "route_id does not exist!")
+        response = requests.post(ROUTE_ADD_WAY_POINT_ENDPOINT.format(0), json=berlin)
+        self.assertEqual(response.status_code, 403)
+        route_id = self._start_new_route()
+        response = requests.post(
+            ROUTE_ADD_WAY_POINT_ENDPOINT.format(route_id), json=berlin
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            response.json()["Ok"], "Updated waypoint for route_id {}".format(route_id)
+        )
+
     def test_calculate_longest_route_for_today(self):
         """
         The request will only query days in the past. Test that the service
@@ -155,16 +464,30 @@ class TestRoute(unittest.TestCase):
         expected_error_messages = [
             "The request will only query days in the past.",
             "No routes recorded for {}".format(query_date),
+            "{} is not finalized yet, retry later.".format(query_date),
         ]
         response = requests.get(ROUTE_LONGEST_ROUTE_IN_DAY_ENDPOINT.format(query_date))
         query_result = response.json()
+        if response.status_code == 503:
+            self.assertTrue(int(response.headers["Retry-After"]) > 0)
         if query_result.get("Error"):
-            self.assertTrue(response.status_code in [403, 404])
+            self.assertTrue(response.status_code in [403, 404, 503])
             self.assertTrue(query_result["Error"] in expected_error_messages)
         else:
             self.assertTrue(isinstance(query_result["km"], float))
 
 
+    def test_metrics_endpoint(self):
+        """
+        Requests and queries are timed, and /metrics reports them in the
+        Prometheus text format.
+        """
+        self._start_new_route()
+        response = requests.get(METRICS_ENDPOINT)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('endpoint="/route/"' in response.text)
+        self.assertTrue('query="start_new_route",phase="execute"' in response.text)
+
     def test_add_many_waypoints(self):
         """
         A basic test that can be extended to measure the service's tolerance
@@ -200,6 +523,590 @@ class TestRoute(unittest.TestCase):
         return {"lat": lat, "lon": lon}
 
 
+class TestAsyncRoute(unittest.TestCase):
+    """Class for testing the asyncio entry point from a client perspective"""
+
+    def _post(self, path, **kwargs):
+        try:
+            return requests.post(ASYNC_SERVICE_ENDPOINT + path, **kwargs)
+        except requests.ConnectionError as error:
+            raise unittest.SkipTest(str(error))
+
+    def test_malformed_json(self):
+        """
+        Bodies that are not JSON, or lack the expected keys, are answered
+        with 400 rather than an internal error.
+        """
+        for path in ("initialize_db/", "route/0/way_point/", "route/0/way_points/"):
+            response = self._post(
+                path, data="{", headers={"Content-Type": "application/json"}
+            )
+            self.assertEqual(response.status_code, 400)
+        response = self._post("route/0/way_point/", json={"lat": 52.520008})
+        self.assertEqual(response.status_code, 400)
+        response = self._post("initialize_db/", json=[SECRET_KEY])
+        self.assertEqual(response.status_code, 400)
+
+
+class TestMaintenance(unittest.TestCase):
+    """Class for testing the maintenance jobs of models.py on the service's db
+
+    models is imported here rather than at the top, so that the client
+    tests above run without psycopg2.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        requests.post(BOOTSTRAP_ENDPOINT, json={"key": SECRET_KEY})
+        try:
+            import models
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        models.DB_HOST = DB_HOST
+        try:
+            models.close_and_commit(*models.execute_pgscript("SELECT 1;"))
+        except models.UNAVAILABLE_ERRORS as error:
+            raise unittest.SkipTest(str(error))
+        cls.models = models
+
+    def _stored_length(self, route_id):
+        conn, cur = self.models.execute_statement("stored_route_length", (route_id,))
+        route_length = cur.fetchone()[0]
+        self.models.close_and_commit(cur, conn)
+        return route_length
+
+    def test_compacted_route(self):
+        """
+        Once the bootstrap day is finalized and compacted, its route is
+        read from compact_routes. Recomputing it keeps its length, and
+        replaying one of its waypoints stores nothing.
+        """
+        self.models.finalize_days(wait=True)
+        self.models.compact_days()
+        conn, cur = self.models.execute_pgscript(
+            "SELECT points FROM compact_routes WHERE route_id = 0;"
+        )
+        compacted = cur.fetchone()
+        self.models.close_and_commit(cur, conn)
+        self.assertEqual(compacted, (2,))
+        self.assertTrue(800 < self._stored_length(0) < 850)
+
+        self.assertEqual(self.models.recompute_route_lengths([0]), 1)
+        self.assertTrue(800 < self._stored_length(0) < 850)
+        longitude, latitude, epoch = BOOTSTRAP_WAY_POINT
+        inserted = self.models.insert_way_points(
+            0, [longitude], [latitude], [epoch], replay=True
+        )
+        self.assertEqual(inserted, 0)
+        self.assertTrue(800 < self._stored_length(0) < 850)
+
+    def test_way_point_before_a_buffered_one(self):
+        """
+        A waypoint the server stamps before a point the buffer has already
+        written recomputes the route length instead of extending it.
+        """
+        conn, cur = self.models.execute_statement("start_new_route")
+        route_id = cur.fetchone()[0]
+        self.models.close_and_commit(cur, conn)
+        epoch = time.time() + 60.0
+        self.models.insert_way_points(
+            route_id, [13.4, 13.5], [52.5, 52.5], [epoch, epoch + 1.0], replay=True
+        )
+        conn, cur = self.models.execute_statement(
+            "update_route", (route_id, 14.0, 52.5)
+        )
+        self.assertEqual(cur.fetchone(), (route_id,))
+        self.models.close_and_commit(cur, conn)
+        conn, cur = self.models.execute_statement("single_route_length", (route_id,))
+        recomputed = cur.fetchone()[0]
+        self.models.close_and_commit(cur, conn)
+        self.assertAlmostEqual(self._stored_length(route_id), recomputed, places=6)
+
+    def test_replay_of_finalized_day(self):
+        """
+        A waypoint replayed into a finalized day is dropped, so neither the
+        route length nor the longest route of that day changes.
+        """
+        self.models.finalize_days(wait=True)
+        longest = self._longest_route_of_bootstrap_day()
+        route_length = self._stored_length(0)
+        longitude, latitude, epoch = BOOTSTRAP_WAY_POINT
+        inserted = self.models.insert_way_points(
+            0, [longitude + 1.0], [latitude], [epoch + 60.0], replay=True
+        )
+        self.assertEqual(inserted, 0)
+        self.assertEqual(self._stored_length(0), route_length)
+        self.assertEqual(self._longest_route_of_bootstrap_day(), longest)
+
+    def _longest_route_of_bootstrap_day(self):
+        conn, cur = self.models.execute_pgscript(
+            "SELECT route_id, km FROM longest_route_per_day WHERE day = '1984-01-28';"
+        )
+        longest = cur.fetchone()
+        self.models.close_and_commit(cur, conn)
+        return longest
+
+    def test_finalize_days_is_idempotent(self):
+        """
+        Once the past days are finalized, finalizing again has nothing to do
+        and leaves the longest route of each day as it was.
+        """
+        self.models.finalize_days(wait=True)
+        longest = self._longest_route_of_bootstrap_day()
+        self.assertEqual(longest[0], 0)
+        self.assertIsNone(self.models.finalize_days(wait=True))
+        self.assertEqual(self._longest_route_of_bootstrap_day(), longest)
+
+    def test_days_are_only_finalized_by_the_job(self):
+        """
+        Looking up a day that is not finalized yet raises DayNotFinalized
+        instead of finalizing it; days before the first route are finalized
+        along with it and have no routes.
+        """
+        import storage
+
+        postgres = storage.PostgresStorage()
+        self.models.finalize_days(wait=True)
+        today = datetime.date.today()
+        with self.assertRaises(storage.DayNotFinalized):
+            postgres.longest_route_in_day(today.strftime("%Y-%m-%d"))
+        with self.assertRaises(storage.DayNotFinalized):
+            postgres.longest_routes(today - datetime.timedelta(days=1), today, 3)
+        self.assertEqual(postgres.longest_route_in_day("1984-01-28")[0], 0)
+        self.assertIsNone(postgres.longest_route_in_day("1984-01-27"))
+
+    def test_finalization_lock(self):
+        """
+        While one transaction holds the finalization lock, no other can take
+        it, and finalize_days() returns at once instead of waiting.
+        """
+        conn, cur = self.models.execute_pgscript(self.models.querys.LOCK_FINALIZATION)
+        try:
+            other_conn, other_cur = self.models.execute_pgscript(
+                self.models.querys.TRY_LOCK_FINALIZATION
+            )
+            taken = other_cur.fetchone()[0]
+            self.models.close_and_commit(other_cur, other_conn)
+            self.assertFalse(taken)
+            self.assertIsNone(self.models.finalize_days())
+            self.assertIsNone(self.models.compact_days())
+        finally:
+            conn.rollback()
+            self.models.release_connection(conn)
+
+class StorageBackendTests(object):
+    """Tests shared by the in-process backends of storage.py
+
+    A subclass sets up self.storage.
+    """
+
+    def _today_epochs(self, count):
+        """count epochs a second apart, from the start of today in UTC"""
+        now = time.time()
+        start = now - now % (24 * 60 * 60)
+        return [start + offset for offset in range(count)]
+
+    def _columns(self):
+        coordinates = TestRoute.wgs84_coordinates
+        return [point["lon"] for point in coordinates], [
+            point["lat"] for point in coordinates
+        ]
+
+    def test_route_length(self):
+        """
+        A batch stamped by the server gives the length of the route through
+        the points, the same as a full scan.
+        """
+        route_id, _ = self.storage.create_route()
+        self.assertIsNone(self.storage.route_length(route_id))
+        longitudes, latitudes = self._columns()
+        inserted = self.storage.add_way_points(route_id, longitudes, latitudes)
+        self.assertEqual(inserted, len(longitudes))
+        length = self.storage.route_length(route_id)
+        self.assertTrue(11750 < length < 11900)
+        self.assertAlmostEqual(
+            length, self.storage.full_scan_route_length(route_id), places=6
+        )
+
+    def test_out_of_order_replay(self):
+        """
+        Device timestamps put the points in order whatever order they were
+        written in, and replaying them stores nothing twice.
+        """
+        route_id, _ = self.storage.create_route()
+        longitudes, latitudes = self._columns()
+        epochs = self._today_epochs(len(longitudes))
+        self.storage.add_way_points(
+            route_id, longitudes[2:], latitudes[2:], epochs[2:], replay=True
+        )
+        self.storage.add_way_points(
+            route_id, longitudes[:2], latitudes[:2], epochs[:2], replay=True
+        )
+        self.assertTrue(11750 < self.storage.route_length(route_id) < 11900)
+        inserted = self.storage.add_way_points(
+            route_id, longitudes, latitudes, epochs, replay=True
+        )
+        self.assertEqual(inserted, 0)
+        self.assertAlmostEqual(
+            self.storage.route_length(route_id),
+            self.storage.full_scan_route_length(route_id),
+            places=6,
+        )
+
+    def test_unknown_route_and_unrepresentable_epoch(self):
+        """
+        Nothing is stored for an unknown route, nor for an epoch too large
+        for a datetime.
+        """
+        self.assertEqual(self.storage.add_way_points(999999, [13.4], [52.5]), 0)
+        route_id, _ = self.storage.create_route()
+        self.assertEqual(
+            self.storage.add_way_points(route_id, [13.4], [52.5], [1e300]), 0
+        )
+        self.assertFalse(self.storage.route_has_way_points(route_id))
+        chunks = list(self.storage.route_lengths([route_id, 999999], 1))
+        self.assertEqual(chunks, [[(route_id, None, True)], [(999999, None, False)]])
+
+
+class TestMemoryStorage(StorageBackendTests, unittest.TestCase):
+    """Class for testing storage.MemoryStorage"""
+
+    def setUp(self):
+        try:
+            import storage
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.storage = storage.MemoryStorage()
+
+
+class TestSQLiteStorage(StorageBackendTests, unittest.TestCase):
+    """Class for testing storage.SQLiteStorage on a temporary file"""
+
+    def setUp(self):
+        try:
+            import storage
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.directory = tempfile.mkdtemp()
+        self.storage = storage.SQLiteStorage(
+            os.path.join(self.directory, "test.sqlite3")
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Class for running the database benchmarks of benchmark.py on small data
+
+    They build and drop their own scratch database on DB_HOST.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import models
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        try:
+            models.psycopg2.connect(
+                host=DB_HOST,
+                port=models.DB_PORT,
+                dbname=models.PERSISTENCE_PROVIDER,
+                user=models.DB_USER,
+                password=models.DB_PASS,
+                connect_timeout=models.DB_CONNECT_TIMEOUT,
+            ).close()
+        except models.UNAVAILABLE_ERRORS as error:
+            raise unittest.SkipTest(str(error))
+
+    def _run_benchmark(self, *args):
+        """
+        Returns:
+            str: the output of python benchmark.py args
+        """
+        finished = subprocess.run(
+            [sys.executable, "benchmark.py"] + list(args),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        self.assertEqual(finished.returncode, 0, finished.stdout)
+        return finished.stdout
+
+    def test_explain(self):
+        """
+        The hot queries run on the schema before the migrations and after
+        them, and each is reported.
+        """
+        output = self._run_benchmark(
+            "explain",
+            "--db-host",
+            DB_HOST,
+            "--routes",
+            "40",
+            "--points-per-route",
+            "10",
+            "--days",
+            "4",
+        )
+        for name in ("ROUTE_ID_HAS_WAYPOINTS", "SINGLE_ROUTE_LENGTH"):
+            self.assertTrue(name in output, output)
+
+
+class TestLengths(unittest.TestCase):
+    """Class for testing the NumPy route lengths of lengths.py"""
+
+    def setUp(self):
+        try:
+            import lengths
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.lengths = lengths
+
+    def test_known_distances(self):
+        """
+        On the sphere of ST_DistanceSphere, a degree of the equator is
+        111.19468 km and a quarter meridian 10007.521 km. A route's length
+        is the sum of its legs, and a route of a single waypoint has none.
+        """
+        route_ids, kms = self.lengths.route_lengths(
+            [7, 7, 7, 8, 8, 9], [0.0, 1.0, 2.0, 0.0, 0.0, 13.4], [0, 0, 0, 0, 90, 52.5]
+        )
+        self.assertEqual(route_ids.tolist(), [7, 8, 9])
+        self.assertAlmostEqual(kms[0], 2 * 111.19468, places=3)
+        self.assertAlmostEqual(kms[1], 10007.521, places=3)
+        self.assertEqual(kms[2], 0.0)
+        route_ids, kms = self.lengths.route_lengths_of_rows([])
+        self.assertEqual((len(route_ids), len(kms)), (0, 0))
+
+    def test_matches_scalar_distance(self):
+        """
+        The vectorized lengths agree with sphere_distance_km(), the distance
+        the memory and sqlite backends sum one waypoint at a time.
+        """
+        points = [
+            (point["lon"], point["lat"]) for point in TestRoute.wgs84_coordinates
+        ]
+        expected = sum(
+            self.lengths.sphere_distance_km(*(start + end))
+            for start, end in zip(points, points[1:])
+        )
+        longitudes, latitudes = zip(*points)
+        _, kms = self.lengths.route_lengths([1] * len(points), longitudes, latitudes)
+        self.assertAlmostEqual(kms[0], expected, places=9)
+        self.assertTrue(11750 < kms[0] < 11900)
+
+
+class TestCaches(unittest.TestCase):
+    """Class for testing the process-local caches of cache.py and controller.py"""
+
+    def setUp(self):
+        try:
+            import cache
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.cache = cache
+
+    def test_local_lru_cache(self):
+        """
+        The least recently used entry is evicted beyond max_items, expired
+        entries are misses, and the counters add up.
+        """
+        lru = self.cache.get_cache("test", 2)
+        lru.set("a", "1")
+        lru.set("b", "2")
+        self.assertEqual(lru.get("a"), "1")
+        lru.set("c", "3")
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("c"), "3")
+        lru.set("d", "4", expires=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(lru.get("d"))
+        stats = lru.stats()
+        self.assertEqual(
+            (stats["hits"], stats["misses"], stats["evictions"], stats["items"]),
+            (2, 2, 2, 1),
+        )
+
+    def test_stats_keys_of_both_backends(self):
+        """
+        The shared uWSGI cache reports the same stats as the local LRU, with
+        None for the evictions uWSGI does not count.
+        """
+
+        class FakeUWSGI(object):
+            def __init__(self):
+                self.caches = {}
+
+            def cache_get(self, key, name):
+                return self.caches.get(name, {}).get(key)
+
+            def cache_update(self, key, value, expires, name):
+                self.caches.setdefault(name, {})[key] = value
+
+            def cache_inc(self, key, value, expires, name):
+                cache = self.caches.setdefault(name, {})
+                cache[key] = cache.get(key, 0) + value
+
+            def cache_num(self, key, name):
+                return self.caches.get(name, {}).get(key, 0)
+
+            def cache_keys(self, name):
+                return list(self.caches.get(name, {}))
+
+        uwsgi, self.cache.uwsgi = self.cache.uwsgi, FakeUWSGI()
+        try:
+            shared = self.cache.UWSGICache("test", 2)
+            shared.set("a", "1")
+            shared.set("a", "2")
+            self.assertEqual(shared.get("a"), "2")
+            self.assertIsNone(shared.get("b"))
+            stats = shared.stats()
+        finally:
+            self.cache.uwsgi = uwsgi
+        self.assertEqual(
+            set(stats), set(self.cache.LocalLRUCache("test", 2).stats())
+        )
+        self.assertEqual(
+            (stats["hits"], stats["misses"], stats["evictions"], stats["items"]),
+            (1, 1, None, 1),
+        )
+
+    def test_route_meta_and_longest_route_caches(self):
+        """
+        Routes cached with a creation time before today are stale without a
+        query, and cached longest routes read back as they were stored.
+        """
+        try:
+            import controller
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        controller.cache_route_creation_date(2 ** 31 - 2, yesterday)
+        controller.cache_route_creation_date(2 ** 31 - 3, datetime.datetime.now())
+        self.assertTrue(controller.is_cached_route_stale(2 ** 31 - 2))
+        self.assertFalse(controller.is_cached_route_stale(2 ** 31 - 3))
+        self.assertFalse(controller.is_cached_route_stale(2 ** 31 - 4))
+        controller.update_long_route_cache("1984-01-28", (0, 825.5))
+        controller.update_long_route_cache("1984-01-29", None)
+        self.assertEqual(
+            controller.cached_longest_route_in_day("1984-01-28"), [0, 825.5]
+        )
+        self.assertEqual(controller.cached_longest_route_in_day("1984-01-29"), [])
+        self.assertIsNone(controller.cached_longest_route_in_day("1984-01-30"))
+
+
+class TestWaypointBuffer(unittest.TestCase):
+    """Class for testing the write-behind buffer of ingest.py"""
+
+    def setUp(self):
+        try:
+            import ingest
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.ingest = ingest
+
+    def test_flush_and_stats(self):
+        """
+        Queued waypoints are written per route, in the order queued. The
+        points of a route that fails are dropped, and the counters add up.
+        """
+        written = {}
+
+        def write(route_id, epochs, longitudes, latitudes):
+            if route_id == 2:
+                raise ValueError("timestamp out of range")
+            written.setdefault(route_id, []).extend(epochs)
+            return len(epochs)
+
+        buffer = self.ingest.WaypointBuffer(10, 2, 0.05, write)
+        self.assertTrue(buffer.put(1, 10.0, 13.4, 52.5))
+        self.assertTrue(buffer.put(1, 11.0, 13.5, 52.6))
+        self.assertTrue(buffer.put(2, 10.0, 0.0, 0.0))
+        buffer.close()
+        self.assertFalse(buffer.put(1, 12.0, 13.6, 52.7))
+        self.assertEqual(written, {1: [10.0, 11.0]})
+        self.assertEqual(
+            buffer.stats(), {"queued": 3, "flushed": 2, "dropped": 1, "backlog": 0}
+        )
+
+
+class TestWaypointSpool(unittest.TestCase):
+    """Class for testing the memory-mapped waypoint spool of spool.py"""
+
+    def setUp(self):
+        try:
+            import spool
+        except ImportError as error:
+            raise unittest.SkipTest(str(error))
+        self.spool = spool
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_reopen(self):
+        """
+        Appends are all or nothing within the capacity, and the records
+        survive reopening the file.
+        """
+        waypoint_spool = self.spool.WaypointSpool(self.path, 3)
+        self.assertTrue(
+            waypoint_spool.append([(1, 10.0, 13.4, 52.5), (1, 11.0, 13.5, 52.6)])
+        )
+        self.assertFalse(
+            waypoint_spool.append([(2, 10.0, 0.0, 0.0), (2, 11.0, 0.0, 0.0)])
+        )
+        self.assertEqual(len(waypoint_spool), 2)
+        waypoint_spool.close()
+        reopened = self.spool.WaypointSpool(self.path, 3)
+        self.assertEqual(len(reopened), 2)
+        reopened.close()
+
+    def test_replay_drops_failing_route(self):
+        """
+        A route whose write fails for good is dropped, the other routes are
+        written in timestamp order and the spool is emptied.
+        """
+        waypoint_spool = self.spool.WaypointSpool(self.path, 10)
+        waypoint_spool.append([(2, 11.0, 13.5, 52.6), (1, 10.0, 0.0, 0.0)])
+        waypoint_spool.append([(2, 10.0, 13.4, 52.5)])
+        written = {}
+
+        def write(route_id, epochs, longitudes, latitudes):
+            if route_id == 1:
+                raise ValueError("timestamp out of range")
+            written[route_id] = epochs
+            return len(epochs)
+
+        self.assertEqual(waypoint_spool.replay(write), 3)
+        self.assertEqual(written, {2: [10.0, 11.0]})
+        self.assertEqual(len(waypoint_spool), 0)
+        waypoint_spool.close()
+
+    def test_replay_keeps_routes_while_unavailable(self):
+        """
+        While the database is unavailable, the routes not written yet stay
+        in the spool and the error is raised for the replay to be retried.
+        """
+        waypoint_spool = self.spool.WaypointSpool(self.path, 10)
+        waypoint_spool.append([(1, 10.0, 0.0, 0.0), (2, 10.0, 0.0, 0.0)])
+
+        def write(route_id, epochs, longitudes, latitudes):
+            if route_id == 2:
+                raise self.spool.models.UNAVAILABLE_ERRORS[0]("db is down")
+            return len(epochs)
+
+        with self.assertRaises(self.spool.models.UNAVAILABLE_ERRORS):
+            waypoint_spool.replay(write)
+        self.assertEqual(len(waypoint_spool), 1)
+        self.assertEqual(waypoint_spool.replay(lambda *way_points: 1), 1)
+        self.assertEqual(len(waypoint_spool), 0)
+        waypoint_spool.close()
+
 
 if __name__ == '__main__':
     unittest.main()
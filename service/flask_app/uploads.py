@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""uploads.py decodes batches of waypoints POSTed in compact encodings.
+
+POST /route/<int:route_id>/way_points/ takes a JSON list of coordinates by
+default. High-rate trackers can send the same batch in one of these content
+types instead, which skip JSON parsing and are a fraction of its size:
+
+    application/octet-stream
+        Packed little-endian records of three float64, 24 bytes per
+        waypoint, with no header:
+
+            offset 0   timestamp  seconds since the unix epoch (UTC), or NaN
+                                  to have the server stamp the waypoint
+            offset 8   lon        WGS84 degrees
+            offset 16  lat        WGS84 degrees
+
+        e.g. struct.pack("<3d", 1567296000.0, 13.40, 52.52) per waypoint.
+
+    application/msgpack (or application/x-msgpack)
+        A MessagePack map of columns, {"lon": ..., "lat": ...} with an
+        optional "timestamp" column. Each column is either a bin of packed
+        little-endian float64, like above, or an array of numbers (a nil
+        timestamp is stamped by the server). An array of {"lat": ...,
+        "lon": ...} maps, the JSON schema, is accepted as well.
+
+    application/x-polyline
+        An encoded polyline (see polyline.py), with ?precision decimal
+        places (default 5). The server stamps the waypoints in order.
+
+Packed arrays and bin columns are read with numpy.frombuffer(), which views
+the request body in place rather than copying it into Python objects.
+
+Timestamps do not lift the rule that routes only take waypoints on the day
+they are created: a route of an earlier day is answered with 403, and
+waypoints stamped with another day than the route's are not stored.
+
+Example:
+    $ longitudes, latitudes, epochs = uploads.decode_way_points(
+          "application/octet-stream", body)
+
+"""
+import json
+
+import msgpack
+import numpy as np
+
+import polyline
+
+PACKED_CONTENT_TYPE = "application/octet-stream"
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+POLYLINE_CONTENT_TYPE = "application/x-polyline"
+
+CONTENT_TYPES = (PACKED_CONTENT_TYPE, POLYLINE_CONTENT_TYPE) + MSGPACK_CONTENT_TYPES
+
+# One waypoint of the packed format
+WAY_POINT_DTYPE = np.dtype([("timestamp", "<f8"), ("lon", "<f8"), ("lat", "<f8")])
+
+# 9999-12-31 23:59:59 UTC, the last second a datetime can hold
+MAX_EPOCH = 253402300799.0
+
+MISSING_COORDINATES = "Every waypoint needs a numeric lat and lon."
+
+
+def decode_packed(body):
+    """Views packed (timestamp, lon, lat) records without copying them
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, numpy.ndarray: the longitudes, the
+            latitudes and the epochs, NaN where the server stamps
+    """
+    if len(body) % WAY_POINT_DTYPE.itemsize:
+        raise ValueError(
+            "The body must be a whole number of {} byte waypoints.".format(
+                WAY_POINT_DTYPE.itemsize
+            )
+        )
+    records = np.frombuffer(body, dtype=WAY_POINT_DTYPE)
+    return records["lon"], records["lat"], records["timestamp"]
+
+
+def decode_records(way_points):
+    """Reads a list of {"lat": ..., "lon": ...} dicts, the JSON schema
+
+    A waypoint may carry a "timestamp" in seconds since the unix epoch.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, numpy.ndarray: the longitudes, the
+            latitudes and the epochs, NaN where the server stamps
+    """
+    if not isinstance(way_points, list) or not way_points:
+        raise ValueError("Expected a list of coordinates.")
+    columns = np.empty((3, len(way_points)))
+    try:
+        for index, way_point in enumerate(way_points):
+            timestamp = way_point.get("timestamp")
+            columns[:, index] = (
+                way_point["lon"],
+                way_point["lat"],
+                np.nan if timestamp is None else timestamp,
+            )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError(MISSING_COORDINATES)
+    return columns[0], columns[1], columns[2]
+
+
+def decode_column(column):
+    """
+    Returns:
+        numpy.ndarray: of float64, a view of column if it is packed bytes
+    """
+    if isinstance(column, bytes):
+        if len(column) % 8:
+            raise ValueError("A bin column must be packed little-endian float64.")
+        return np.frombuffer(column, dtype="<f8")
+    if not isinstance(column, list):
+        raise ValueError("A column must be a bin or an array of numbers.")
+    try:
+        return np.array(
+            [np.nan if value is None else value for value in column], dtype=np.float64
+        )
+    except (TypeError, ValueError):
+        raise ValueError("A column must be a bin or an array of numbers.")
+
+
+def decode_msgpack(body):
+    """Reads a MessagePack map of columns, or an array of waypoint maps
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, numpy.ndarray: the longitudes, the
+            latitudes and the epochs, NaN where the server stamps
+    """
+    try:
+        unpacked = msgpack.unpackb(body, raw=False)
+    except Exception:
+        raise ValueError("The body is not valid MessagePack.")
+    if isinstance(unpacked, list):
+        return decode_records(unpacked)
+    if not isinstance(unpacked, dict) or "lon" not in unpacked or "lat" not in unpacked:
+        raise ValueError(MISSING_COORDINATES)
+    longitudes = decode_column(unpacked["lon"])
+    latitudes = decode_column(unpacked["lat"])
+    if "timestamp" in unpacked:
+        epochs = decode_column(unpacked["timestamp"])
+    else:
+        epochs = np.full(len(longitudes), np.nan)
+    if not len(longitudes) == len(latitudes) == len(epochs):
+        raise ValueError("The lon, lat and timestamp columns differ in length.")
+    return longitudes, latitudes, epochs
+
+
+def decode_way_points(content_type, body, precision=5):
+    """Decodes a batch of waypoints in any of the accepted content types
+
+    Args:
+        content_type (str): the mimetype of the request, JSON if it is not
+            one of CONTENT_TYPES
+        body (bytes): the request body
+        precision (int): decimal places of an encoded polyline
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, numpy.ndarray: the longitudes, the
+            latitudes and the epochs, NaN where the server stamps
+
+    Raises:
+        ValueError: with a message for the client, if the body is malformed
+    """
+    if content_type == PACKED_CONTENT_TYPE:
+        longitudes, latitudes, epochs = decode_packed(body)
+    elif content_type in MSGPACK_CONTENT_TYPES:
+        longitudes, latitudes, epochs = decode_msgpack(body)
+    elif content_type == POLYLINE_CONTENT_TYPE:
+        longitudes, latitudes = polyline.decode_polyline(body.strip(), precision)
+        epochs = np.full(len(longitudes), np.nan)
+    else:
+        try:
+            way_points = json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise ValueError("Expected a list of coordinates.")
+        longitudes, latitudes, epochs = decode_records(way_points)
+    if not len(longitudes):
+        raise ValueError("Expected a list of coordinates.")
+    if not (np.isfinite(longitudes).all() and np.isfinite(latitudes).all()):
+        raise ValueError(MISSING_COORDINATES)
+    # NaN, stamped by the server, compares False
+    if ((epochs < 0) | (epochs > MAX_EPOCH)).any():
+        raise ValueError(
+            "A timestamp must be between 0 and {:.0f} seconds.".format(MAX_EPOCH)
+        )
+    return longitudes, latitudes, epochs
+
+
+def as_lists(longitudes, latitudes, epochs):
+    """Converts a decoded batch for storage.add_way_points()
+
+    Returns:
+        list, list, list: the longitudes, the latitudes and the epochs, with
+            None where the server stamps, or None for the epochs if it
+            stamps every waypoint
+    """
+    stamped = ~np.isnan(epochs)
+    if not stamped.any():
+        epochs = None
+    else:
+        epochs = [
+            epoch if is_stamped else None
+            for epoch, is_stamped in zip(epochs.tolist(), stamped.tolist())
+        ]
+    return longitudes.tolist(), latitudes.tolist(), epochs
@@ -12,22 +12,23 @@ Example:
         $ cd .. && docker-compose up
 
 """
+import collections
 import datetime
 import json
 import logging
-import sys
+import timeit
 
-from flask import Flask, request
+from flask import Flask, Response, g, request
 
 import controller
-import models
+import export
+import logs
+import metrics
+import storage
+import uploads
 
-logging.basicConfig(
-    stream=sys.stdout,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p",
-)
+logs.setup_logging()
+LOGGER = logging.getLogger(__name__)
 
 # >> The application is a small service.
 APP = Flask(__name__)
@@ -35,12 +36,43 @@ APP = Flask(__name__)
 
 SECRET = "hello"
 
+MAX_WAY_POINTS_PER_BATCH = 5000
+
+MAX_ROUTE_IDS_PER_LENGTHS_REQUEST = 5000
+
+MAX_LONGEST_ROUTES_K = 100
+MAX_LONGEST_ROUTES_DAYS = 366
+
+
+@APP.before_request
+def start_timer():
+    g.start_time = timeit.default_timer()
+
+
+@APP.after_request
+def record_request(response):
+    """Observes the latency of the request in metrics.REQUEST_SECONDS
+
+    The request is labelled with its route, e.g. /route/<int:route_id>/length/,
+    rather than its path, so that every route_id shares one series.
+    """
+    start_time = g.pop("start_time", None)
+    if start_time is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe_request(
+            request.method,
+            endpoint,
+            response.status_code,
+            timeit.default_timer() - start_time,
+        )
+    return response
+
 
 @APP.route("/initialize_db/", methods=["POST"])
 def initialize_db():
     """bootstrap_endpoint
 
-    Bootstraps the database using the models.initialize_db() method.
+    Bootstraps the storage backend, for Postgres with models.initialize_db().
 
     Returns:
         dict, 201 response code: success
@@ -49,17 +81,13 @@ def initialize_db():
     """
     secret_key = request.get_json()
     if secret_key["key"] == SECRET:
-        models.initialize_db()
-        exists = models.db_exists(models.DB_NAME)
-        routes_table_exists = models.table_exists("routes")
-        route_lengths_exists = models.table_exists("route_lengths")
-        assert exists == routes_table_exists == route_lengths_exists
-        APP.logger.info("PostGres DB with tables is online.")
+        assert storage.get_storage().bootstrap()
+        LOGGER.info("PostGres DB with tables is online.")
         return (
             json.dumps({"Success!": "PostGres DB with postgis extensions is created."}),
             201,
         )
-    APP.logger.warn("Error! Failed to initialize the db.")
+    LOGGER.warning("Error! Failed to initialize the db.")
     return json.dumps({"Error": "Failed to initialize the db"}), 500
 
 
@@ -70,9 +98,9 @@ def create_route():
     >> The service accepts data from a GPS tracker device.
     >> In the beginning of a track, the service requests a route to be created...
     """
-    APP.logger.debug("New route_id requested.")
+    LOGGER.debug("New route_id requested.")
     new_route = controller.create_route()
-    APP.logger.debug("New route_id assigned: %s.", new_route)
+    LOGGER.debug("New route_id assigned: %s.", new_route)
     return json.dumps(new_route), 201
 
 
@@ -98,6 +126,146 @@ def add_way_point(route_id):
     return controller.update_route(route_id, coordinates["lon"], coordinates["lat"])
 
 
+@APP.route("/route/<int:route_id>/way_points/", methods=["POST"])
+def add_way_points(route_id):
+    """route_add_way_points_endpoint
+
+    Devices that buffer their data points replay them here in one request,
+    e.g. [{"lat": 52.52, "lon": 13.40}, {"lat": 52.53, "lon": 13.41}].
+    The whole batch is written in a single statement, in the order sent.
+
+    The batch can also be sent packed, as MessagePack or as an encoded
+    polyline (with ?precision decimal places), see uploads.py for the
+    schema of each content type.
+
+    Args:
+        route_id (int): A route_id supplied by the user in the POST
+
+    Returns:
+        dict, 201 response code: with the received and inserted counts
+        dict, 400 response code: if the body is not a list of coordinates
+        dict, 404 response code: if the route_id does not exist in the route_lengths table
+        dict, 403 response code: if the creation time of the route_id is older than today
+        dict, 413 response code: if the batch has more than MAX_WAY_POINTS_PER_BATCH points
+    """
+    try:
+        precision = int(request.args.get("precision", 5))
+    except ValueError:
+        precision = None
+    if precision is None or not 0 <= precision <= 8:
+        return json.dumps({"Error": "precision must be 0 to 8."}), 400
+    try:
+        longitudes, latitudes, epochs = uploads.decode_way_points(
+            request.mimetype, request.get_data(), precision
+        )
+    except ValueError as err:
+        return json.dumps({"Error": str(err)}), 400
+    if len(longitudes) > MAX_WAY_POINTS_PER_BATCH:
+        return (
+            json.dumps(
+                {
+                    "Error": "At most {} waypoints per batch.".format(
+                        MAX_WAY_POINTS_PER_BATCH
+                    )
+                }
+            ),
+            413,
+        )
+    return controller.update_route_columns(
+        route_id, *uploads.as_lists(longitudes, latitudes, epochs)
+    )
+
+
+@APP.route("/route/<int:route_id>/way_points/", methods=["GET"])
+def export_way_points(route_id):
+    """route_export_way_points_endpoint
+
+    Streams the waypoints of route_id in timestamp order, as ?format=geojson
+    (default), ndjson or csv. They are read from a server-side cursor in
+    chunks, so a route of any length is sent in constant memory.
+
+    ?format=polyline answers with the route as an encoded polyline instead,
+    with ?precision decimal places (default 5). ?simplify=<degrees> drops
+    the waypoints within that tolerance of the simplified route, for any
+    format.
+
+    Returns:
+        stream, 200 response code: the waypoints
+        dict, 200 response code: the encoded polyline
+        dict, 400 response code: unknown format, bad precision or tolerance
+        dict, 404 response code: route_id does not exist
+    """
+    export_format = request.args.get("format", "geojson")
+    formats = sorted(controller.WAY_POINT_EXPORT_FORMATS) + ["polyline"]
+    if export_format not in formats:
+        return (
+            json.dumps(
+                {"Error": "format must be one of {}.".format(", ".join(formats))}
+            ),
+            400,
+        )
+    try:
+        precision = int(request.args.get("precision", 5))
+        tolerance = float(request.args.get("simplify", 0.0))
+    except ValueError:
+        precision, tolerance = None, None
+    if precision is None or not 0 <= precision <= 8 or not tolerance >= 0:
+        return (
+            json.dumps(
+                {"Error": "precision must be 0 to 8, simplify a tolerance >= 0."}
+            ),
+            400,
+        )
+    if not controller.route_id_exists(route_id):
+        return json.dumps({"Error": "route_id does not exist!"}), 404
+    # a tolerance of 0 keeps every waypoint, there is nothing to simplify
+    tolerance = tolerance or None
+    if export_format == "polyline":
+        return (
+            json.dumps(controller.encode_way_points(route_id, precision, tolerance)),
+            200,
+            {"Content-Type": "application/json"},
+        )
+    return Response(
+        controller.export_way_points(route_id, export_format, tolerance),
+        mimetype=controller.WAY_POINT_EXPORT_FORMATS[export_format],
+    )
+
+
+@APP.route("/export/<string:table>/")
+def export_days(table):
+    """bulk_export_endpoint
+
+    Streams every row of table (way_points or route_lengths) of the days
+    ?first_day=%Y-%m-%d through ?last_day (inclusive, first_day by default)
+    as ?format=csv (default) or binary, straight from COPY ... TO STDOUT.
+
+    Returns:
+        stream, 200 response code: the rows
+        dict, 400 response code: unknown table or format, or malformed days
+        dict, 501 response code: the storage backend is not postgres
+    """
+    if storage.STORAGE_BACKEND != "postgres":
+        return json.dumps({"Error": "Bulk exports need the postgres backend."}), 501
+    copy_format = request.args.get("format", "csv")
+    if table not in export.TABLES or copy_format not in export.CONTENT_TYPES:
+        return json.dumps({"Error": "Unknown table or format."}), 400
+    try:
+        first_day = export.parse_day(request.args.get("first_day", ""))
+        last_day = export.parse_day(request.args.get("last_day") or str(first_day))
+    except ValueError:
+        return (
+            json.dumps({"Error": "first_day and last_day must be %Y-%m-%d dates."}),
+            400,
+        )
+    filename = "{}_{}_{}.{}".format(table, first_day, last_day, copy_format)
+    return Response(
+        export.stream_days(table, first_day, last_day, copy_format),
+        mimetype=export.CONTENT_TYPES[copy_format],
+        headers={"Content-Disposition": "attachment; filename={}".format(filename)},
+    )
+
+
 @APP.route("/route/<int:route_id>/length/")
 def calculate_length(route_id):
     """route_length_endpoint
@@ -107,6 +275,9 @@ def calculate_length(route_id):
     "Eventually" is ambiguous, so we allow for queries on the length of a
     route that is still in progress.
 
+    With ?verify=true, the stored length is compared against a full scan of
+    the route's waypoints, and both are returned along with their drift.
+
     Args:
         route_id (int): A route_id supplied by the user in a POST
 
@@ -114,19 +285,68 @@ def calculate_length(route_id):
         dict, 201 response code: success
         dict, 404 response code: if the route_id has no waypoints
     """
-    route_id_has_waypoints = controller.route_id_has_waypoints(route_id)
-    if not route_id_has_waypoints:
+    if request.args.get("verify") == "true":
+        length_of_route = controller.verify_length_of_single_route(route_id)
+    else:
+        length_of_route = controller.get_length_of_single_route(route_id)
+    if length_of_route is None:
         return (
             json.dumps(
                 {"Error": "route_id {} has not added any waypoints".format(route_id)}
             ),
             404,
         )
-    length_of_route = controller.get_length_of_single_route(route_id)
+    if isinstance(length_of_route, dict):
+        return json.dumps(length_of_route), 201
     return json.dumps({"route_id": route_id, "km": length_of_route[0]}), 201
 
 
 
+@APP.route("/routes/lengths", methods=["GET", "POST"])
+def route_lengths():
+    """route_lengths_endpoint
+
+    The stored lengths of many routes in one request, for dashboards, with
+    GET /routes/lengths?route_ids=1,2,3 or a POST of [1, 2, 3] (or of
+    {"route_ids": [1, 2, 3]}). The answer is streamed.
+
+    Returns:
+        stream, 200 response code: the "routes", km null for a route without
+            waypoints, and the "unknown" route_ids
+        dict, 400 response code: if the route_ids are not a list of integers
+        dict, 413 response code: if there are more than
+            MAX_ROUTE_IDS_PER_LENGTHS_REQUEST route_ids
+    """
+    if request.method == "POST":
+        route_ids = request.get_json(silent=True)
+        if isinstance(route_ids, dict):
+            route_ids = route_ids.get("route_ids")
+    else:
+        route_ids = request.args.get("route_ids", "").split(",")
+    try:
+        route_ids = [int(route_id) for route_id in route_ids]
+    except (TypeError, ValueError):
+        route_ids = []
+    if not route_ids:
+        return json.dumps({"Error": "Expected a list of route_ids."}), 400
+    # the order of the first occurrence of every route_id
+    route_ids = list(collections.OrderedDict.fromkeys(route_ids))
+    if len(route_ids) > MAX_ROUTE_IDS_PER_LENGTHS_REQUEST:
+        return (
+            json.dumps(
+                {
+                    "Error": "At most {} route_ids per request.".format(
+                        MAX_ROUTE_IDS_PER_LENGTHS_REQUEST
+                    )
+                }
+            ),
+            413,
+        )
+    return Response(
+        controller.stream_route_lengths(route_ids), mimetype="application/json"
+    )
+
+
 @APP.route("/longest-route/<string:query_date>")
 def calculate_longest_route_for_day(query_date):
     """route_longest_route_in_day_endpoint
@@ -143,44 +363,124 @@ def calculate_longest_route_for_day(query_date):
         dict, 201 response code: if there were waypoints for query_date older than today
         dict, 403 response code): if the route_id was created today
         dict, 404 response code: if there are no waypoints for query_date
+        dict, 503 response code: if query_date is not finalized yet, with a
+            Retry-After header
     """
-    if controller.query_date_is_in_cache(query_date):# This is db lookuo #1
+    # shared cache lookup
+    longest_route_in_a_day = controller.cached_longest_route_in_day(query_date)
+
+    if longest_route_in_a_day is None:
+        query_older_than_today = \
+            controller.is_query_date_older_than_today(query_date)# ram op
+
+        if not query_older_than_today:
+            return (
+                json.dumps({"Error": "The request will only query days in the past."}),
+                403,
+            )
+        # This is db lookuo #1
+        try:
+            longest_route_in_a_day = controller.query_longest_route_in_day(query_date)
+        except storage.DayNotFinalized as error:
+            return controller.day_not_finalized(error.args[0])
+        controller.update_long_route_cache(query_date, longest_route_in_a_day)
+
+    if longest_route_in_a_day:
         return (
             json.dumps(
                 {
                     "date": query_date,
-                    "route_id": controller.LONGEST_ROUTE_IN_DAY_CACHE[query_date][0],
-                    "km": controller.LONGEST_ROUTE_IN_DAY_CACHE[query_date][1],
+                    "route_id": longest_route_in_a_day[0],
+                    "km": longest_route_in_a_day[1],
                 }
             ),
             201,
         )
+    # It is possible that there were no routes for query_date.
+    return (json.dumps({"Error": "No routes recorded for {}".format(query_date)}), 404)
+
+
+@APP.route("/longest-routes")
+def longest_routes():
+    """route_longest_routes_endpoint
 
-    query_older_than_today = \
-        controller.is_query_date_older_than_today(query_date)# ram op
+    The k longest routes over a range of past days, e.g. a weekly
+    leaderboard, /longest-routes?from=2019-09-01&to=2019-09-07&k=10, with
+    the longest route of each day of the range.
 
-    if not query_older_than_today:
+    Returns:
+        dict, 200 response code: the 'routes' and the per-day 'days'
+        dict, 400 response code: bad dates, k or a range of too many days
+        dict, 403 response code: if the range includes today
+        dict, 503 response code: if the range is not finalized yet, with a
+            Retry-After header
+    """
+    try:
+        first_day = datetime.datetime.strptime(request.args["from"], "%Y-%m-%d")
+        last_day = datetime.datetime.strptime(request.args["to"], "%Y-%m-%d")
+        k = int(request.args.get("k", 10))
+    except (KeyError, ValueError):
         return (
-            json.dumps({"Error": "The request will only query days in the past."}),
-            403,
+            json.dumps({"Error": "from and to must be %Y-%m-%d dates, k a number."}),
+            400,
         )
-    # This is db lookuo #2
-    longest_route_in_a_day = controller.query_longest_route_in_day()
-
-    if longest_route_in_a_day:
-        controller.update_long_route_cache(query_date, longest_route_in_a_day)
+    first_day, last_day = first_day.date(), last_day.date()
+    days = (last_day - first_day).days + 1
+    if not 1 <= days <= MAX_LONGEST_ROUTES_DAYS or not 1 <= k <= MAX_LONGEST_ROUTES_K:
         return (
             json.dumps(
                 {
-                    "date": query_date,
-                    "route_id": longest_route_in_a_day[0],
-                    "km": longest_route_in_a_day[1],
+                    "Error": "The range must be 1 to {} days, k 1 to {}.".format(
+                        MAX_LONGEST_ROUTES_DAYS, MAX_LONGEST_ROUTES_K
+                    )
                 }
             ),
-            201,
+            400,
         )
-    # It is possible that there were no routes for query_date.
-    return (json.dumps({"Error": "No routes recorded for {}".format(query_date)}), 404)
+    if last_day >= datetime.date.today():
+        return (
+            json.dumps({"Error": "The request will only query days in the past."}),
+            403,
+        )
+    try:
+        longest = controller.query_longest_routes(first_day, last_day, k)
+    except storage.DayNotFinalized as error:
+        return controller.day_not_finalized(error.args[0])
+    return json.dumps(longest), 200
+
+
+@APP.route("/cache/stats/")
+def cache_stats():
+    """cache_stats_endpoint
+
+    Returns:
+        dict, 200 response code: hit/miss/eviction counters and sizes of the
+            controller caches, null where uWSGI does not measure them, and
+            the counters of the waypoint buffer of the worker that
+            answered, null unless waypoints are buffered
+    """
+    return (
+        json.dumps(
+            {
+                "route_meta": controller.ROUTE_META_CACHE.stats(),
+                "longest_route": controller.LONGEST_ROUTE_IN_DAY_CACHE.stats(),
+                "way_point_buffer": controller.way_point_buffer_stats(),
+            }
+        ),
+        200,
+    )
+
+
+@APP.route("/metrics")
+def prometheus_metrics():
+    """metrics_endpoint
+
+    Returns:
+        text, 200 response code: request and query latencies of all workers
+            in the Prometheus text format, see metrics.py
+    """
+    body, content_type = metrics.exposition()
+    return body, 200, {"Content-Type": content_type}
 
 
 if __name__ == "__main__":
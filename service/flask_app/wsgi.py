@@ -2,8 +2,68 @@
 """
 Module for running the production http server
 """
+import logging
 
+import psycopg2
+
+import controller
+import metrics
+import models
+import spool
+import storage
+import tasks
 from views import APP as application
 
+try:
+    from uwsgidecorators import postfork
+except ImportError:  # not running under uWSGI
+    postfork = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+if postfork is not None:
+
+    @postfork
+    def init_db_pool():
+        """Opens the connection pool of each uWSGI worker after the fork
+
+        A worker restarted with waypoints left in its spool starts replaying
+        them.
+        """
+        try:
+            if storage.STORAGE_BACKEND == "postgres":
+                models.init_pool()
+        except psycopg2.Error as err:
+            # The db may not be bootstrapped yet; models.get_pool() retries
+            # lazily on the first query.
+            LOGGER.warning("Deferring connection pool creation: %s", err)
+        pending = spool.resume_spool()
+        if pending:
+            LOGGER.info("Replaying %s spooled waypoints", pending)
+
+
+def warm_caches():
+    """Pre-warms the longest-route cache before the workers are forked
+
+    Under uWSGI the cache is shared, so the master loads it once for all
+    workers. The master's connections are closed again before the fork.
+    """
+    try:
+        warmed = controller.warm_long_route_cache(
+            controller.LONGEST_ROUTE_CACHE_WARM_DAYS
+        )
+        LOGGER.info("Pre-warmed the longest route cache with %s days", warmed)
+    except psycopg2.Error as err:
+        LOGGER.warning("Skipping the longest route cache warm-up: %s", err)
+    finally:
+        models.close_pool()
+
+
+metrics.reset_multiprocess_dir()
+warm_caches()
+tasks.register_uwsgi_cron()
+
+
 if __name__ == "__main__":
     application.run()